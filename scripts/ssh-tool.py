@@ -3,6 +3,7 @@
 # /// script
 # requires-python = ">=3.11"
 # dependencies = [
+#   "asyncssh>=2.14",
 #   "pyyaml>=6.0",
 #   "rich>=14.0.0",
 #   "typer>=0.26.7",
@@ -20,18 +21,39 @@ from __future__ import annotations
 
 import asyncio
 import fnmatch
-import ipaddress
-import readline
+import importlib
+import math
+import os
+import posixpath
+import queue
+import random
 import re
+import secrets
+import shlex
+import shutil
+import signal
+import stat
 import subprocess
 import sys
+import tempfile
+import threading
 import time
-from dataclasses import dataclass, field
+from collections.abc import Callable, Coroutine
+from concurrent.futures import Future
+from dataclasses import dataclass, field, replace
+from functools import cached_property, partial
 from pathlib import Path
+from typing import TYPE_CHECKING
 
 import typer
-import yaml
-from rich.console import Console
+
+# yaml, rich and readline, and the stdlib modules behind the caches, the
+# history and the JSON output, are imported where they are first needed: a
+# one-off command with piped output and no config file needs none of them
+if TYPE_CHECKING:
+    import sqlite3
+
+    from rich.console import Console
 
 
 # ---------------------------------------------------------------------------
@@ -65,6 +87,10 @@ class HostDefinition:
     user: str | None = None  # SSH username override
     port: int = 22  # SSH port
     identity_file: str | None = None  # path to SSH key
+    labels: list[str] = field(
+        default_factory=list
+    )  # tags and key=value labels for --select
+    via: HostDefinition | None = None  # bastion the connection is made through
 
 
 @dataclass
@@ -82,6 +108,42 @@ class Config:
 
     hosts: dict[str, HostDefinition] = field(default_factory=dict)
     groups: dict[str, HostGroup] = field(default_factory=dict)
+    # group name -> resolved host names, filled in by `compile_groups`
+    resolved: dict[str, list[str]] = field(
+        default_factory=dict, repr=False, compare=False
+    )
+    # label -> bitmask over `host_names`, built by `index_labels`
+    label_index: dict[str, int] | None = field(default=None, repr=False, compare=False)
+
+    @cached_property
+    def host_names(self) -> list[str]:
+        """Host definition names in sorted order (what glob patterns match against)."""
+        return sorted(self.hosts)
+
+
+@dataclass
+class HostTiming:
+    """Wall-clock timestamps (seconds since the epoch) for one host's execution."""
+
+    started: float | None = None  # execution began
+    spawned: float | None = None  # ssh process / channel created
+    connected: float | None = None  # SSH connection established (when known)
+    first_byte: float | None = None  # first output byte received
+    finished: float | None = None  # result available
+
+    @property
+    def elapsed(self) -> float | None:
+        """Seconds from start to finish, if both are known."""
+        if self.started is None or self.finished is None:
+            return None
+        return self.finished - self.started
+
+    @property
+    def connect_time(self) -> float | None:
+        """Seconds from start until the connection was established, if known."""
+        if self.started is None or self.connected is None:
+            return None
+        return self.connected - self.started
 
 
 @dataclass
@@ -94,6 +156,11 @@ class CommandResult:
     exit_code: int
     timed_out: bool = False
     error: str | None = None  # connection error message
+    skipped: bool = False  # never started (batch run aborted)
+    stdout_file: Path | None = None  # full stdout when spilled to disk
+    stderr_file: Path | None = None  # full stderr when spilled to disk
+    timing: HostTiming = field(default_factory=HostTiming)
+    attempts: int = 1  # tries made, more than one after transient connection failures
 
 
 # ---------------------------------------------------------------------------
@@ -101,7 +168,40 @@ class CommandResult:
 # ---------------------------------------------------------------------------
 
 # RFC 1123 label pattern: 1-63 alphanumeric chars and hyphens, no leading/trailing hyphens
-_HOSTNAME_LABEL_RE = re.compile(r"^[a-zA-Z0-9](?:[a-zA-Z0-9-]{0,61}[a-zA-Z0-9])?$")
+_HOSTNAME_LABEL = r"[a-zA-Z0-9](?:[a-zA-Z0-9-]{0,61}[a-zA-Z0-9])?"
+# Whole hostname: dot-separated labels, optional trailing dot, at most 253 characters
+_HOSTNAME = rf"(?=.{{1,253}}\Z){_HOSTNAME_LABEL}(?:\.{_HOSTNAME_LABEL})*\.?"
+
+# Dotted quad without leading zeros, as accepted by ipaddress
+_DEC_OCTET = r"(?:25[0-5]|2[0-4][0-9]|1[0-9][0-9]|[1-9]?[0-9])"
+_IPV4 = rf"{_DEC_OCTET}(?:\.{_DEC_OCTET}){{3}}"
+
+# RFC 4291 text forms (RFC 3986 IPv6address), plus an optional %scope
+_H16 = r"[0-9a-fA-F]{1,4}"
+_LS32 = rf"(?:{_H16}:{_H16}|{_IPV4})"
+_IPV6 = (
+    "(?:"
+    + "|".join(
+        [
+            rf"(?:{_H16}:){{6}}{_LS32}",
+            rf"::(?:{_H16}:){{5}}{_LS32}",
+            rf"(?:{_H16})?::(?:{_H16}:){{4}}{_LS32}",
+            rf"(?:(?:{_H16}:){{0,1}}{_H16})?::(?:{_H16}:){{3}}{_LS32}",
+            rf"(?:(?:{_H16}:){{0,2}}{_H16})?::(?:{_H16}:){{2}}{_LS32}",
+            rf"(?:(?:{_H16}:){{0,3}}{_H16})?::{_H16}:{_LS32}",
+            rf"(?:(?:{_H16}:){{0,4}}{_H16})?::{_LS32}",
+            rf"(?:(?:{_H16}:){{0,5}}{_H16})?::{_H16}",
+            rf"(?:(?:{_H16}:){{0,6}}{_H16})?::",
+        ]
+    )
+    + r")(?:%[^%/]+)?"
+)
+
+_HOSTNAME_RE = re.compile(rf"{_HOSTNAME}\Z")
+_IPV4_RE = re.compile(rf"{_IPV4}\Z")
+_IPV6_RE = re.compile(rf"{_IPV6}\Z")
+# Every dotted quad is also a valid hostname, so two alternatives cover all entries
+_HOST_ENTRY_RE = re.compile(rf"(?:{_HOSTNAME}|{_IPV6})\Z")
 
 
 def validate_hostname(s: str) -> bool:
@@ -113,47 +213,26 @@ def validate_hostname(s: str) -> bool:
     - Each label: 1-63 characters, alphanumeric and hyphens only
     - No leading or trailing hyphens in labels
     """
-    if not s or len(s) > 253:
-        return False
-
-    # Remove trailing dot (FQDN notation)
-    if s.endswith("."):
-        s = s[:-1]
-
-    if not s:
-        return False
-
-    labels = s.split(".")
-    for label in labels:
-        if not label or len(label) > 63:
-            return False
-        if not _HOSTNAME_LABEL_RE.match(label):
-            return False
-
-    return True
+    return _HOSTNAME_RE.match(s) is not None
 
 
 def validate_ipv4(s: str) -> bool:
     """Validate an IPv4 address string."""
-    try:
-        ipaddress.IPv4Address(s)
-        return True
-    except (ipaddress.AddressValueError, ValueError):
-        return False
+    return _IPV4_RE.match(s) is not None
 
 
 def validate_ipv6(s: str) -> bool:
-    """Validate an IPv6 address string."""
-    try:
-        ipaddress.IPv6Address(s)
-        return True
-    except (ipaddress.AddressValueError, ValueError):
-        return False
+    """Validate an IPv6 address string (optionally with a %scope)."""
+    return _IPV6_RE.match(s) is not None
 
 
 def validate_host_entry(s: str) -> bool:
-    """Validate a host entry as a valid hostname, IPv4, or IPv6 address."""
-    return validate_hostname(s) or validate_ipv4(s) or validate_ipv6(s)
+    """Validate a host entry as a valid hostname, IPv4, or IPv6 address.
+
+    Uses a single precompiled pattern; equivalent to checking
+    `validate_hostname`, `validate_ipv4` and `validate_ipv6` in turn.
+    """
+    return _HOST_ENTRY_RE.match(s) is not None
 
 
 # ---------------------------------------------------------------------------
@@ -171,44 +250,102 @@ def validate_connection_timeout(timeout: int) -> bool:
     return 1 <= timeout <= 300
 
 
+# ---------------------------------------------------------------------------
+# Bastions
+# ---------------------------------------------------------------------------
+
+# Default number of hosts in flight behind one bastion (--bastion-forks),
+# matching sshd's default MaxSessions
+_DEFAULT_BASTION_FORKS = 10
+
+
+def parse_bastion(spec: str) -> HostDefinition:
+    """Parse a bastion given as [user@]host[:port] (IPv6 with a port as [addr]:port).
+
+    Raises:
+        ValidationError: If the host or port is invalid.
+    """
+    user, _, target = spec.rpartition("@")
+    port = "22"
+    if target.startswith("["):
+        hostname, _, rest = target[1:].partition("]")
+        if rest:
+            port = rest.removeprefix(":")
+    elif target.count(":") == 1:
+        hostname, port = target.split(":")
+    else:
+        hostname = target
+    if not validate_host_entry(hostname):
+        raise ValidationError(
+            f"invalid bastion '{spec}': does not match hostname, IPv4, or IPv6 format"
+        )
+    if not port.isdigit() or not validate_port(int(port)):
+        raise ValidationError(
+            f"invalid bastion '{spec}': port must be in range [1, 65535]"
+        )
+    return HostDefinition(
+        name=spec, hostname=hostname, user=user or None, port=int(port)
+    )
+
+
 # ---------------------------------------------------------------------------
 # Host File Parsing
 # ---------------------------------------------------------------------------
 
 _MAX_HOST_FILE_ENTRIES = 10_000
+# Invalid entries listed in a host file error before the rest are counted
+_MAX_REPORTED_INVALID = 20
 
 
-def parse_host_file(path: Path) -> list[str]:
+def parse_host_file(path: Path, max_entries: int = _MAX_HOST_FILE_ENTRIES) -> list[str]:
     """Read a host file and return a list of validated host entries.
 
-    Reads the file at the given path, strips blank and whitespace-only lines,
-    validates each remaining entry, and returns the list of valid hosts.
+    Reads the file at the given path line by line, skips blank and
+    whitespace-only lines, and validates each remaining entry as it is read
+    with one precompiled pattern, so an oversized file is rejected without
+    loading all of it. Invalid entries are collected and reported together
+    once the whole file has been read.
+
+    Args:
+        path: The host file.
+        max_entries: Maximum number of entries accepted (--max-hosts).
 
     Raises:
         ValidationError: If the file cannot be read, contains invalid entries,
             or exceeds the maximum entry limit.
     """
+    entries: list[str] = []
+    invalid: list[tuple[int, str]] = []
+    is_valid = _HOST_ENTRY_RE.match
     try:
-        content = path.read_text()
+        with path.open() as f:
+            for number, line in enumerate(f, 1):
+                stripped = line.strip()
+                if not stripped:
+                    continue
+                if is_valid(stripped) is None:
+                    invalid.append((number, stripped))
+                    continue
+                if len(entries) == max_entries:
+                    raise ValidationError(
+                        f"host file '{path}': exceeds maximum of {max_entries} entries"
+                    )
+                entries.append(stripped)
     except FileNotFoundError:
         raise ValidationError(f"host file '{path}': No such file or directory")
     except OSError as e:
         raise ValidationError(f"host file '{path}': {e.strerror}")
 
-    entries: list[str] = []
-    for line in content.splitlines():
-        stripped = line.strip()
-        if not stripped:
-            continue
-        if not validate_host_entry(stripped):
-            raise ValidationError(
-                f"invalid host entry '{stripped}': does not match hostname, IPv4, or IPv6 format"
-            )
-        entries.append(stripped)
-
-    if len(entries) > _MAX_HOST_FILE_ENTRIES:
+    if invalid:
+        listed = ", ".join(
+            f"'{entry}' (line {number})"
+            for number, entry in invalid[:_MAX_REPORTED_INVALID]
+        )
+        if len(invalid) > _MAX_REPORTED_INVALID:
+            listed += f" and {len(invalid) - _MAX_REPORTED_INVALID} more"
+        noun = "entry" if len(invalid) == 1 else "entries"
         raise ValidationError(
-            f"host file '{path}': exceeds maximum of {_MAX_HOST_FILE_ENTRIES} entries"
+            f"invalid host {noun} {listed}: does not match hostname, IPv4, or IPv6 format"
         )
 
     return entries
@@ -244,20 +381,32 @@ def load_config(path: Path) -> Config:
     """Parse a YAML configuration file and return a validated Config object.
 
     The YAML file is expected to have:
-    - hosts.<name> mappings with at least a 'hostname' field
+    - hosts.<name> mappings with at least a 'hostname' field, and optional
+      'labels' (a list of tags, or a mapping indexed as key=value) and 'via'
+      (a bastion: the name of another host, or [user@]host[:port])
     - groups.<name> mappings with a 'hosts' list and optional 'groups' list
 
     Raises:
         ConfigError: If the file cannot be read, is not valid YAML, or contains
             invalid host definitions (missing hostname, invalid port).
     """
+    return parse_config(_read_config_text(path), path)
+
+
+def _read_config_text(path: Path) -> str:
+    """Read a configuration file, raising ConfigError if it cannot be read."""
     try:
-        content = path.read_text()
+        return path.read_text()
     except FileNotFoundError:
         raise ConfigError(f"config file '{path}': No such file or directory")
     except OSError as e:
         raise ConfigError(f"config file '{path}': {e.strerror}")
 
+
+def parse_config(content: str, path: Path) -> Config:
+    """Parse YAML configuration text read from path (see `load_config`)."""
+    import yaml
+
     try:
         data = yaml.safe_load(content)
     except yaml.YAMLError as e:
@@ -271,6 +420,7 @@ def load_config(path: Path) -> Config:
 
     hosts: dict[str, HostDefinition] = {}
     groups: dict[str, HostGroup] = {}
+    vias: dict[str, str] = {}  # host name -> its 'via' value
 
     # Parse host definitions
     raw_hosts = data.get("hosts", {})
@@ -279,9 +429,7 @@ def load_config(path: Path) -> Config:
 
     for name, host_data in raw_hosts.items():
         if not isinstance(host_data, dict):
-            raise ConfigError(
-                f"config file '{path}': host '{name}' must be a mapping"
-            )
+            raise ConfigError(f"config file '{path}': host '{name}' must be a mapping")
 
         # Validate required field: hostname
         hostname = host_data.get("hostname")
@@ -301,14 +449,48 @@ def load_config(path: Path) -> Config:
                 f"config file '{path}': host '{name}' has invalid port {port}: must be in range [1, 65535]"
             )
 
+        # Labels are a list of tags or a mapping, indexed as key=value
+        raw_labels = host_data.get("labels", [])
+        if isinstance(raw_labels, dict):
+            labels = [f"{key}={value}" for key, value in raw_labels.items()]
+        elif isinstance(raw_labels, list):
+            labels = [str(label) for label in raw_labels]
+        else:
+            raise ConfigError(
+                f"config file '{path}': host '{name}' 'labels' must be a list or mapping"
+            )
+
+        if host_data.get("via") is not None:
+            vias[name] = str(host_data["via"])
+
         hosts[name] = HostDefinition(
             name=name,
             hostname=str(hostname),
             user=host_data.get("user"),
             port=port,
             identity_file=host_data.get("identity_file"),
+            labels=labels,
         )
 
+    # A 'via' names another host of the config, or is a [user@]host[:port]
+    for name, via in vias.items():
+        chain = [name]
+        while via in vias and via not in chain:
+            chain.append(via)
+            via = vias[via]
+        if via in chain:
+            raise ConfigError(
+                f"config file '{path}': circular 'via' reference: {' -> '.join(chain + [via])}"
+            )
+    for name, via in vias.items():
+        if via in hosts:
+            hosts[name].via = hosts[via]
+        else:
+            try:
+                hosts[name].via = parse_bastion(via)
+            except ValidationError as e:
+                raise ConfigError(f"config file '{path}': host '{name}' has {e}")
+
     # Parse group definitions
     raw_groups = data.get("groups", {})
     if not isinstance(raw_groups, dict):
@@ -316,9 +498,7 @@ def load_config(path: Path) -> Config:
 
     for name, group_data in raw_groups.items():
         if not isinstance(group_data, dict):
-            raise ConfigError(
-                f"config file '{path}': group '{name}' must be a mapping"
-            )
+            raise ConfigError(f"config file '{path}': group '{name}' must be a mapping")
 
         group_hosts = group_data.get("hosts", [])
         if not isinstance(group_hosts, list):
@@ -338,78 +518,9 @@ def load_config(path: Path) -> Config:
             groups=[str(g) for g in group_groups],
         )
 
-    return Config(hosts=hosts, groups=groups)
-
-
-def resolve_group(
-    config: Config, group_name: str, seen: set[str] | None = None
-) -> list[HostDefinition]:
-    """Recursively resolve a group to a flat list of HostDefinitions.
-
-    Detects circular references and undefined host/group references.
-
-    Args:
-        config: The parsed configuration.
-        group_name: The name of the group to resolve.
-        seen: Set of group names already visited (for cycle detection).
-
-    Raises:
-        ConfigError: If the group references an undefined host/group or if a
-            circular reference is detected.
-    """
-    if seen is None:
-        seen = set()
-
-    group_key = group_name.lower()
-    if group_key in seen:
-        cycle_path = " -> ".join(sorted(seen)) + " -> " + group_name
-        raise ConfigError(f"config group cycle detected: {cycle_path}")
-
-    # Find the group (case-sensitive lookup)
-    if group_name not in config.groups:
-        raise ConfigError(
-            f"config group '{group_name}': references undefined group '{group_name}'"
-        )
-
-    seen = seen | {group_key}
-    group = config.groups[group_name]
-    result: list[HostDefinition] = []
-
-    # Resolve direct host references (supports glob patterns)
-    for host_ref in group.hosts:
-        if any(c in host_ref for c in "*?["):
-            matched = [
-                config.hosts[name]
-                for name in sorted(config.hosts.keys())
-                if fnmatch.fnmatchcase(name, host_ref)
-            ]
-            if not matched:
-                raise ConfigError(
-                    f"config group '{group_name}': host pattern '{host_ref}' matched no hosts"
-                )
-            result.extend(matched)
-        else:
-            if host_ref not in config.hosts:
-                raise ConfigError(
-                    f"config group '{group_name}': references undefined host '{host_ref}'"
-                )
-            result.append(config.hosts[host_ref])
-
-    # Resolve nested group references
-    for nested_group_ref in group.groups:
-        nested_hosts = resolve_group(config, nested_group_ref, seen)
-        result.extend(nested_hosts)
-
-    # Deduplicate by name (case-insensitive), keeping first occurrence
-    seen_names: set[str] = set()
-    deduplicated: list[HostDefinition] = []
-    for host in result:
-        key = host.name.lower()
-        if key not in seen_names:
-            seen_names.add(key)
-            deduplicated.append(host)
-
-    return deduplicated
+    config = Config(hosts=hosts, groups=groups)
+    index_labels(config)
+    return config
 
 
 # ---------------------------------------------------------------------------
@@ -429,6 +540,7 @@ class HostRegistry:
         user: str | None,
         port: int,
         identity_file: str | None,
+        via: HostDefinition | None = None,
     ) -> None:
         """Add hosts from CLI-provided hostnames.
 
@@ -440,6 +552,7 @@ class HostRegistry:
             user: SSH username override (applied to all CLI hosts).
             port: SSH port (applied to all CLI hosts).
             identity_file: Path to SSH key (applied to all CLI hosts).
+            via: Optional bastion (applied to all CLI hosts).
         """
         for hostname in hostnames:
             self.hosts.append(
@@ -449,6 +562,7 @@ class HostRegistry:
                     user=user,
                     port=port,
                     identity_file=identity_file,
+                    via=via,
                 )
             )
 
@@ -462,10 +576,20 @@ class HostRegistry:
             config: The parsed configuration.
             group_names: List of group names to resolve and add.
         """
+        memo: dict[str, list[HostDefinition]] = {}
         for group_name in group_names:
-            resolved = resolve_group(config, group_name)
+            resolved = resolve_group(config, group_name, memo=memo)
             self.hosts.extend(resolved)
 
+    def add_from_inventory(self, hosts: list[HostDefinition]) -> None:
+        """Add hosts returned by an inventory source (see `InventoryResultCache`)."""
+        self.hosts.extend(hosts)
+
+    def add_from_selection(self, config: Config, expressions: list[str]) -> None:
+        """Add the config hosts matched by each --select expression (see `select_hosts`)."""
+        for expression in expressions:
+            self.hosts.extend(select_hosts(config, expression))
+
     def deduplicate(self) -> None:
         """Remove duplicate entries by name (case-insensitive), keeping first occurrence."""
         seen: set[str] = set()
@@ -483,7 +607,10 @@ class HostRegistry:
 
 
 def resolve_group(
-    config: Config, group_name: str, seen: list[str] | None = None
+    config: Config,
+    group_name: str,
+    seen: list[str] | None = None,
+    memo: dict[str, list[HostDefinition]] | None = None,
 ) -> list[HostDefinition]:
     """Recursively resolve a group to a flat, deduplicated list of HostDefinitions.
 
@@ -494,6 +621,8 @@ def resolve_group(
         config: The parsed configuration containing hosts and groups.
         group_name: The name of the group to resolve.
         seen: List of group names already visited in this resolution path (for cycle detection).
+        memo: Groups already resolved in this traversal, shared with nested calls
+            so a group reachable along many paths is resolved only once.
 
     Returns:
         A list of HostDefinition objects, deduplicated case-insensitively by name,
@@ -505,6 +634,14 @@ def resolve_group(
     """
     if seen is None:
         seen = []
+    if memo is None:
+        memo = {}
+
+    # A group still being resolved is never memoized, so cycles are still caught
+    if group_name in memo:
+        return memo[group_name]
+    if group_name in config.resolved:
+        return [config.hosts[name] for name in config.resolved[group_name]]
 
     # Cycle detection
     if group_name in seen:
@@ -513,9 +650,7 @@ def resolve_group(
 
     # Undefined group check
     if group_name not in config.groups:
-        raise ConfigError(
-            f"config group references undefined group '{group_name}'"
-        )
+        raise ConfigError(f"config group references undefined group '{group_name}'")
 
     seen = seen + [group_name]
     group = config.groups[group_name]
@@ -525,11 +660,8 @@ def resolve_group(
     for host_ref in group.hosts:
         if any(c in host_ref for c in "*?["):
             # Glob pattern: match against all host definition names
-            matched = [
-                config.hosts[name]
-                for name in sorted(config.hosts.keys())
-                if fnmatch.fnmatchcase(name, host_ref)
-            ]
+            match = re.compile(fnmatch.translate(host_ref)).match
+            matched = [config.hosts[name] for name in config.host_names if match(name)]
             if not matched:
                 raise ConfigError(
                     f"config group '{group_name}': host pattern '{host_ref}' matched no hosts"
@@ -545,7 +677,7 @@ def resolve_group(
 
     # Resolve nested group references
     for nested_group_name in group.groups:
-        nested_hosts = resolve_group(config, nested_group_name, seen)
+        nested_hosts = resolve_group(config, nested_group_name, seen, memo)
         result.extend(nested_hosts)
 
     # Deduplicate case-insensitively by host definition name, keeping first occurrence
@@ -557,416 +689,4350 @@ def resolve_group(
             seen_names.add(key)
             deduped.append(host_def)
 
+    memo[group_name] = deduped
     return deduped
 
 
+def compile_groups(config: Config) -> None:
+    """Pre-resolve every group of config into `config.resolved`.
+
+    Groups that fail to resolve are left out, so `resolve_group` reports their
+    errors when (and only if) they are actually requested.
+    """
+    memo: dict[str, list[HostDefinition]] = {}
+    config.resolved = {}
+    for name in config.groups:
+        try:
+            hosts = resolve_group(config, name, memo=memo)
+        except ConfigError:
+            continue
+        config.resolved[name] = [host.name for host in hosts]
+
+
 # ---------------------------------------------------------------------------
-# SSH Command Construction
+# Label Selection
 # ---------------------------------------------------------------------------
 
 
-def build_ssh_args(host: HostDefinition, connection_timeout: float) -> list[str]:
-    """Build the ssh command arguments list.
+def _positions_mask(positions, size: int) -> int:
+    """Bitmask with the given bit positions set."""
+    bits = bytearray(size // 8 + 1)
+    for i in positions:
+        bits[i >> 3] |= 1 << (i & 7)
+    return int.from_bytes(bits, "little")
 
-    Constructs the full argument list for invoking the system ssh binary,
-    including connection options, port, identity file, and user@host target.
 
-    Args:
-        host: The host definition containing connection parameters.
-        connection_timeout: SSH connection timeout in seconds (converted to int).
+def index_labels(config: Config) -> None:
+    """Build `config.label_index`, the inverted index from label to hosts.
 
-    Returns:
-        A list of strings suitable for subprocess invocation, e.g.:
-        ['ssh', '-o', 'ConnectTimeout=10', '-o', 'BatchMode=yes', '-p', '2222',
-         '-i', '/path/key', 'user@host']
+    Each host is a bit (its position in `config.host_names`), so the host set
+    of a label is one integer and set algebra is a bitwise operation.
     """
-    args: list[str] = ["ssh"]
+    positions: dict[str, list[int]] = {}
+    for i, name in enumerate(config.host_names):
+        for label in config.hosts[name].labels:
+            positions.setdefault(label, []).append(i)
+    size = len(config.host_names)
+    config.label_index = {
+        label: _positions_mask(found, size) for label, found in positions.items()
+    }
 
-    # Always include ConnectTimeout (convert float to int)
-    args.extend(["-o", f"ConnectTimeout={int(connection_timeout)}"])
 
-    # Always include BatchMode=yes for non-interactive behavior
-    args.extend(["-o", "BatchMode=yes"])
+# Operators of --select expressions, with their keyword spellings
+_SELECT_KEYWORDS = {"and": "&", "or": "|", "not": "!"}
+_SELECT_TOKEN_RE = re.compile(r"\s*(?:([()&|,!])|([^\s()&|,!]+))")
 
-    # Accept new host keys automatically (reject changed ones)
-    args.extend(["-o", "StrictHostKeyChecking=accept-new"])
 
-    # Include port only if not the default
-    if host.port != 22:
-        args.extend(["-p", str(host.port)])
+class _Selection:
+    """Recursive-descent evaluator for one --select expression.
 
-    # Include identity file if specified
-    if host.identity_file:
-        args.extend(["-i", host.identity_file])
+    Grammar (loosest binding first)::
 
-    # Build the target: user@hostname if user is set, otherwise just hostname
-    if host.user:
-        args.append(f"{host.user}@{host.hostname}")
-    else:
-        args.append(host.hostname)
+        union        := intersection (("|" | "," | "or") intersection)*
+        intersection := unary (("&" | "and") unary | ("!" | "not") unary)*
+        unary        := ("!" | "not") unary | "(" union ")" | atom
 
-    return args
+    `A not B` is a difference, `not A` the complement within all hosts. Atoms
+    are labels (`web`, `region=eu-west`), label globs (`region=eu-*`), host
+    name globs (`host=web0*`) and groups (`@webservers`).
+    """
 
+    def __init__(self, config: Config, expression: str) -> None:
+        self.config = config
+        self.expression = expression
+        self.tokens = self._tokenize(expression)
+        self.pos = 0
+        self.memo: dict[str, list[HostDefinition]] = {}
+        self.all = (1 << len(config.host_names)) - 1
+
+    def _tokenize(self, expression: str) -> list[tuple[str, str]]:
+        tokens = []
+        for match in _SELECT_TOKEN_RE.finditer(expression.rstrip()):
+            op, word = match.groups()
+            if op is not None:
+                tokens.append(("op", op))
+            elif word.lower() in _SELECT_KEYWORDS:
+                tokens.append(("op", _SELECT_KEYWORDS[word.lower()]))
+            else:
+                tokens.append(("atom", word))
+        return tokens
 
-def build_remote_command(command: str, working_dir: str | None = None) -> str:
-    """Wrap command with cd prefix if working_dir is set.
+    def _error(self, message: str) -> ValidationError:
+        return ValidationError(
+            f"invalid --select expression '{self.expression}': {message}"
+        )
 
-    Args:
-        command: The command string to execute on the remote host.
-        working_dir: Optional working directory to cd into before executing.
+    def _peek(self) -> str | None:
+        if self.pos < len(self.tokens) and self.tokens[self.pos][0] == "op":
+            return self.tokens[self.pos][1]
+        return None
+
+    def evaluate(self) -> int:
+        if not self.tokens:
+            raise self._error("empty expression")
+        mask = self._union()
+        if self.pos < len(self.tokens):
+            raise self._error(f"unexpected '{self.tokens[self.pos][1]}'")
+        return mask
+
+    def _union(self) -> int:
+        mask = self._intersection()
+        while self._peek() in ("|", ","):
+            self.pos += 1
+            mask |= self._intersection()
+        return mask
+
+    def _intersection(self) -> int:
+        mask = self._unary()
+        while True:
+            op = self._peek()
+            if op == "&":
+                self.pos += 1
+                mask &= self._unary()
+            elif op == "!":
+                self.pos += 1
+                mask &= ~self._unary()
+            else:
+                return mask
+
+    def _unary(self) -> int:
+        if self.pos >= len(self.tokens):
+            raise self._error("unexpected end")
+        kind, text = self.tokens[self.pos]
+        self.pos += 1
+        if kind == "atom":
+            return self._atom(text)
+        if text == "!":
+            return self.all & ~self._unary()
+        if text == "(":
+            mask = self._union()
+            if self._peek() != ")":
+                raise self._error("missing ')'")
+            self.pos += 1
+            return mask
+        raise self._error(f"unexpected '{text}'")
+
+    def _atom(self, text: str) -> int:
+        config = self.config
+        size = len(config.host_names)
+        if text.startswith("@"):
+            names = {
+                host.name for host in resolve_group(config, text[1:], memo=self.memo)
+            }
+            return _positions_mask(
+                (i for i, name in enumerate(config.host_names) if name in names), size
+            )
+        is_glob = any(c in text for c in "*?[")
+        if text.startswith("host="):
+            pattern = text[len("host=") :]
+            if not is_glob:
+                return _positions_mask(
+                    (i for i, name in enumerate(config.host_names) if name == pattern),
+                    size,
+                )
+            match = re.compile(fnmatch.translate(pattern)).match
+            return _positions_mask(
+                (i for i, name in enumerate(config.host_names) if match(name)), size
+            )
+        if is_glob:
+            match = re.compile(fnmatch.translate(text)).match
+            mask = 0
+            for label, hosts in config.label_index.items():
+                if match(label):
+                    mask |= hosts
+            return mask
+        return config.label_index.get(text, 0)
 
-    Returns:
-        'cd /some/dir && command' when working_dir is set, or just 'command'.
+
+def select_hosts(config: Config, expression: str) -> list[HostDefinition]:
+    """Return the config hosts matched by a --select expression, sorted by name.
+
+    See `_Selection` for the expression language.
+
+    Raises:
+        ValidationError: If the expression is malformed.
+        ConfigError: If it references a group that cannot be resolved.
     """
-    if working_dir:
-        return f"cd {working_dir} && {command}"
-    return command
+    if config.label_index is None:
+        index_labels(config)
+    mask = _Selection(config, expression).evaluate()
+    names = config.host_names
+    bits = format(mask, "b")[::-1]
+    return [config.hosts[names[i]] for i, bit in enumerate(bits) if bit == "1"]
 
 
 # ---------------------------------------------------------------------------
-# SSH Execution
+# Inventory Cache
 # ---------------------------------------------------------------------------
 
+# Bump whenever the layout of a cache entry changes
+_INVENTORY_CACHE_VERSION = 3
 
-async def run_command_on_host(
-    host: HostDefinition,
-    command: str,
-    working_dir: str | None = None,
-    timeout: float = 30.0,
-    connection_timeout: float = 10.0,
-) -> CommandResult:
-    """Execute a command on a single host via ssh subprocess.
-
-    Builds the full SSH command using `build_ssh_args` and `build_remote_command`,
-    then runs it asynchronously. Handles timeouts and connection failures gracefully.
 
-    Args:
-        host: The host definition containing connection parameters.
-        command: The command string to execute on the remote host.
-        working_dir: Optional working directory to cd into before executing.
-        timeout: Maximum time in seconds to wait for command completion.
-        connection_timeout: SSH connection timeout in seconds.
+class InventoryCache:
+    """Compiled form of YAML configs, reused while a config file is unchanged.
 
-    Returns:
-        A CommandResult with stdout, stderr, exit_code, and error/timeout info.
+    Parsing and resolving the groups of a large config dominates start-up, so
+    the parsed hosts and groups, with every group pre-resolved and the label
+    index built, are pickled under $XDG_CACHE_HOME/ssh-tool (default
+    ~/.cache/ssh-tool). An entry is used as-is while the config's mtime and
+    size are unchanged, and after checking the content hash when they are not
+    (e.g. after a touch).
     """
-    ssh_args = build_ssh_args(host, connection_timeout)
-    remote_cmd = build_remote_command(command, working_dir)
 
-    try:
-        process = await asyncio.create_subprocess_exec(
-            *ssh_args,
-            remote_cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE,
+    def __init__(self, directory: Path | None = None) -> None:
+        self.directory = directory or self.default_directory()
+
+    @staticmethod
+    def default_directory() -> Path:
+        """The cache location under the XDG cache directory."""
+        cache_home = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+        return Path(cache_home) / "ssh-tool"
+
+    def entry_path(self, config_path: Path) -> Path:
+        """The cache file holding the compiled form of config_path."""
+        import hashlib
+
+        key = hashlib.sha1(str(config_path.resolve()).encode()).hexdigest()[:16]
+        return self.directory / f"inventory-{key}.pickle"
+
+    def load(self, config_path: Path) -> Config:
+        """Return the Config for config_path, from the cache when it is current.
+
+        Raises:
+            ConfigError: As `load_config`, when the file has to be parsed.
+        """
+        try:
+            st = config_path.stat()
+        except OSError:
+            return load_config(config_path)
+        stamp = [st.st_mtime_ns, st.st_size]
+        entry_path = self.entry_path(config_path)
+        entry = self._read(entry_path, config_path)
+        if entry is not None and entry["stamp"] == stamp:
+            return self._decode(entry)
+
+        import hashlib
+
+        content = _read_config_text(config_path)
+        digest = hashlib.sha256(content.encode()).hexdigest()
+        if entry is not None and entry["sha256"] == digest:
+            config = self._decode(entry)
+        else:
+            config = parse_config(content, config_path)  # also indexes labels
+            compile_groups(config)
+        self._write(
+            entry_path,
+            {
+                "version": _INVENTORY_CACHE_VERSION,
+                "path": str(config_path),
+                "stamp": stamp,
+                "sha256": digest,
+                "hosts": [
+                    (
+                        h.name,
+                        h.hostname,
+                        h.user,
+                        h.port,
+                        h.identity_file,
+                        h.labels,
+                        h.via,
+                    )
+                    for h in config.hosts.values()
+                ],
+                "groups": [(g.name, g.hosts, g.groups) for g in config.groups.values()],
+                "resolved": config.resolved,
+                "labels": config.label_index,
+            },
         )
-    except OSError as e:
-        return CommandResult(
-            host=host,
-            stdout="",
-            stderr="",
-            exit_code=1,
-            error=str(e),
+        return config
+
+    @staticmethod
+    def _decode(entry: dict) -> Config:
+        return Config(
+            hosts={fields[0]: HostDefinition(*fields) for fields in entry["hosts"]},
+            groups={fields[0]: HostGroup(*fields) for fields in entry["groups"]},
+            resolved=entry["resolved"],
+            label_index=entry["labels"],
         )
 
-    try:
-        stdout_bytes, stderr_bytes = await asyncio.wait_for(
-            process.communicate(), timeout=timeout
-        )
-    except asyncio.TimeoutError:
-        # Kill the process on timeout
+    @staticmethod
+    def _read(entry_path: Path, config_path: Path) -> dict | None:
+        import pickle
+
         try:
-            process.kill()
-        except ProcessLookupError:
+            with entry_path.open("rb") as f:
+                entry = pickle.load(f)
+        except Exception:  # noqa: BLE001
+            # Missing, corrupt or unreadable entries are simply rebuilt
+            return None
+        if (
+            not isinstance(entry, dict)
+            or entry.get("version") != _INVENTORY_CACHE_VERSION
+            or entry.get("path") != str(config_path)
+        ):
+            return None
+        return entry
+
+    def _write(self, entry_path: Path, entry: dict) -> None:
+        import pickle
+
+        # Best effort: a read-only cache directory only costs the speed-up
+        try:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, entry_path)
+        except OSError:
             pass
-        # Wait for the process to be reaped
-        await process.wait()
-        return CommandResult(
-            host=host,
-            stdout="",
-            stderr="",
-            exit_code=1,
-            timed_out=True,
-        )
 
-    return CommandResult(
-        host=host,
-        stdout=stdout_bytes.decode(errors="replace"),
-        stderr=stderr_bytes.decode(errors="replace"),
-        exit_code=process.returncode if process.returncode is not None else 1,
+
+# ---------------------------------------------------------------------------
+# Inventory Plugins
+# ---------------------------------------------------------------------------
+
+_DEFAULT_INVENTORY_TTL = 300.0
+_INVENTORY_EXEC_TIMEOUT = 60.0
+# A refresh lock older than this is assumed to belong to a crashed refresh
+_INVENTORY_REFRESH_LOCK_AGE = 120.0
+
+
+def _inventory_labels(spec: str, name: str, raw) -> list[str]:
+    if isinstance(raw, dict):
+        return [f"{key}={value}" for key, value in raw.items()]
+    if isinstance(raw, list):
+        return [str(label) for label in raw]
+    raise ValidationError(
+        f"inventory '{spec}': host '{name}' 'labels' must be a list or mapping"
     )
 
 
-async def run_command_on_all(
-    hosts: list[HostDefinition],
-    command: str,
-    working_dirs: dict[str, str] | None = None,
+def inventory_hosts(
+    spec: str, data, max_entries: int = _MAX_HOST_FILE_ENTRIES
+) -> list[HostDefinition]:
+    """Validate the data returned by an inventory source and build its hosts.
+
+    Accepted shapes, as JSON, YAML or Python objects:
+    - a list of host entries (strings), or of mappings with 'hostname' and
+      optional 'name', 'user', 'port', 'identity_file', 'labels' and 'via'
+      (a bastion as [user@]host[:port])
+    - {"hosts": <such a list>}, or {"hosts": {name: mapping}} as in the config
+
+    Raises:
+        ValidationError: If the data has another shape, an entry is invalid,
+            or there are more than max_entries hosts.
+    """
+    if isinstance(data, dict):
+        data = data.get("hosts")
+        if isinstance(data, dict):
+            entries = []
+            for name, fields in data.items():
+                if fields is not None and not isinstance(fields, dict):
+                    raise ValidationError(
+                        f"inventory '{spec}': invalid host entry {name!r}: {fields!r}"
+                    )
+                entries.append({"name": name, **(fields or {})})
+            data = entries
+    if not isinstance(data, list):
+        raise ValidationError(f"inventory '{spec}': expected a list of hosts")
+    if len(data) > max_entries:
+        raise ValidationError(
+            f"inventory '{spec}': exceeds maximum of {max_entries} entries"
+        )
+
+    hosts: list[HostDefinition] = []
+    bastions: dict[str, HostDefinition] = {}  # shared by all hosts behind the same one
+    for item in data:
+        if isinstance(item, str):
+            item = {"hostname": item}
+        if not isinstance(item, dict) or not item.get("hostname"):
+            raise ValidationError(f"inventory '{spec}': invalid host entry {item!r}")
+        hostname = str(item["hostname"])
+        name = str(item.get("name") or hostname)
+        if not validate_host_entry(hostname):
+            raise ValidationError(
+                f"inventory '{spec}': invalid host entry '{hostname}': "
+                "does not match hostname, IPv4, or IPv6 format"
+            )
+        port = item.get("port", 22)
+        if not isinstance(port, int) or not validate_port(port):
+            raise ValidationError(
+                f"inventory '{spec}': host '{name}' has invalid port {port!r}"
+            )
+        via = item.get("via")
+        if via is not None:
+            via = str(via)
+            if via not in bastions:
+                try:
+                    bastions[via] = parse_bastion(via)
+                except ValidationError as e:
+                    raise ValidationError(f"inventory '{spec}': host '{name}' has {e}")
+            via = bastions[via]
+        hosts.append(
+            HostDefinition(
+                name=name,
+                hostname=hostname,
+                user=item.get("user"),
+                port=port,
+                identity_file=item.get("identity_file"),
+                labels=_inventory_labels(spec, name, item.get("labels", [])),
+                via=via,
+            )
+        )
+    return hosts
+
+
+class InventorySource:
+    """A source of hosts named by an --inventory spec of the form `kind:argument`."""
+
+    cacheable = True  # whether results are worth keeping in InventoryResultCache
+
+    def __init__(self, spec: str, argument: str) -> None:
+        self.spec = spec
+        self.argument = argument
+
+    def fetch(self, max_entries: int = _MAX_HOST_FILE_ENTRIES) -> list[HostDefinition]:
+        """Query the source and return its validated hosts.
+
+        Raises:
+            ValidationError: If the source fails or returns invalid data.
+        """
+        raise NotImplementedError
+
+
+class ExecInventory(InventorySource):
+    """`exec:COMMAND` -- runs a command (split like a shell would) that prints JSON."""
+
+    def fetch(self, max_entries: int = _MAX_HOST_FILE_ENTRIES) -> list[HostDefinition]:
+        try:
+            proc = subprocess.run(
+                shlex.split(self.argument),
+                capture_output=True,
+                timeout=_INVENTORY_EXEC_TIMEOUT,
+                check=False,
+            )
+        except (OSError, ValueError) as e:
+            raise ValidationError(f"inventory '{self.spec}': {e}")
+        except subprocess.TimeoutExpired:
+            raise ValidationError(
+                f"inventory '{self.spec}': timed out after {_INVENTORY_EXEC_TIMEOUT:g}s"
+            )
+        if proc.returncode != 0:
+            detail = proc.stderr.decode(errors="replace").strip().splitlines()[-1:] or [
+                ""
+            ]
+            raise ValidationError(
+                f"inventory '{self.spec}': exited with code {proc.returncode}: {detail[0]}"
+            )
+        import json
+
+        try:
+            data = json.loads(proc.stdout)
+        except ValueError as e:
+            raise ValidationError(f"inventory '{self.spec}': invalid JSON: {e}")
+        return inventory_hosts(self.spec, data, max_entries)
+
+
+class FileInventory(InventorySource):
+    """`file:PATH` -- JSON (.json), YAML (.yaml/.yml) or a plain host file."""
+
+    cacheable = False  # a local read costs no more than the cache, and sees edits
+
+    def fetch(self, max_entries: int = _MAX_HOST_FILE_ENTRIES) -> list[HostDefinition]:
+        path = Path(self.argument).expanduser()
+        suffix = path.suffix.lower()
+        if suffix not in (".json", ".yaml", ".yml"):
+            return [
+                HostDefinition(name=entry, hostname=entry)
+                for entry in parse_host_file(path, max_entries)
+            ]
+        try:
+            content = path.read_text()
+        except OSError as e:
+            raise ValidationError(f"inventory '{self.spec}': {e.strerror}")
+        import json
+
+        import yaml
+
+        try:
+            data = json.loads(content) if suffix == ".json" else yaml.safe_load(content)
+        except (ValueError, yaml.YAMLError) as e:
+            raise ValidationError(
+                f"inventory '{self.spec}': invalid {suffix[1:].upper()}: {e}"
+            )
+        return inventory_hosts(self.spec, data, max_entries)
+
+
+class PythonInventory(InventorySource):
+    """`py:MODULE:FUNCTION` -- calls a function returning hosts (see `inventory_hosts`)."""
+
+    def fetch(self, max_entries: int = _MAX_HOST_FILE_ENTRIES) -> list[HostDefinition]:
+        module_name, _, function_name = self.argument.partition(":")
+        if not module_name or not function_name:
+            raise ValidationError(
+                f"inventory '{self.spec}': expected py:MODULE:FUNCTION"
+            )
+        try:
+            module = importlib.import_module(module_name)
+            function = getattr(module, function_name)
+        except (ImportError, AttributeError) as e:
+            raise ValidationError(f"inventory '{self.spec}': {e}")
+        try:
+            data = function()
+        except Exception as e:  # noqa: BLE001 - any error in the plugin is reported
+            raise ValidationError(f"inventory '{self.spec}': {type(e).__name__}: {e}")
+        return inventory_hosts(self.spec, data, max_entries)
+
+
+_INVENTORY_PLUGINS: dict[str, type[InventorySource]] = {
+    "exec": ExecInventory,
+    "file": FileInventory,
+    "py": PythonInventory,
+}
+
+
+def make_inventory(spec: str) -> InventorySource:
+    """Create the InventorySource for an --inventory spec.
+
+    Raises:
+        ValidationError: If the spec names an unknown kind of source.
+    """
+    kind, sep, argument = spec.partition(":")
+    plugin = _INVENTORY_PLUGINS.get(kind)
+    if not sep or plugin is None or not argument:
+        kinds = ", ".join(f"{k}:" for k in _INVENTORY_PLUGINS)
+        raise ValidationError(f"invalid inventory '{spec}': expected one of {kinds}")
+    return plugin(spec, argument)
+
+
+def _refresh_in_background(refresh: Callable[[], None]) -> None:
+    """Run refresh in a detached process so the caller never waits for it."""
+    try:
+        pid = os.fork()
+    except OSError:
+        return
+    if pid:
+        # The intermediate child exits at once; the grandchild is reparented
+        os.waitpid(pid, 0)
+        return
+    try:
+        if os.fork() == 0:
+            os.setsid()
+            devnull = os.open(os.devnull, os.O_RDWR)
+            for fd in (0, 1, 2):
+                os.dup2(devnull, fd)
+            refresh()
+    finally:
+        os._exit(0)  # never return into the caller, whatever refresh raised
+
+
+def _host_fields(host: HostDefinition) -> list:
+    """Encode a host as a JSON-compatible list (see `_host_from_fields`)."""
+    return [
+        host.name,
+        host.hostname,
+        host.user,
+        host.port,
+        host.identity_file,
+        host.labels,
+        _host_fields(host.via) if host.via is not None else None,
+    ]
+
+
+def _host_from_fields(fields: list) -> HostDefinition:
+    """Decode a host encoded by `_host_fields`."""
+    name, hostname, user, port, identity_file, labels, *via = fields
+    return HostDefinition(
+        name,
+        hostname,
+        user,
+        port,
+        identity_file,
+        labels,
+        _host_from_fields(via[0]) if via and via[0] else None,
+    )
+
+
+class InventoryResultCache:
+    """TTL cache of inventory source results with stale-while-revalidate.
+
+    Results live under the inventory cache directory, one JSON file per spec.
+    Sources that are not `cacheable` (local files) are read every time. A
+    fresh entry is returned as-is. A stale one is returned immediately
+    while a detached process refreshes it, so only the very first query of
+    a source (or ttl=0) waits for it.
+    """
+
+    def __init__(
+        self, directory: Path | None = None, ttl: float = _DEFAULT_INVENTORY_TTL
+    ) -> None:
+        self.directory = directory or InventoryCache.default_directory() / "sources"
+        self.ttl = ttl
+
+    def entry_path(self, spec: str) -> Path:
+        """The cache file for the results of spec."""
+        import hashlib
+
+        return self.directory / f"{hashlib.sha1(spec.encode()).hexdigest()[:16]}.json"
+
+    def load(
+        self, source: InventorySource, max_entries: int = _MAX_HOST_FILE_ENTRIES
+    ) -> list[HostDefinition]:
+        """Return the hosts of source, fetching them only when not cached.
+
+        Raises:
+            ValidationError: If the source has to be queried and fails.
+        """
+        if not source.cacheable:
+            return source.fetch(max_entries)
+        entry = self._read(source.spec)
+        if entry is None or self.ttl <= 0:
+            hosts = source.fetch(max_entries)
+            self._write(source.spec, hosts)
+        else:
+            hosts = [_host_from_fields(fields) for fields in entry["hosts"]]
+            if time.time() - entry["fetched_at"] > self.ttl and self._lock(source.spec):
+                _refresh_in_background(lambda: self._refresh(source, max_entries))
+        if len(hosts) > max_entries:
+            raise ValidationError(
+                f"inventory '{source.spec}': exceeds maximum of {max_entries} entries"
+            )
+        return hosts
+
+    def _refresh(self, source: InventorySource, max_entries: int) -> None:
+        try:
+            self._write(source.spec, source.fetch(max_entries))
+        except ValidationError:
+            pass  # keep serving the stale entry; the next query retries
+        finally:
+            self._lock_path(source.spec).unlink(missing_ok=True)
+
+    def _lock_path(self, spec: str) -> Path:
+        return self.entry_path(spec).with_suffix(".refreshing")
+
+    def _lock(self, spec: str) -> bool:
+        """Claim the refresh of spec, unless another process is refreshing it."""
+        path = self._lock_path(spec)
+        try:
+            if time.time() - path.stat().st_mtime > _INVENTORY_REFRESH_LOCK_AGE:
+                path.unlink(missing_ok=True)
+        except OSError:
+            pass
+        try:
+            os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except OSError:
+            return False
+        return True
+
+    def _read(self, spec: str) -> dict | None:
+        import json
+
+        try:
+            entry = json.loads(self.entry_path(spec).read_text())
+        except (OSError, ValueError):
+            return None
+        if not isinstance(entry, dict) or entry.get("spec") != spec:
+            return None
+        return entry
+
+    def _write(self, spec: str, hosts: list[HostDefinition]) -> None:
+        import json
+
+        # Best effort, as for InventoryCache
+        try:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            with os.fdopen(fd, "w") as f:
+                json.dump(
+                    {
+                        "spec": spec,
+                        "fetched_at": time.time(),
+                        "hosts": [_host_fields(h) for h in hosts],
+                    },
+                    f,
+                )
+            os.replace(tmp, self.entry_path(spec))
+        except OSError:
+            pass
+
+
+# ---------------------------------------------------------------------------
+# SSH Command Construction
+# ---------------------------------------------------------------------------
+
+
+def _connection_key(host: HostDefinition) -> str:
+    """Identify a connection target: user@hostname:port, plus its bastion if any."""
+    key = f"{host.user or ''}@{host.hostname}:{host.port}"
+    if host.via is not None:
+        key += f" via {_connection_key(host.via)}"
+    return key
+
+
+def build_ssh_args(
+    host: HostDefinition,
+    connection_timeout: float,
+    control_path: str | None = None,
+    master: bool = False,
+    forward_agent: bool = False,
+    bastion_control_path: str | None = None,
+) -> list[str]:
+    """Build the ssh command arguments list.
+
+    Constructs the full argument list for invoking the system ssh binary,
+    including connection options, port, identity file, and user@host target.
+
+    Args:
+        host: The host definition containing connection parameters.
+        connection_timeout: SSH connection timeout in seconds (converted to int).
+        control_path: Optional ControlMaster socket path. When set, the
+            connection is multiplexed over an existing master (if any).
+        master: If True (and control_path is set), this invocation becomes
+            the persistent master for control_path.
+        forward_agent: If True, forward the local ssh-agent to the host (used
+            when the host itself connects onward, e.g. relay distribution).
+        bastion_control_path: Optional ControlMaster socket of the host's
+            bastion. Hosts with `via` set connect through a ProxyCommand that
+            runs `ssh -W` on the bastion, multiplexed over this master.
+
+    Returns:
+        A list of strings suitable for subprocess invocation, e.g.:
+        ['ssh', '-o', 'ConnectTimeout=10', '-o', 'BatchMode=yes', '-p', '2222',
+         '-i', '/path/key', 'user@host']
+    """
+    args: list[str] = ["ssh"]
+
+    # Always include ConnectTimeout (convert float to int)
+    args.extend(["-o", f"ConnectTimeout={int(connection_timeout)}"])
+
+    # Always include BatchMode=yes for non-interactive behavior
+    args.extend(["-o", "BatchMode=yes"])
+
+    # Accept new host keys automatically (reject changed ones)
+    args.extend(["-o", "StrictHostKeyChecking=accept-new"])
+
+    if forward_agent:
+        args.extend(["-o", "ForwardAgent=yes"])
+
+    # Connection multiplexing over a ControlMaster socket
+    if control_path:
+        if master:
+            args.extend(["-o", "ControlMaster=yes"])
+            args.extend(["-o", f"ControlPersist={_CONTROL_PERSIST_SECONDS}"])
+        else:
+            # Fall back to a direct connection if the master is gone
+            args.extend(["-o", "ControlMaster=no"])
+        args.extend(["-o", f"ControlPath={control_path}"])
+
+    # Tunnel through the bastion; ssh expands %-tokens in ProxyCommand
+    if host.via is not None:
+        proxy = build_ssh_args(
+            host.via, connection_timeout, control_path=bastion_control_path
+        )
+        proxy = [arg.replace("%", "%%") for arg in proxy]
+        proxy[1:1] = ["-W", "%h:%p"]
+        args.extend(["-o", f"ProxyCommand={shlex.join(proxy)}"])
+
+    # Include port only if not the default
+    if host.port != 22:
+        args.extend(["-p", str(host.port)])
+
+    # Include identity file if specified
+    if host.identity_file:
+        args.extend(["-i", host.identity_file])
+
+    # Build the target: user@hostname if user is set, otherwise just hostname
+    if host.user:
+        args.append(f"{host.user}@{host.hostname}")
+    else:
+        args.append(host.hostname)
+
+    return args
+
+
+def build_remote_command(command: str, working_dir: str | None = None) -> str:
+    """Wrap command with cd prefix if working_dir is set.
+
+    Args:
+        command: The command string to execute on the remote host.
+        working_dir: Optional working directory to cd into before executing.
+
+    Returns:
+        'cd /some/dir && command' when working_dir is set, or just 'command'.
+    """
+    if working_dir:
+        return f"cd {working_dir} && {command}"
+    return command
+
+
+# ---------------------------------------------------------------------------
+# Process Registry
+# ---------------------------------------------------------------------------
+
+# Seconds spawned ssh processes get to exit after SIGTERM before SIGKILL
+_TERMINATE_GRACE = 2.0
+# Seconds to wait for killed processes to be reaped
+_KILL_WAIT = 1.0
+
+
+class ProcessRegistry:
+    """Every live child process, so an interrupt can stop them all at once.
+
+    Processes are added when spawned and dropped once they have exited. A
+    process whose task is cancelled stays registered, so whoever cancelled
+    it can terminate it with `terminate_all`.
+    """
+
+    def __init__(self) -> None:
+        self._processes: set = set()
+
+    def __len__(self) -> int:
+        return len(self._processes)
+
+    def add(self, process) -> None:
+        """Track a newly spawned process."""
+        self._processes.add(process)
+
+    def release(self, process) -> None:
+        """Stop tracking process if it has exited."""
+        if process.returncode is not None:
+            self._processes.discard(process)
+
+    def signal_all(self, signum: int) -> int:
+        """Send signum to every process still running; return how many were signalled."""
+        count = 0
+        for process in list(self._processes):
+            if process.returncode is None:
+                try:
+                    process.send_signal(signum)
+                    count += 1
+                except ProcessLookupError:
+                    pass
+        return count
+
+    async def terminate_all(self, grace: float = _TERMINATE_GRACE) -> int:
+        """Stop every running process and reap it; return how many there were.
+
+        All processes get SIGTERM at once, those still alive after grace
+        seconds get SIGKILL, so this takes at most grace + _KILL_WAIT seconds
+        whatever the number of processes.
+        """
+        running = [p for p in self._processes if p.returncode is None]
+        self._processes.clear()
+        if not running:
+            return 0
+        for process in running:
+            try:
+                process.terminate()
+            except ProcessLookupError:
+                pass
+        waits = {asyncio.ensure_future(p.wait()): p for p in running}
+        _, pending = await asyncio.wait(waits, timeout=grace)
+        if pending:
+            for task in pending:
+                try:
+                    waits[task].kill()
+                except ProcessLookupError:
+                    pass
+            _, pending = await asyncio.wait(pending, timeout=_KILL_WAIT)
+            for task in pending:
+                task.cancel()
+        return len(running)
+
+
+# Processes spawned by the ssh engine (commands and control masters)
+_process_registry = ProcessRegistry()
+
+
+# ---------------------------------------------------------------------------
+# SSH Execution
+# ---------------------------------------------------------------------------
+
+# Default number of hosts executed concurrently (--forks)
+_DEFAULT_FORKS = 64
+
+
+@dataclass
+class ExecutionStats:
+    """Throughput summary for a fan-out run."""
+
+    hosts: int = 0  # number of hosts executed
+    elapsed: float = 0.0  # wall-clock seconds for the whole run
+    forks: int = 0  # worker limit in effect
+
+    @property
+    def throughput(self) -> float:
+        """Achieved throughput in hosts per second."""
+        return self.hosts / self.elapsed if self.elapsed > 0 else 0.0
+
+
+@dataclass
+class BatchPolicy:
+    """Rolling execution plan: run hosts in waves and stop on too many failures.
+
+    Hosts are split into batches of `size` hosts (or `percent` of the total),
+    optionally preceded by a batch of `canary` hosts. A failure in the canary
+    batch, or more failures overall than `max_failures` / `max_fail_percent`
+    of all hosts allow, trips the breaker: hosts that have not started yet are
+    skipped instead of executed.
+    """
+
+    size: int | None = None  # hosts per batch
+    percent: float | None = None  # hosts per batch as a percentage of the total
+    pause: float = 0.0  # seconds to wait between batches
+    canary: int = 0  # hosts to run alone before the first batch
+    max_failures: int | None = None  # failures tolerated before aborting
+    max_fail_percent: float | None = None  # same, as a percentage of all hosts
+
+    def batches(self, hosts: list) -> list[list]:
+        """Split hosts into consecutive batches (canary batch first)."""
+        canary = hosts[: self.canary]
+        rest = hosts[self.canary :]
+        if self.size is not None:
+            size = self.size
+        elif self.percent is not None:
+            size = math.ceil(len(hosts) * self.percent / 100)
+        else:
+            size = len(rest)
+        size = max(1, size)
+        batches = [canary] if canary else []
+        batches.extend(rest[i : i + size] for i in range(0, len(rest), size))
+        return batches
+
+    def failure_limit(self, total: int) -> int | None:
+        """Largest number of failures tolerated across `total` hosts."""
+        limits = []
+        if self.max_failures is not None:
+            limits.append(self.max_failures)
+        if self.max_fail_percent is not None:
+            limits.append(int(total * self.max_fail_percent / 100))
+        return min(limits) if limits else None
+
+
+def parse_batch_size(value: str) -> tuple[int | None, float | None]:
+    """Parse a --batch-size value: a host count ("10") or a percentage ("25%").
+
+    Returns:
+        A (size, percent) tuple with exactly one element set.
+
+    Raises:
+        ValidationError: If the value is not a positive count or a percentage in (0, 100].
+    """
+    try:
+        if value.endswith("%"):
+            percent = float(value[:-1])
+            if 0 < percent <= 100:
+                return None, percent
+        else:
+            size = int(value)
+            if size >= 1:
+                return size, None
+    except ValueError:
+        pass
+    raise ValidationError(
+        f"invalid --batch-size value '{value}': must be a positive count or a percentage like 25%"
+    )
+
+
+# Lowercased ssh/socket error fragments and the failure they identify, in match order
+_FAILURE_PATTERNS = (
+    ("connection refused", "refused"),
+    ("connect call failed", "refused"),
+    ("connection timed out", "connect_timeout"),
+    ("operation timed out", "connect_timeout"),
+    ("no route to host", "unreachable"),
+    ("network is unreachable", "unreachable"),
+    ("kex_exchange_identification", "reset"),
+    ("could not resolve hostname", "resolve"),
+    ("name or service not known", "resolve"),
+    ("permission denied", "auth"),
+    ("host key verification failed", "auth"),
+    ("too many authentication failures", "auth"),
+)
+# Failures that happen before the remote command starts and may not recur
+_TRANSIENT_FAILURES = frozenset({"refused", "connect_timeout", "unreachable", "reset"})
+# How ssh's own connection errors start (lowercased); a remote command's
+# "connection refused" is not one
+_SSH_DIAGNOSTIC_PREFIXES = (
+    "ssh: ",
+    "kex_exchange_identification: ",
+    "ssh_exchange_identification: ",
+    "connection closed by ",
+    "connection reset by ",
+)
+
+
+def _command_started(result: CommandResult) -> bool:
+    """Whether the remote command is known to have started.
+
+    That is, it produced output, or the transport saw the connection
+    established (asyncssh always; forked ssh only when traced).
+    """
+    return bool(result.stdout) or result.timing.connected is not None
+
+
+def classify_failure(result: CommandResult) -> str | None:
+    """Classify why a host failed, or return None if it succeeded.
+
+    Returns one of "skipped", "timeout" (the command timed out), a connection
+    failure ("refused", "connect_timeout", "unreachable", "reset", "resolve",
+    "auth"), "error" (any other local or transport error) or "command" (the
+    remote command exited non-zero).
+    """
+    if result.skipped:
+        return "skipped"
+    if result.timed_out:
+        return "timeout"
+    if result.error is None and result.exit_code == 0:
+        return None
+    if result.error is not None:
+        text = result.error.lower()
+        from_ssh = True
+    # ssh exits 255 for its own errors and prints them as its last line; once
+    # the remote command has started, stderr is the command's own
+    elif result.exit_code == 255 and not _command_started(result):
+        text = result.stderr.rstrip().rpartition("\n")[2].lower()
+        from_ssh = text.startswith(_SSH_DIAGNOSTIC_PREFIXES)
+    else:
+        return "command"
+    for fragment, kind in _FAILURE_PATTERNS:
+        # Connection failures are only taken from ssh's own diagnostics
+        if fragment in text and (from_ssh or kind not in _TRANSIENT_FAILURES):
+            return kind
+    return "command" if result.error is None else "error"
+
+
+@dataclass
+class RetryPolicy:
+    """Retrying hosts whose connection failed transiently (--retries).
+
+    Only failures in `_TRANSIENT_FAILURES` reported by ssh itself are
+    retried, and never once the remote command is known to have started (see
+    `_command_started`).
+    Retries run as waves after the main run at the same concurrency, waiting
+    a doubling delay (capped at max_delay, with jitter) before each wave.
+    """
+
+    attempts: int  # retries after the first try
+    base_delay: float = 1.0
+    max_delay: float = 30.0
+    jitter: float = 0.2  # +/- fraction of each delay
+
+    def retryable(self, result: CommandResult) -> bool:
+        """Whether result is a transient connection failure of a command that never started."""
+        return (
+            not _command_started(result)
+            and classify_failure(result) in _TRANSIENT_FAILURES
+        )
+
+    def delay(self, attempt: int) -> float:
+        """Seconds to wait before retry wave number attempt (1-based)."""
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        return delay * (1 + random.uniform(-self.jitter, self.jitter))
+
+
+async def _bounded_map(func, items: list, limit: int) -> list:
+    """Apply an async function to every item with at most `limit` in flight.
+
+    A fixed set of workers pulls from a shared iterator, so items are only
+    picked up when a worker becomes free and each worker is reused for many
+    items. Results are returned in the same order as items.
+    """
+    results: list = [None] * len(items)
+    pending = iter(enumerate(items))
+
+    async def worker() -> None:
+        for index, item in pending:
+            results[index] = await func(item)
+
+    workers = max(1, min(limit, len(items)))
+    await asyncio.gather(*(worker() for _ in range(workers)))
+    return results
+
+
+async def _bastion_map(
+    func, hosts: list[HostDefinition], limit: int, per_bastion: int
+) -> list:
+    """`_bounded_map` over hosts that also bounds the hosts in flight per bastion.
+
+    Each bastion's hosts are drained by their own at most per_bastion
+    workers, which take a slot of the overall limit only while running, so a
+    saturated bastion never holds slots that hosts elsewhere could use.
+    """
+    slots = asyncio.Semaphore(limit)
+    queues: dict[str, list[int]] = {}  # bastion ("" for direct hosts) -> host indexes
+    for index, host in enumerate(hosts):
+        key = _connection_key(host.via) if host.via is not None else ""
+        queues.setdefault(key, []).append(index)
+    results: list = [None] * len(hosts)
+
+    async def run(index: int) -> None:
+        async with slots:
+            results[index] = await func(hosts[index])
+
+    await asyncio.gather(
+        *(
+            _bounded_map(run, indexes, per_bastion if key else limit)
+            for key, indexes in queues.items()
+        )
+    )
+    return results
+
+
+# Read size used when streaming remote output
+_READ_CHUNK_SIZE = 64 * 1024
+
+# Callback receiving (host, line, is_stderr) for live line streaming
+LineCallback = Callable[[HostDefinition, str, bool], None]
+
+
+# Bytes of each stream kept in memory when output is spilled to files
+_SPILL_RETAIN_BYTES = 64 * 1024
+
+
+class OutputCapture:
+    """Accumulates one output stream with an optional memory cap and spill file.
+
+    With a limit, only the first and last limit/2 bytes are kept in memory
+    and the middle is replaced by an omission marker. With a path, every
+    byte is also written to that file as it arrives.
+    """
+
+    def __init__(self, limit: int | None = None, path: Path | None = None) -> None:
+        self.limit = limit
+        self.path = path
+        self.total = 0  # bytes received
+        self._head = bytearray()
+        self._tail = bytearray()
+        self._file = path.open("wb") if path is not None else None
+
+    def write(self, chunk: bytes) -> None:
+        """Add a chunk of output."""
+        self.total += len(chunk)
+        if self._file is not None:
+            self._file.write(chunk)
+        if self.limit is None:
+            self._head += chunk
+            return
+        room = self.limit - self.limit // 2 - len(self._head)
+        if room > 0:
+            self._head += chunk[:room]
+            chunk = chunk[room:]
+        if chunk:
+            self._tail += chunk
+            excess = len(self._tail) - self.limit // 2
+            if excess > 0:
+                del self._tail[:excess]
+
+    def close(self) -> None:
+        """Flush and close the spill file, if any."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    @property
+    def omitted(self) -> int:
+        """Bytes received but not kept in memory."""
+        return self.total - len(self._head) - len(self._tail)
+
+    def getvalue(self) -> bytes:
+        """The retained output, with a marker where bytes were omitted."""
+        if not self.omitted:
+            return bytes(self._head + self._tail)
+        marker = f"\n[... {self.omitted} bytes omitted ...]\n".encode()
+        return bytes(self._head) + marker + bytes(self._tail)
+
+
+_SIZE_SUFFIXES = {"": 1, "K": 1024, "M": 1024**2, "G": 1024**3}
+
+
+def parse_size(value: str) -> int:
+    """Parse a byte count with an optional K/M/G suffix (e.g. "512K", "10M").
+
+    Raises:
+        ValidationError: If the value is not a positive size.
+    """
+    match = re.fullmatch(r"(\d+)([KMG]?)B?", value.strip().upper())
+    if match is None or int(match.group(1)) == 0:
+        raise ValidationError(
+            f"invalid size '{value}': expected a positive number of bytes like 512K or 10M"
+        )
+    return int(match.group(1)) * _SIZE_SUFFIXES[match.group(2)]
+
+
+@dataclass
+class CaptureLimits:
+    """Per-host output capture settings (--max-output, --output-dir)."""
+
+    max_bytes: int | None = None  # bytes kept in memory per stream
+    output_dir: Path | None = None  # write full output to <dir>/<host>.stdout/.stderr
+
+    def open(self, host: HostDefinition) -> tuple[OutputCapture, OutputCapture]:
+        """Create the stdout and stderr captures for host."""
+        if self.output_dir is None:
+            return OutputCapture(self.max_bytes), OutputCapture(self.max_bytes)
+        # The files hold the full output, so memory only needs a preview
+        limit = self.max_bytes if self.max_bytes is not None else _SPILL_RETAIN_BYTES
+        stem = re.sub(r"[^\w.@-]", "_", host.name)
+        return (
+            OutputCapture(limit, self.output_dir / f"{stem}.stdout"),
+            OutputCapture(limit, self.output_dir / f"{stem}.stderr"),
+        )
+
+
+# Printed to stderr by the remote side first thing when timing is traced
+# (--stats, --trace-file); its arrival marks the moment the connection was
+# established. It needs a POSIX login shell on the host.
+_CONNECT_MARKER = b"\x1essh-tool-connected\x1e"
+_CONNECT_MARKER_CMD = r"printf '\036ssh-tool-connected\036\n' >&2"
+
+
+class _ConnectMarkerStream:
+    """Wraps a stderr reader, removing the connect marker and timestamping it.
+
+    Output is held back until the marker line is seen (or the stream ends),
+    so the marker never reaches captures or line callbacks.
+    """
+
+    def __init__(self, stream, timing: HostTiming) -> None:
+        self._stream = stream
+        self._timing = timing
+        self._pending: bytearray | None = bytearray()
+
+    async def read(self, n: int = -1) -> bytes:
+        while self._pending is not None:
+            chunk = await self._stream.read(n)
+            if not chunk:
+                data, self._pending = bytes(self._pending), None
+                return data
+            self._pending += chunk
+            index = self._pending.find(_CONNECT_MARKER + b"\n")
+            if index >= 0:
+                self._timing.connected = time.time()
+                data = bytes(
+                    self._pending[:index]
+                    + self._pending[index + len(_CONNECT_MARKER) + 1 :]
+                )
+                self._pending = None
+                if data:
+                    return data
+        return await self._stream.read(n)
+
+
+async def _stream_lines(
+    stream: asyncio.StreamReader,
+    capture: OutputCapture,
+    emit: Callable[[str], None] | None = None,
+    timing: HostTiming | None = None,
+) -> None:
+    """Read a stream to EOF into capture, emitting each complete line as soon as it arrives.
+
+    When timing is given, the arrival of the first byte is recorded on it.
+    """
+    partial = b""
+    while chunk := await stream.read(_READ_CHUNK_SIZE):
+        if timing is not None and timing.first_byte is None:
+            timing.first_byte = time.time()
+        capture.write(chunk)
+        if emit is None:
+            continue
+        # Lines break as in the collected output (see PlainWriter.write_lines)
+        lines, partial = _split_lines(partial + chunk, final=False)
+        for line in lines:
+            emit(line.decode(errors="replace"))
+    if partial and emit is not None:
+        lines, partial = _split_lines(partial)
+        for line in [*lines, partial] if partial else lines:
+            emit(line.decode(errors="replace"))
+
+
+async def _collect_output(
+    process,
+    host: HostDefinition,
+    on_line: LineCallback | None = None,
+    capture: CaptureLimits | None = None,
+    timing: HostTiming | None = None,
+    connect_marker: bool = False,
+) -> CommandResult:
+    """Read a process's output to EOF and build its CommandResult.
+
+    Without on_line, capture limits or timing this is a plain `communicate()`.
+    Otherwise both streams are read in chunks, reporting lines to on_line,
+    retaining output as configured by capture and recording the first byte
+    (and, with connect_marker, the connect marker on stderr) on timing.
+    """
+    if on_line is None and capture is None and timing is None:
+        stdout_bytes, stderr_bytes = await process.communicate()
+        return CommandResult(
+            host=host,
+            stdout=(stdout_bytes or b"").decode(errors="replace"),
+            stderr=(stderr_bytes or b"").decode(errors="replace"),
+            exit_code=process.returncode if process.returncode is not None else 1,
+        )
+
+    stdout, stderr = (capture or CaptureLimits()).open(host)
+    stderr_stream = process.stderr
+    if connect_marker and timing is not None:
+        stderr_stream = _ConnectMarkerStream(stderr_stream, timing)
+    try:
+        await asyncio.gather(
+            _stream_lines(
+                process.stdout,
+                stdout,
+                on_line and (lambda line: on_line(host, line, False)),
+                timing,
+            ),
+            _stream_lines(
+                stderr_stream,
+                stderr,
+                on_line and (lambda line: on_line(host, line, True)),
+                timing,
+            ),
+        )
+        await process.wait()
+    finally:
+        stdout.close()
+        stderr.close()
+    return CommandResult(
+        host=host,
+        stdout=stdout.getvalue().decode(errors="replace"),
+        stderr=stderr.getvalue().decode(errors="replace"),
+        exit_code=process.returncode if process.returncode is not None else 1,
+        stdout_file=stdout.path,
+        stderr_file=stderr.path,
+    )
+
+
+class InputSource:
+    """Data written to the stdin of every host's remote command."""
+
+    def open(self) -> InputSource:
+        """Return the view of this input fed to one host (closed when it finishes)."""
+        return self
+
+    async def feed(self, writer) -> None:
+        """Write the whole input to writer (awaiting drain for backpressure)."""
+        raise NotImplementedError
+
+    def close(self) -> None:
+        """Release a view returned by `open` once its host has finished."""
+
+    async def aclose(self) -> None:
+        """Release resources held for the whole run."""
+
+
+class FileInput(InputSource):
+    """Streams a local file to each host, reading it from disk per host."""
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+
+    async def feed(self, writer) -> None:
+        with self.path.open("rb") as f:
+            while chunk := f.read(_READ_CHUNK_SIZE):
+                writer.write(chunk)
+                await writer.drain()
+
+
+# Chunks of broadcast input held in memory ahead of the slowest host
+_BROADCAST_WINDOW = 64
+
+
+class BroadcastInput(InputSource):
+    """Local input (typically stdin) read once and fanned out to every host.
+
+    Chunks are shared by all hosts rather than copied per host. Reading pauses
+    while the slowest open host lags `window` chunks behind, so memory stays
+    bounded whatever the input size, and a host that stops reading holds the
+    others back instead of growing the buffer.
+
+    Hosts that start after data has left memory (more hosts than --forks or
+    --bastion-forks allow at once, rolling batches, retries) can only be
+    served with spool=True: every chunk is then also appended to an anonymous
+    temporary file and replayed from there. Without it, `open` raises
+    RuntimeError for such a host.
+
+    The stream is read on a daemon thread, so a pipe that stays open but
+    idle never keeps the process from exiting once every host has finished.
+    """
+
+    def __init__(
+        self, stream, spool: bool = False, window: int = _BROADCAST_WINDOW
+    ) -> None:
+        self._stream = stream
+        self._window = window
+        # Closed by aclose
+        self._spool = tempfile.TemporaryFile(buffering=0) if spool else None  # noqa: SIM115
+        self._spool_index: list[tuple[int, int]] = []  # chunk -> (offset, length)
+        self._spool_size = 0
+        self._chunks: dict[int, bytes] = {}  # chunks still held in memory
+        self._released = 0  # chunks below this index have left memory
+        self._count = 0  # chunks read so far
+        self._eof = False
+        self._readers: set[_BroadcastReader] = set()
+        self._changed = asyncio.Event()
+        self._pump_task: asyncio.Task | None = None
+        self._requests: queue.SimpleQueue | None = None  # futures for the reader thread
+
+    def open(self) -> _BroadcastReader:
+        if self._released and self._spool is None:
+            raise RuntimeError("broadcast input already released; enable spooling")
+        reader = _BroadcastReader(self)
+        self._readers.add(reader)
+        if self._pump_task is None:
+            self._pump_task = asyncio.ensure_future(self._pump())
+        return reader
+
+    async def aclose(self) -> None:
+        try:
+            if self._pump_task is not None:
+                self._pump_task.cancel()
+                try:
+                    await self._pump_task
+                except asyncio.CancelledError:
+                    pass
+                self._pump_task = None
+        finally:
+            if self._requests is not None:
+                self._requests.put(None)  # an idle reader thread exits
+                self._requests = None
+            if self._spool is not None:
+                self._spool.close()
+
+    def _read(self) -> asyncio.Future:
+        """Read the next chunk on the reader thread, started on first use."""
+        loop = asyncio.get_running_loop()
+        if self._requests is None:
+            self._requests = queue.SimpleQueue()
+            threading.Thread(
+                target=self._reader,
+                args=(loop, self._requests),
+                name="ssh-tool-stdin",
+                daemon=True,
+            ).start()
+        future = loop.create_future()
+        self._requests.put(future)
+        return future
+
+    def _reader(
+        self, loop: asyncio.AbstractEventLoop, requests: queue.SimpleQueue
+    ) -> None:
+        try:
+            # Unbuffered: a daemon thread blocked inside a buffered object's
+            # lock aborts interpreter shutdown
+            read = partial(os.read, self._stream.fileno())
+        except (AttributeError, OSError, ValueError):
+            # read1 returns whatever is buffered instead of waiting for a full chunk
+            read = (
+                self._stream.read1
+                if hasattr(self._stream, "read1")
+                else self._stream.read
+            )
+
+        def settle(
+            future: asyncio.Future, chunk: bytes | None, error: BaseException | None
+        ) -> None:
+            if future.done():
+                return  # the pump was cancelled
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(chunk)
+
+        while (future := requests.get()) is not None:
+            chunk, error = None, None
+            try:
+                chunk = read(_READ_CHUNK_SIZE)
+            except Exception as e:  # noqa: BLE001 - re-raised by the awaiting pump
+                error = e
+            try:
+                loop.call_soon_threadsafe(settle, future, chunk, error)
+            except RuntimeError:
+                return  # the loop has closed
+
+    def _notify(self) -> None:
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def _low_water(self) -> int:
+        """Index of the oldest chunk an open host still needs."""
+        if self._readers:
+            return min(reader.position for reader in self._readers)
+        return self._count if self._spool is not None else self._released
+
+    def _release(self) -> None:
+        low = self._low_water()
+        while self._released < low:
+            self._chunks.pop(self._released, None)
+            self._released += 1
+        self._notify()
+
+    async def _pump(self) -> None:
+        try:
+            while True:
+                while self._count - self._low_water() >= self._window:
+                    await self._changed.wait()
+                chunk = await self._read()
+                if not chunk:
+                    return
+                if self._spool is not None:
+                    self._spool.write(chunk)
+                    self._spool_index.append((self._spool_size, len(chunk)))
+                    self._spool_size += len(chunk)
+                self._chunks[self._count] = chunk
+                self._count += 1
+                self._release()
+        finally:
+            # Also on a read error (re-raised by aclose), so no host waits forever
+            self._eof = True
+            self._notify()
+
+    def _chunk(self, index: int) -> bytes:
+        chunk = self._chunks.get(index)
+        if chunk is None:
+            offset, length = self._spool_index[index]
+            chunk = os.pread(self._spool.fileno(), length, offset)
+        return chunk
+
+
+class _BroadcastReader(InputSource):
+    """One host's position in a BroadcastInput."""
+
+    def __init__(self, source: BroadcastInput) -> None:
+        self.source = source
+        self.position = 0
+
+    async def feed(self, writer) -> None:
+        source = self.source
+        while True:
+            while self.position >= source._count and not source._eof:
+                await source._changed.wait()
+            if self.position >= source._count:
+                return
+            writer.write(source._chunk(self.position))
+            await writer.drain()
+            self.position += 1
+            source._release()
+
+    def close(self) -> None:
+        self.source._readers.discard(self)
+        self.source._release()
+
+
+async def _feed_input(writer, source: InputSource | None) -> None:
+    """Feed source to a process's stdin and close it.
+
+    A remote command that exits without reading all of its input is not an
+    error; its exit status is reported as usual.
+    """
+    try:
+        if source is not None:
+            await source.feed(writer)
+        writer.write_eof()
+    except (BrokenPipeError, ConnectionResetError):
+        pass
+    except OSError as e:
+        if "closed" not in str(e).lower():
+            raise
+
+
+async def _with_input(collect, writer, source: InputSource | None) -> CommandResult:
+    """Run an output collector while feeding source to the process's stdin.
+
+    The result is ready as soon as the collector finishes: a feeder still
+    waiting for input the process never read is cancelled.
+    """
+    feeder = asyncio.ensure_future(_feed_input(writer, source))
+    try:
+        result = await collect
+    finally:
+        if not feeder.done():
+            feeder.cancel()
+    try:
+        await feeder
+    except asyncio.CancelledError:
+        pass
+    return result
+
+
+async def run_command_on_host(
+    host: HostDefinition,
+    command: str,
+    working_dir: str | None = None,
+    timeout: float = 30.0,
+    connection_timeout: float = 10.0,
+    control_path: str | None = None,
+    on_line: LineCallback | None = None,
+    transport: Transport | None = None,
+    capture: CaptureLimits | None = None,
+    trace: bool = False,
+    stdin: InputSource | None = None,
+) -> CommandResult:
+    """Execute a command on a single host.
+
+    Builds the remote command using `build_remote_command` and runs it through
+    the given transport, or via an ssh subprocess (`build_ssh_args`) when no
+    transport is given. Handles timeouts and connection failures gracefully.
+
+    Args:
+        host: The host definition containing connection parameters.
+        command: The command string to execute on the remote host.
+        working_dir: Optional working directory to cd into before executing.
+        timeout: Maximum time in seconds to wait for command completion.
+        connection_timeout: SSH connection timeout in seconds.
+        control_path: Optional ControlMaster socket to multiplex over.
+        on_line: Optional callback invoked for every output line as it arrives.
+        transport: Optional Transport to execute through instead of forking ssh.
+        capture: Optional CaptureLimits bounding the output kept in memory.
+        trace: If True, record every phase (spawn, connect, first byte) in
+            the result's timing; otherwise only start and finish are recorded.
+        stdin: Optional InputSource fed to the remote command's stdin.
+
+    Returns:
+        A CommandResult with stdout, stderr, exit_code, and error/timeout info.
+    """
+    remote_cmd = build_remote_command(command, working_dir)
+    started = time.time()
+    timing = HostTiming(started=started) if trace else None
+    try:
+        source = stdin.open() if stdin is not None else None
+    except RuntimeError as e:
+        # The input has already left memory; only this host fails
+        return CommandResult(host=host, stdout="", stderr="", exit_code=1, error=str(e))
+    try:
+        if transport is not None:
+            result = await transport.run(
+                host,
+                remote_cmd,
+                timeout,
+                connection_timeout,
+                on_line,
+                capture=capture,
+                timing=timing,
+                stdin=source,
+            )
+        else:
+            result = await _run_ssh_subprocess(
+                host,
+                remote_cmd,
+                timeout,
+                connection_timeout,
+                control_path,
+                on_line,
+                capture,
+                timing,
+                source,
+            )
+    finally:
+        if source is not None:
+            source.close()
+    if timing is not None:
+        result.timing = timing
+    result.timing.started = started
+    result.timing.finished = time.time()
+    return result
+
+
+async def _run_ssh_subprocess(
+    host: HostDefinition,
+    remote_cmd: str,
+    timeout: float,
+    connection_timeout: float,
+    control_path: str | None = None,
+    on_line: LineCallback | None = None,
+    capture: CaptureLimits | None = None,
+    timing: HostTiming | None = None,
+    stdin: InputSource | None = None,
+    forward_agent: bool = False,
+    bastion_control_path: str | None = None,
+) -> CommandResult:
+    """Run a remote command by forking the system ssh binary.
+
+    With timing, the remote side first prints a marker to stderr so that the
+    moment the connection was established can be observed locally.
+    """
+    ssh_args = build_ssh_args(
+        host,
+        connection_timeout,
+        control_path=control_path,
+        forward_agent=forward_agent,
+        bastion_control_path=bastion_control_path,
+    )
+    if timing is not None:
+        remote_cmd = f"{_CONNECT_MARKER_CMD}; {remote_cmd}"
+
+    try:
+        process = await asyncio.create_subprocess_exec(
+            *ssh_args,
+            remote_cmd,
+            stdin=asyncio.subprocess.PIPE if stdin is not None else None,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+    except OSError as e:
+        return CommandResult(
+            host=host,
+            stdout="",
+            stderr="",
+            exit_code=1,
+            error=str(e),
+        )
+    _process_registry.add(process)
+    if timing is not None:
+        timing.spawned = time.time()
+
+    collect = _collect_output(
+        process, host, on_line, capture, timing, connect_marker=True
+    )
+    if stdin is not None:
+        collect = _with_input(collect, process.stdin, stdin)
+
+    try:
+        return await asyncio.wait_for(collect, timeout=timeout)
+    except asyncio.TimeoutError:
+        # Kill the process on timeout
+        try:
+            process.kill()
+        except ProcessLookupError:
+            pass
+        # Wait for the process to be reaped
+        await process.wait()
+        return CommandResult(
+            host=host,
+            stdout="",
+            stderr="",
+            exit_code=1,
+            timed_out=True,
+        )
+    finally:
+        _process_registry.release(process)
+
+
+async def run_command_on_all(
+    hosts: list[HostDefinition],
+    command: str,
+    working_dirs: dict[str, str] | None = None,
+    timeout: float = 30.0,
+    connection_timeout: float = 10.0,
+    sequential: bool = False,
+    pool: ConnectionPool | None = None,
+    forks: int = _DEFAULT_FORKS,
+    stats: ExecutionStats | None = None,
+    on_result: Callable[[CommandResult], None] | None = None,
+    on_line: LineCallback | None = None,
+    transport: Transport | None = None,
+    batch: BatchPolicy | None = None,
+    capture: CaptureLimits | None = None,
+    trace: bool = False,
+    priority: Callable[[HostDefinition], float] | None = None,
+    timeouts: dict[str, float] | None = None,
+    stdin: InputSource | None = None,
+    retry: RetryPolicy | None = None,
+    bastion_forks: int | None = None,
+) -> list[CommandResult]:
+    """Execute a command on all hosts with bounded concurrency.
+
+    At most `forks` ssh processes run at once; a new host is started as soon
+    as a running one finishes. With a BatchPolicy, hosts run in consecutive
+    batches and the remaining hosts are skipped once the policy's failure
+    threshold is exceeded.
+
+    Args:
+        hosts: List of host definitions to execute the command on.
+        command: The command string to execute on each remote host.
+        working_dirs: Optional mapping of host names to their working directory.
+        timeout: Maximum time in seconds to wait for each command.
+        connection_timeout: SSH connection timeout in seconds.
+        sequential: If True, execute on hosts one at a time (same as forks=1).
+        pool: Optional ConnectionPool whose masters the commands are multiplexed over.
+        forks: Maximum number of hosts executed concurrently.
+        stats: Optional ExecutionStats to fill in with throughput figures.
+        on_result: Optional callback invoked with each host's result as soon as
+            that host completes (completion order, not host order).
+        on_line: Optional callback invoked for every output line as it arrives.
+        transport: Optional Transport to execute through instead of forking ssh.
+        batch: Optional BatchPolicy for rolling execution with a failure cut-off.
+        capture: Optional CaptureLimits bounding the output kept per host.
+        trace: If True, record per-phase timestamps for every host.
+        priority: Optional function giving each host's expected duration.
+            Hosts (within each batch) are started longest first, so stragglers
+            don't start last and set the total wall time.
+        timeouts: Optional per-host command timeouts by host name, overriding
+            `timeout` for those hosts.
+        stdin: Optional InputSource fed to every host's remote command.
+        retry: Optional RetryPolicy. Hosts that failed transiently are rerun
+            (within each batch) before being reported or counted as failures.
+        bastion_forks: Optional maximum number of hosts executed concurrently
+            behind each bastion (hosts with `via` set), within `forks`.
+
+    Returns:
+        A list of CommandResult objects, one per host, in the same order as hosts.
+        Hosts skipped by the batch policy have `skipped` set.
+    """
+    limit = 1 if sequential else forks
+    limit_failures = batch.failure_limit(len(hosts)) if batch else None
+    failures = 0
+    tripped = False
+
+    async def run_one(host: HostDefinition, final: bool = True) -> CommandResult:
+        nonlocal failures, tripped
+        if tripped:
+            result = CommandResult(
+                host=host, stdout="", stderr="", exit_code=1, skipped=True
+            )
+            if on_result is not None:
+                on_result(result)
+            return result
+        result = await run_command_on_host(
+            host,
+            command,
+            working_dirs.get(host.name) if working_dirs else None,
+            timeouts.get(host.name, timeout) if timeouts else timeout,
+            connection_timeout,
+            control_path=pool.control_path(host) if pool else None,
+            on_line=on_line,
+            transport=transport,
+            capture=capture,
+            trace=trace,
+            stdin=stdin,
+        )
+        if not final and retry.retryable(result):
+            return result  # retried later, reported then
+        if result.exit_code != 0:
+            failures += 1
+            if limit_failures is not None and failures > limit_failures:
+                tripped = True
+        if on_result is not None:
+            on_result(result)
+        return result
+
+    async def run_all(run, wave: list[HostDefinition]) -> list[CommandResult]:
+        if bastion_forks is not None and any(host.via is not None for host in wave):
+            return await _bastion_map(run, wave, limit, bastion_forks)
+        return await _bounded_map(run, wave, limit)
+
+    async def run_hosts(wave: list[HostDefinition], final: bool) -> list[CommandResult]:
+        run = run_one if final else (lambda host: run_one(host, final=False))
+        if priority is None:
+            return await run_all(run, wave)
+        order = sorted(range(len(wave)), key=lambda i: priority(wave[i]), reverse=True)
+        done = await run_all(run, [wave[i] for i in order])
+        ordered: list = [None] * len(wave)
+        for index, result in zip(order, done):
+            ordered[index] = result
+        return ordered
+
+    async def run_wave(wave: list[HostDefinition]) -> list[CommandResult]:
+        if retry is None or retry.attempts < 1:
+            return await run_hosts(wave, final=True)
+        results = await run_hosts(wave, final=False)
+        for attempt in range(1, retry.attempts + 1):
+            again = [i for i, result in enumerate(results) if retry.retryable(result)]
+            if not again:
+                break
+            await asyncio.sleep(retry.delay(attempt))
+            redone = await run_hosts(
+                [results[i].host for i in again], final=attempt == retry.attempts
+            )
+            for index, result in zip(again, redone):
+                result.attempts = attempt + 1
+                results[index] = result
+        return results
+
+    start_time = time.monotonic()
+    if batch is None:
+        results = await run_wave(hosts)
+    else:
+        results = []
+        batches = batch.batches(hosts)
+        for number, wave in enumerate(batches):
+            if number > 0 and batch.pause > 0 and not tripped:
+                await asyncio.sleep(batch.pause)
+            results.extend(await run_wave(wave))
+            if number == 0 and batch.canary and failures:
+                tripped = True
+    if stats is not None:
+        stats.hosts = len(hosts)
+        stats.elapsed = time.monotonic() - start_time
+        stats.forks = max(1, min(limit, len(hosts)))
+    return results
+
+
+# ---------------------------------------------------------------------------
+# Persistent Remote Shell
+# ---------------------------------------------------------------------------
+
+
+class RemoteShellClosed(Exception):
+    """Raised when a persistent remote shell's output ends unexpectedly."""
+
+    def __init__(self, stdout: bytes, stderr: bytes) -> None:
+        super().__init__("remote shell closed")
+        self.stdout = stdout
+        self.stderr = stderr
+
+
+async def _read_frame(
+    stream: asyncio.StreamReader, buffer: bytearray, marker: bytes
+) -> tuple[bytes, bytes]:
+    """Read from stream until a line starting with `marker` (preceded by a newline).
+
+    Args:
+        stream: The stream to read from.
+        buffer: Bytes already read but not yet consumed; updated in place.
+        marker: The sentinel that starts the framing line.
+
+    Returns:
+        (data before the sentinel, remainder of the sentinel line).
+
+    Raises:
+        EOFError: If the stream ends before the sentinel is seen.
+    """
+    needle = b"\n" + marker
+    search_from = 0
+    while True:
+        index = buffer.find(needle, search_from)
+        if index != -1:
+            end = buffer.find(b"\n", index + len(needle))
+            if end != -1:
+                data = bytes(buffer[:index])
+                rest = bytes(buffer[index + len(needle) : end])
+                del buffer[: end + 1]
+                return data, rest
+        else:
+            search_from = max(0, len(buffer) - len(needle))
+        chunk = await stream.read(_READ_CHUNK_SIZE)
+        if not chunk:
+            raise EOFError
+        buffer += chunk
+
+
+# Remote command starting a persistent shell: the user's login shell when it
+# speaks the POSIX syntax of the framing script, else sh. Single-quoted so any
+# login shell (csh and fish included) passes it to sh unchanged.
+_REMOTE_SHELL_CMD = (
+    'exec sh -c \'case "${SHELL##*/}" in'
+    ' bash|zsh|ksh|ksh93|mksh|dash|ash|sh) exec "${SHELL}" ;;'
+    " esac; exec sh'"
+)
+
+
+class RemoteShell:
+    """A long-lived remote shell that runs REPL commands written to its stdin.
+
+    The shell is the user's login shell when it is POSIX-compatible (see
+    `_REMOTE_SHELL_CMD`), so commands keep its syntax (bash arrays, process
+    substitution) as they have when run one ssh invocation at a time.
+
+    Each command is followed by printf sentinels on stdout and stderr that
+    carry a unique token, the exit code and the shell's current directory, so
+    output can be framed without closing the channel. Shell state (cwd,
+    environment variables, functions) persists between commands for free.
+    """
+
+    def __init__(
+        self,
+        host: HostDefinition,
+        process: object,
+        terminate: Callable[[], None],
+    ) -> None:
+        """Initialize the shell wrapper.
+
+        Args:
+            host: The host the shell runs on.
+            process: A process-like object with stdin/stdout/stderr streams,
+                `wait()` and `returncode` (asyncio subprocess or asyncssh process).
+            terminate: Callable that forcibly ends the process.
+        """
+        self.host = host
+        self.cwd: str | None = None
+        self.alive = True
+        self._process = process
+        self._terminate = terminate
+        self._stdout_buffer = bytearray()
+        self._stderr_buffer = bytearray()
+        self._lock = asyncio.Lock()
+
+    @staticmethod
+    def build_script(command: str, token: str) -> str:
+        """Build the stdin script for one command.
+
+        The command is syntax-checked first by the same shell binary ($0; a
+        syntax error would otherwise terminate the remote shell), then eval'ed
+        in the current shell with stdin detached so it cannot swallow the
+        framing lines.
+        """
+        quoted = shlex.quote(command)
+        return (
+            f'if __ssh_tool_err=$("$0" -nc {quoted} 2>&1); then eval {quoted} </dev/null; '
+            f"else printf '%s\\n' \"$__ssh_tool_err\" >&2; (exit 2); fi\n"
+            f"__ssh_tool_rc=$?\n"
+            f'printf \'\\n{token} %d %s\\n\' "$__ssh_tool_rc" "$PWD"\n'
+            f"printf '\\n{token}\\n' >&2\n"
+        )
+
+    async def run(self, command: str, timeout: float = 30.0) -> CommandResult:
+        """Run a command in the shell and return its framed result.
+
+        On timeout or if the shell dies, the shell is closed and marked dead.
+        """
+        async with self._lock:
+            if not self.alive:
+                return CommandResult(
+                    host=self.host,
+                    stdout="",
+                    stderr="",
+                    exit_code=255,
+                    error="remote shell closed",
+                )
+            token = f"__SSH_TOOL_{secrets.token_hex(8)}__"
+            marker = token.encode()
+            try:
+                self._process.stdin.write(self.build_script(command, token).encode())
+                await self._process.stdin.drain()
+                (stdout, rest), (stderr, _) = await asyncio.wait_for(
+                    asyncio.gather(
+                        _read_frame(self._process.stdout, self._stdout_buffer, marker),
+                        _read_frame(self._process.stderr, self._stderr_buffer, marker),
+                    ),
+                    timeout=timeout,
+                )
+            except TimeoutError:
+                await self.close()
+                return CommandResult(
+                    host=self.host, stdout="", stderr="", exit_code=1, timed_out=True
+                )
+            except (EOFError, OSError, ConnectionError):
+                return await self._closed_result()
+
+            exit_text, _, cwd = rest.decode(errors="replace").strip().partition(" ")
+            if cwd:
+                self.cwd = cwd
+            return CommandResult(
+                host=self.host,
+                stdout=stdout.decode(errors="replace"),
+                stderr=stderr.decode(errors="replace"),
+                exit_code=int(exit_text) if exit_text.isdigit() else 1,
+            )
+
+    async def _closed_result(self) -> CommandResult:
+        """Build the result for a shell whose channel ended mid-command."""
+        self.alive = False
+        # Drain whatever is left (e.g. ssh's own connection error message)
+        stderr = bytes(self._stderr_buffer)
+        try:
+            stderr += await asyncio.wait_for(self._process.stderr.read(), timeout=1.0)
+            await asyncio.wait_for(self._process.wait(), timeout=1.0)
+        except (TimeoutError, OSError, ConnectionError):
+            pass
+        returncode = self._process.returncode
+        reason = stderr.decode(errors="replace").strip()
+        return CommandResult(
+            host=self.host,
+            stdout=bytes(self._stdout_buffer).decode(errors="replace"),
+            stderr=stderr.decode(errors="replace"),
+            exit_code=returncode if returncode not in (None, 0) else 255,
+            error=reason or "remote shell closed",
+        )
+
+    async def close(self) -> None:
+        """Terminate the shell."""
+        if not self.alive:
+            return
+        self.alive = False
+        try:
+            self._process.stdin.write_eof()
+        except (OSError, AttributeError, RuntimeError):
+            pass
+        try:
+            await asyncio.wait_for(self._process.wait(), timeout=1.0)
+        except (TimeoutError, OSError, ConnectionError):
+            try:
+                self._terminate()
+            except ProcessLookupError:
+                pass
+        # Read the pipes to EOF so they are released with the process
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(
+                    self._process.stdout.read(), self._process.stderr.read()
+                ),
+                timeout=1.0,
+            )
+        except (TimeoutError, OSError, ConnectionError):
+            pass
+
+
+# ---------------------------------------------------------------------------
+# Transports
+# ---------------------------------------------------------------------------
+
+
+class Transport:
+    """Interface for executing a remote command on a host.
+
+    When no transport is given, `run_command_on_host` forks the system ssh
+    binary per command. Alternative transports implement `run` (and `close`
+    to release any connections they hold).
+    """
+
+    async def run(
+        self,
+        host: HostDefinition,
+        remote_cmd: str,
+        timeout: float,
+        connection_timeout: float,
+        on_line: LineCallback | None = None,
+        capture: CaptureLimits | None = None,
+        timing: HostTiming | None = None,
+        stdin: InputSource | None = None,
+    ) -> CommandResult:
+        """Execute remote_cmd on host and return its result.
+
+        When timing is given, phase timestamps are recorded on it. stdin, if
+        given, is fed to the remote command.
+        """
+        raise NotImplementedError
+
+    async def open_shell(
+        self, host: HostDefinition, connection_timeout: float
+    ) -> RemoteShell:
+        """Start a persistent remote shell on host."""
+        raise NotImplementedError
+
+    async def close(self) -> None:
+        """Release any resources held by the transport."""
+
+
+class SubprocessTransport(Transport):
+    """Forks the system ssh binary per command (the default behaviour)."""
+
+    def __init__(
+        self,
+        pool: ConnectionPool | None = None,
+        forward_agent: bool = False,
+        bastions: ConnectionPool | None = None,
+    ) -> None:
+        """Initialize the transport.
+
+        Args:
+            pool: Optional ConnectionPool whose masters commands are multiplexed over.
+            forward_agent: Forward the local ssh-agent to every host.
+            bastions: Optional ConnectionPool for bastions. The first host
+                behind a bastion opens a master to it, and every host behind
+                it tunnels over that one connection; the masters are closed
+                by `close`.
+        """
+        self.pool = pool
+        self.forward_agent = forward_agent
+        self.bastions = bastions
+        self._bastion_masters: dict[
+            str, asyncio.Future
+        ] = {}  # control path -> open attempt
+
+    async def bastion_control_path(
+        self, host: HostDefinition, connection_timeout: float
+    ) -> str | None:
+        """Return the control socket of host's bastion, opening its master once.
+
+        Returns None if the host has no bastion, there is no bastion pool or
+        the master could not be opened (ssh then connects through the
+        bastion directly, and reports the failure itself).
+        """
+        if host.via is None or self.bastions is None:
+            return None
+        path = self.bastions.control_path(host.via)
+        attempt = self._bastion_masters.get(path)
+        if attempt is None:
+            attempt = asyncio.ensure_future(self.bastions.open(host.via))
+            self._bastion_masters[path] = attempt
+        reason = await asyncio.shield(attempt)
+        return path if reason is None else None
+
+    async def run(
+        self,
+        host: HostDefinition,
+        remote_cmd: str,
+        timeout: float,
+        connection_timeout: float,
+        on_line: LineCallback | None = None,
+        capture: CaptureLimits | None = None,
+        timing: HostTiming | None = None,
+        stdin: InputSource | None = None,
+    ) -> CommandResult:
+        control_path = self.pool.control_path(host) if self.pool else None
+        bastion_path = await self.bastion_control_path(host, connection_timeout)
+        return await _run_ssh_subprocess(
+            host,
+            remote_cmd,
+            timeout,
+            connection_timeout,
+            control_path,
+            on_line,
+            capture,
+            timing,
+            stdin,
+            self.forward_agent,
+            bastion_path,
+        )
+
+    async def open_shell(
+        self, host: HostDefinition, connection_timeout: float
+    ) -> RemoteShell:
+        control_path = self.pool.control_path(host) if self.pool else None
+        process = await asyncio.create_subprocess_exec(
+            *build_ssh_args(host, connection_timeout, control_path=control_path),
+            _REMOTE_SHELL_CMD,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        return RemoteShell(host, process, process.kill)
+
+    async def close(self) -> None:
+        """Close the bastion masters."""
+        if self.bastions is not None:
+            attempts = list(self._bastion_masters.values())
+            self._bastion_masters.clear()
+            for attempt in attempts:
+                if not attempt.done():
+                    attempt.cancel()
+            await self.bastions.close_all()
+
+
+class AsyncSSHTransport(Transport):
+    """Runs every connection in-process on the event loop using asyncssh.
+
+    One SSH connection is opened per distinct user/hostname/port and kept
+    open; each command is a new channel multiplexed over that connection, so
+    there is no process creation and no repeated handshake per command.
+    Connections are bound to the event loop that created them and are
+    transparently re-established if a different loop is used.
+    """
+
+    def __init__(self, **connect_options: object) -> None:
+        """Initialize the transport.
+
+        Args:
+            connect_options: Extra keyword arguments passed to asyncssh.connect
+                (e.g. known_hosts=None).
+
+        Raises:
+            ValidationError: If the asyncssh package is not installed.
+        """
+        try:
+            import asyncssh
+        except ImportError:
+            raise ValidationError("the asyncssh engine requires the 'asyncssh' package")
+        self._asyncssh = asyncssh
+        self._connect_options = connect_options
+        self._connections: dict[tuple, asyncio.Future] = {}
+        self._loop: asyncio.AbstractEventLoop | None = None
+
+    def _key(self, host: HostDefinition) -> tuple:
+        return (_connection_key(host), host.identity_file)
+
+    async def _open(self, host: HostDefinition, connection_timeout: float):
+        """Open a new connection to host (tunnelled over its bastion's, if any)."""
+        options = dict(self._connect_options)
+        if host.identity_file:
+            options["client_keys"] = [host.identity_file]
+        if host.via is not None:
+            options["tunnel"] = await self.connect(host.via, connection_timeout)
+        return await asyncio.wait_for(
+            self._asyncssh.connect(
+                host.hostname, port=host.port, username=host.user, **options
+            ),
+            timeout=connection_timeout,
+        )
+
+    async def connect(self, host: HostDefinition, connection_timeout: float):
+        """Return a live connection for host, opening it if necessary.
+
+        Concurrent callers for the same target share a single connection
+        attempt.
+        """
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            # Connections cannot outlive the loop they were created on
+            self._connections.clear()
+            self._loop = loop
+
+        key = self._key(host)
+        future = self._connections.get(key)
+        if (
+            future is not None
+            and future.done()
+            and (
+                future.cancelled()
+                or future.exception() is not None
+                or future.result().is_closed()
+            )
+        ):
+            future = None
+        if future is None:
+            future = asyncio.ensure_future(self._open(host, connection_timeout))
+            self._connections[key] = future
+        try:
+            return await asyncio.shield(future)
+        except BaseException:
+            if self._connections.get(key) is future:
+                del self._connections[key]
+            raise
+
+    async def run(
+        self,
+        host: HostDefinition,
+        remote_cmd: str,
+        timeout: float,
+        connection_timeout: float,
+        on_line: LineCallback | None = None,
+        capture: CaptureLimits | None = None,
+        timing: HostTiming | None = None,
+        stdin: InputSource | None = None,
+    ) -> CommandResult:
+        asyncssh = self._asyncssh
+        try:
+            conn = await self.connect(host, connection_timeout)
+            connected = time.time()
+            process = await conn.create_process(remote_cmd, encoding=None)
+            if timing is not None:
+                timing.connected = connected
+                timing.spawned = time.time()
+        except TimeoutError:
+            return CommandResult(
+                host=host,
+                stdout="",
+                stderr="",
+                exit_code=255,
+                error="connection timed out",
+            )
+        except (OSError, asyncssh.Error) as e:
+            return CommandResult(
+                host=host,
+                stdout="",
+                stderr="",
+                exit_code=255,
+                error=str(e) or type(e).__name__,
+            )
+
+        collect = _with_input(
+            _collect_output(process, host, on_line, capture, timing),
+            process.stdin,
+            stdin,
+        )
+        try:
+            result = await asyncio.wait_for(collect, timeout=timeout)
+        except TimeoutError:
+            process.close()
+            result = CommandResult(
+                host=host, stdout="", stderr="", exit_code=1, timed_out=True
+            )
+        except (OSError, asyncssh.Error) as e:
+            result = CommandResult(
+                host=host,
+                stdout="",
+                stderr="",
+                exit_code=255,
+                error=str(e) or type(e).__name__,
+            )
+        result.timing.connected = connected
+        return result
+
+    async def open_shell(
+        self, host: HostDefinition, connection_timeout: float
+    ) -> RemoteShell:
+        try:
+            conn = await self.connect(host, connection_timeout)
+            process = await conn.create_process(_REMOTE_SHELL_CMD, encoding=None)
+        except TimeoutError:
+            raise OSError("connection timed out")
+        except self._asyncssh.Error as e:
+            raise OSError(str(e) or type(e).__name__)
+        return RemoteShell(host, process, process.close)
+
+    async def close(self) -> None:
+        """Close every open connection."""
+        futures = list(self._connections.values())
+        self._connections.clear()
+        if asyncio.get_running_loop() is not self._loop:
+            return
+        for future in futures:
+            if future.done() and not future.cancelled() and future.exception() is None:
+                conn = future.result()
+                conn.close()
+                await conn.wait_closed()
+            else:
+                future.cancel()
+
+
+def make_transport(
+    engine: str, pool: ConnectionPool | None = None, forward_agent: bool = False
+) -> Transport:
+    """Create the transport for an --engine value ("ssh" or "asyncssh").
+
+    Raises:
+        ValidationError: If the engine is unknown or its dependency is missing.
+    """
+    if engine == "ssh":
+        return SubprocessTransport(pool, forward_agent=forward_agent)
+    if engine == "asyncssh":
+        if forward_agent:
+            return AsyncSSHTransport(agent_forwarding=True)
+        return AsyncSSHTransport()
+    raise ValidationError(f"invalid --engine value '{engine}': must be ssh or asyncssh")
+
+
+# ---------------------------------------------------------------------------
+# Connection Pool (ControlMaster)
+# ---------------------------------------------------------------------------
+
+# Idle lifetime of a master if the tool dies without tearing the pool down
+_CONTROL_PERSIST_SECONDS = 600
+
+
+class ConnectionPool:
+    """Manages persistent ssh ControlMaster connections, one per host.
+
+    Masters are opened once (at REPL session start) and every later ssh
+    invocation for the same host reuses the master's socket via ControlPath,
+    skipping the TCP, key-exchange and authentication handshake. Sockets live
+    in a private temporary directory that is removed on `close_all`.
+    """
+
+    def __init__(
+        self,
+        connection_timeout: float = 10.0,
+        control_dir: Path | None = None,
+    ) -> None:
+        """Initialize the pool.
+
+        Args:
+            connection_timeout: SSH connection timeout in seconds for masters.
+            control_dir: Directory for control sockets. Defaults to a fresh
+                private temporary directory created on first use.
+        """
+        self.connection_timeout = connection_timeout
+        self._control_dir = control_dir
+        self._owns_control_dir = control_dir is None
+        self.masters: dict[str, HostDefinition] = {}  # control_path -> host
+        self._bastion_opens: dict[
+            str, asyncio.Future
+        ] = {}  # control path -> open attempt
+
+    @property
+    def control_dir(self) -> Path:
+        """Directory holding the control sockets (created lazily)."""
+        if self._control_dir is None:
+            self._control_dir = Path(tempfile.mkdtemp(prefix="ssh-tool-"))
+        return self._control_dir
+
+    def control_path(self, host: HostDefinition) -> str:
+        """Return the control socket path for a host.
+
+        The path is derived from user, hostname, port and bastion so that
+        hosts sharing a connection target share a master. A short digest keeps
+        the path well under the unix socket length limit.
+        """
+        import hashlib
+
+        digest = hashlib.sha1(_connection_key(host).encode()).hexdigest()[:16]
+        return str(self.control_dir / digest)
+
+    async def _run_ssh(self, args: list[str]) -> tuple[int, str]:
+        """Run a local ssh control invocation and return (exit_code, stderr)."""
+        try:
+            process = await asyncio.create_subprocess_exec(
+                *args,
+                stdin=asyncio.subprocess.DEVNULL,
+                stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.PIPE,
+            )
+        except OSError as e:
+            return 1, str(e)
+        _process_registry.add(process)
+        try:
+            _stdout, stderr_bytes = await asyncio.wait_for(
+                process.communicate(), timeout=self.connection_timeout + 5
+            )
+        except TimeoutError:
+            try:
+                process.kill()
+            except ProcessLookupError:
+                pass
+            await process.wait()
+            return 1, "connection timed out"
+        finally:
+            _process_registry.release(process)
+        returncode = process.returncode if process.returncode is not None else 1
+        return returncode, (stderr_bytes or b"").decode(errors="replace").strip()
+
+    async def bastion_control_path(self, host: HostDefinition) -> str | None:
+        """Return the control socket of host's bastion, opening its master once.
+
+        Returns None if the host has no bastion or the master could not be
+        opened (the host's own master then connects through the bastion
+        directly).
+        """
+        if host.via is None:
+            return None
+        path = self.control_path(host.via)
+        attempt = self._bastion_opens.get(path)
+        if attempt is None:
+            attempt = asyncio.ensure_future(self.open(host.via))
+            self._bastion_opens[path] = attempt
+        reason = await asyncio.shield(attempt)
+        return path if reason is None else None
+
+    async def open(self, host: HostDefinition) -> str | None:
+        """Start a background master for a host.
+
+        A host behind a bastion tunnels over a single master to that bastion,
+        shared by every host behind it.
+
+        Returns:
+            None on success, otherwise a failure reason.
+        """
+        path = self.control_path(host)
+        if path in self.masters:
+            return None  # another host definition shares this master
+        args = build_ssh_args(
+            host,
+            self.connection_timeout,
+            control_path=path,
+            master=True,
+            bastion_control_path=await self.bastion_control_path(host),
+        )
+        # -N: no remote command, -f: background once authenticated
+        args[1:1] = ["-N", "-f"]
+        returncode, stderr = await self._run_ssh(args)
+        if returncode != 0:
+            return stderr or "connection failed"
+        self.masters[path] = host
+        return None
+
+    async def check(self, host: HostDefinition) -> bool:
+        """Return True if the host's master is alive (local check, no network)."""
+        path = self.control_path(host)
+        if path not in self.masters:
+            return False
+        args = build_ssh_args(host, self.connection_timeout, control_path=path)
+        args[1:1] = ["-O", "check"]
+        returncode, _stderr = await self._run_ssh(args)
+        if returncode != 0:
+            del self.masters[path]
+            return False
+        return True
+
+    async def ensure(self, host: HostDefinition) -> str | None:
+        """Health-check a host's master, reopening it if it has died.
+
+        Returns:
+            None if a live master is available, otherwise a failure reason.
+        """
+        if await self.check(host):
+            return None
+        return await self.open(host)
+
+    async def close(self, host: HostDefinition) -> None:
+        """Ask the host's master to exit."""
+        path = self.control_path(host)
+        if self.masters.pop(path, None) is None:
+            return
+        args = build_ssh_args(host, self.connection_timeout, control_path=path)
+        args[1:1] = ["-O", "exit"]
+        await self._run_ssh(args)
+
+    async def open_all(
+        self,
+        hosts: list[HostDefinition],
+        forks: int = _DEFAULT_FORKS,
+        bastion_forks: int | None = None,
+    ) -> dict[str, str | None]:
+        """Open masters for all hosts, at most `forks` at a time.
+
+        With bastion_forks, at most that many are opened at a time behind
+        each bastion (see `_bastion_map`).
+
+        Returns:
+            A mapping of host name to failure reason (None on success).
+        """
+        # Open each distinct control path once; aliases share the outcome
+        unique: dict[str, HostDefinition] = {}
+        for host in hosts:
+            unique.setdefault(self.control_path(host), host)
+        targets = list(unique.values())
+        if bastion_forks is not None and any(host.via is not None for host in targets):
+            reasons = await _bastion_map(self.open, targets, forks, bastion_forks)
+        else:
+            reasons = await _bounded_map(self.open, targets, forks)
+        by_path = dict(zip(unique.keys(), reasons))
+        return {host.name: by_path[self.control_path(host)] for host in hosts}
+
+    async def close_all(self) -> None:
+        """Tear down every master and remove the socket directory."""
+        await _bounded_map(self.close, list(self.masters.values()), _DEFAULT_FORKS)
+        self._bastion_opens.clear()
+        if self._owns_control_dir and self._control_dir is not None:
+            shutil.rmtree(self._control_dir, ignore_errors=True)
+            self._control_dir = None
+
+
+# ---------------------------------------------------------------------------
+# Output Aggregation
+# ---------------------------------------------------------------------------
+
+# Splits a host name into (prefix, number, suffix) around its last digit run
+_HOST_NUMBER_RE = re.compile(r"^(.*?)(\d+)(\D*)$")
+
+
+def format_host_ranges(names: list[str]) -> str:
+    """Render host names compactly, collapsing numbered runs into ranges.
+
+    Names that differ only in a number of the same width are merged, e.g.
+    web01, web02, web03, web05 -> "web[01-03,05]". Other names are listed
+    as-is. The result is sorted and comma-separated.
+    """
+    numbered: dict[tuple[str, str, int], list[int]] = {}
+    plain: list[str] = []
+    for name in names:
+        match = _HOST_NUMBER_RE.match(name)
+        if match is None:
+            plain.append(name)
+            continue
+        prefix, digits, suffix = match.groups()
+        numbered.setdefault((prefix, suffix, len(digits)), []).append(int(digits))
+
+    parts: list[tuple[str, str]] = [(name, name) for name in plain]
+    for (prefix, suffix, width), numbers in numbered.items():
+        numbers = sorted(set(numbers))
+        if len(numbers) == 1:
+            name = f"{prefix}{numbers[0]:0{width}d}{suffix}"
+            parts.append((name, name))
+            continue
+        runs: list[str] = []
+        start = prev = numbers[0]
+        for number in numbers[1:] + [None]:
+            if number is not None and number == prev + 1:
+                prev = number
+                continue
+            if start == prev:
+                runs.append(f"{start:0{width}d}")
+            else:
+                runs.append(f"{start:0{width}d}-{prev:0{width}d}")
+            if number is not None:
+                start = prev = number
+        parts.append(
+            (f"{prefix}{numbers[0]:0{width}d}", f"{prefix}[{','.join(runs)}]{suffix}")
+        )
+    return ",".join(text for _key, text in sorted(parts))
+
+
+@dataclass
+class ResultGroup:
+    """Hosts that produced byte-identical results."""
+
+    result: CommandResult  # the first result seen (representative)
+    hosts: list[str] = field(default_factory=list)  # names of all hosts in the group
+
+
+class ResultAggregator:
+    """Groups results by (stdout, stderr, exit_code) as they arrive.
+
+    Only the first result of each group is kept, so memory and rendering
+    cost scale with the number of distinct outputs, not with the number
+    of hosts.
+    """
+
+    def __init__(self) -> None:
+        self._groups: dict[
+            bytes, ResultGroup
+        ] = {}  # digest -> group, in first-seen order
+
+    @staticmethod
+    def _digest(result: CommandResult) -> bytes:
+        import hashlib
+
+        h = hashlib.sha1()
+        for part in (result.stdout, result.stderr):
+            h.update(part.encode(errors="surrogateescape"))
+            h.update(b"\0")
+        h.update(f"{result.exit_code}:{result.timed_out}:{result.skipped}".encode())
+        for path in (result.stdout_file, result.stderr_file):
+            # Retained text is only a preview of spilled output
+            if path is not None:
+                h.update(f":{path.stat().st_size}".encode())
+        return h.digest()
+
+    def add(self, result: CommandResult) -> None:
+        """Add one host's result to its group."""
+        key = self._digest(result)
+        group = self._groups.get(key)
+        if group is None:
+            group = self._groups[key] = ResultGroup(result=result)
+        group.hosts.append(result.host.name)
+
+    def groups(self) -> list[ResultGroup]:
+        """Distinct results, largest group first (ties in first-seen order)."""
+        return sorted(self._groups.values(), key=lambda g: -len(g.hosts))
+
+
+# ---------------------------------------------------------------------------
+# Output Formatting
+# ---------------------------------------------------------------------------
+
+
+def _output_lines(text: str, path: Path | None):
+    """Yield the lines of a captured stream, reading spilled output from disk."""
+    if path is None:
+        yield from text.splitlines()
+        return
+    with path.open("r", errors="replace") as f:
+        for line in f:
+            yield line.rstrip("\n")
+
+
+def result_to_json(result: CommandResult) -> dict:
+    """Convert a result to the JSON object emitted by --format jsonl.
+
+    Spilled streams are reported as a byte count and file path, with the
+    inline text set to null. Phase timestamps other than started and finished
+    are null unless the run is traced (--stats or --trace-file).
+    """
+    record: dict = {
+        "host": result.host.name,
+        "hostname": result.host.hostname,
+        "exit_code": result.exit_code,
+        "timed_out": result.timed_out,
+        "error": result.error,
+        "skipped": result.skipped,
+        "failure": classify_failure(result),
+        "attempts": result.attempts,
+    }
+    for name, text, path in (
+        ("stdout", result.stdout, result.stdout_file),
+        ("stderr", result.stderr, result.stderr_file),
+    ):
+        if path is None:
+            record[name] = text
+        else:
+            record[name] = None
+            record[f"{name}_bytes"] = path.stat().st_size
+            record[f"{name}_file"] = str(path)
+    record["started"] = result.timing.started
+    record["spawned"] = result.timing.spawned
+    record["connected"] = result.timing.connected
+    record["first_byte"] = result.timing.first_byte
+    record["finished"] = result.timing.finished
+    return record
+
+
+# Bytes PlainWriter accumulates before writing through
+_PLAIN_BUFFER_SIZE = 256 * 1024
+
+# Line boundaries of str.splitlines other than "\n", in UTF-8
+_LINE_BREAK_RE = re.compile(rb"[\r\x0b\x0c\x1c-\x1e]|\xc2\x85|\xe2\x80[\xa8\xa9]")
+
+
+def _split_lines(data: bytes, final: bool = True) -> tuple[list[bytes], bytes]:
+    """Split output into lines where str.splitlines (and so the TTY output) does.
+
+    Returns the complete lines, without their line breaks, and the
+    unterminated rest. Unless final, a trailing "\r" stays in the rest, as
+    more data may turn it into "\r\n".
+    """
+    if not _LINE_BREAK_RE.search(data):
+        *lines, rest = data.split(b"\n")
+        return lines, rest
+    parts = data.decode(errors="surrogateescape").splitlines(keepends=True)
+    last = parts[-1]
+    unterminated = last.splitlines()[0] == last
+    rest = parts.pop() if unterminated or (not final and last.endswith("\r")) else ""
+    lines = [part.splitlines()[0].encode(errors="surrogateescape") for part in parts]
+    return lines, rest.encode(errors="surrogateescape")
+
+
+class PlainWriter:
+    """Low-overhead writer for piped ("[host] line") output.
+
+    Prefixes whole blocks of output at once with bytes operations and
+    writes them through in large chunks to the binary layer of the output
+    file, bypassing Rich's per-line rendering. Spilled output files are
+    copied through as bytes without decoding.
+    """
+
+    def __init__(
+        self, file: object | None = None, buffer_size: int = _PLAIN_BUFFER_SIZE
+    ) -> None:
+        """Initialize the writer.
+
+        Args:
+            file: Text output file. If None, uses sys.stdout. When it has a
+                binary `buffer` (as sys.stdout does) bytes are written there.
+            buffer_size: Bytes to accumulate before writing through.
+        """
+        self._file = file if file is not None else sys.stdout
+        self._binary = getattr(self._file, "buffer", None)
+        self._buffer = bytearray()
+        self._buffer_size = buffer_size
+
+    def write(self, data: bytes) -> None:
+        """Queue raw bytes for output."""
+        self._buffer += data
+        if len(self._buffer) >= self._buffer_size:
+            self.flush()
+
+    def write_lines(self, prefix: bytes, data: bytes) -> bool:
+        """Write every line of data with prefix in front of it.
+
+        Returns:
+            True if data contained at least one line.
+        """
+        if not data:
+            return False
+        if _LINE_BREAK_RE.search(data):
+            lines, rest = _split_lines(data)
+            data = b"\n".join([*lines, rest] if rest else lines)
+        elif data.endswith(b"\n"):
+            data = data[:-1]
+        self.write(prefix + data.replace(b"\n", b"\n" + prefix) + b"\n")
+        return True
+
+    def write_file(self, prefix: bytes, path: Path) -> bool:
+        """Like write_lines, reading the data from path in large chunks."""
+        has_output = False
+        partial = b""
+        with path.open("rb") as f:
+            while chunk := f.read(_PLAIN_BUFFER_SIZE):
+                head, sep, partial = (partial + chunk).rpartition(b"\n")
+                if sep:
+                    has_output |= self.write_lines(prefix, head + sep)
+        return self.write_lines(prefix, partial) or has_output
+
+    def flush(self) -> None:
+        """Write all queued bytes through to the file."""
+        if not self._buffer:
+            return
+        data = bytes(self._buffer)
+        self._buffer.clear()
+        if self._binary is not None:
+            # Keep ordering with anything already written to the text layer
+            self._file.flush()
+            self._binary.write(data)
+            self._binary.flush()
+        else:
+            self._file.write(data.decode(errors="replace"))
+            self._file.flush()
+
+
+class OutputFormatter:
+    """Formats command results for display.
+
+    Supports two modes:
+    - TTY mode: Rich-formatted block output with bold cyan host headers,
+      red ERR: prefixes for stderr, and yellow exit code indicators.
+    - Piped mode: Plain prefixed output suitable for grep/filtering,
+      with [host] prefix on stdout lines and [host] ERR: on stderr lines.
+      Written through a PlainWriter rather than Rich.
+
+    The --color option controls colorization:
+    - "auto": colorize only when stdout is a TTY
+    - "always": colorize regardless of TTY
+    - "never": no colorization regardless of TTY
+
+    With aggregate=True, hosts with identical results are printed once,
+    labelled with a compact host list (see `format_host_ranges`).
+
+    With output_format="jsonl", every result is written as one JSON object
+    per line (see `result_to_json`) regardless of TTY mode.
+    """
+
+    def __init__(
+        self,
+        color: str = "auto",
+        is_tty: bool | None = None,
+        file: object | None = None,
+        aggregate: bool = False,
+        output_format: str = "text",
+    ) -> None:
+        """Initialize the OutputFormatter.
+
+        Args:
+            color: Color mode — "always", "never", or "auto".
+            is_tty: Override TTY detection (for testing). If None, uses sys.stdout.isatty().
+            file: Override output file (for testing). If None, uses sys.stdout.
+            aggregate: Collapse identical results across hosts in format_results.
+            output_format: "text" (human-readable) or "jsonl" (one JSON object per host).
+        """
+        self._color = color
+        self.aggregate = aggregate
+        self.output_format = output_format
+
+        # Determine if we're in TTY mode
+        if is_tty is not None:
+            self._is_tty = is_tty
+        else:
+            self._is_tty = sys.stdout.isatty()
+
+        self._file = file
+        self._plain = PlainWriter(file)
+
+    @property
+    def is_tty(self) -> bool:
+        """Whether output is in TTY (interactive) mode."""
+        return self._is_tty
+
+    @cached_property
+    def console(self) -> Console:
+        """The Rich Console instance used for output (created on first use)."""
+        from rich.console import Console
+
+        # Determine if color should be enabled
+        if self._color == "always":
+            force_terminal = True
+        elif self._color == "never":
+            force_terminal = False
+        else:  # auto
+            force_terminal = None  # let Rich auto-detect
+
+        return Console(
+            file=self._file if self._file is not None else sys.stdout,
+            force_terminal=force_terminal,
+            no_color=(self._color == "never"),
+            highlight=False,
+        )
+
+    def format_results(self, results: list[CommandResult]) -> None:
+        """Print all results grouped by host using the appropriate mode.
+
+        Each host's output is printed contiguously (no interleaving).
+        Results are sorted alphabetically by host name.
+
+        Args:
+            results: List of CommandResult objects to format.
+        """
+        if self.aggregate and self.output_format == "text":
+            aggregator = ResultAggregator()
+            for result in results:
+                aggregator.add(result)
+            self.format_groups(aggregator.groups())
+            return
+        for result in results:
+            if self.output_format == "jsonl":
+                self._format_json(result)
+            elif self._is_tty:
+                self._format_tty(result)
+            else:
+                self._format_piped(result)
+        self._plain.flush()
+
+    def format_groups(self, groups: list[ResultGroup]) -> None:
+        """Print each distinct result once, labelled with the hosts that produced it."""
+        for group in groups:
+            label = format_host_ranges(group.hosts)
+            if self._is_tty:
+                self._format_tty(group.result, f"{label} ({len(group.hosts)} host(s))")
+            else:
+                self._format_piped(group.result, label)
+        self._plain.flush()
+
+    def format_result(self, result: CommandResult) -> None:
+        """Print a single host's result block using the appropriate mode."""
+        if self.output_format == "jsonl":
+            self._format_json(result)
+            self._plain.flush()
+        elif self._is_tty:
+            self._format_tty(result)
+        else:
+            self._format_piped(result)
+            self._plain.flush()
+
+    def _format_json(self, result: CommandResult) -> None:
+        """Queue one result as a JSON line."""
+        import json
+
+        self._plain.write(json.dumps(result_to_json(result)).encode() + b"\n")
+
+    def format_line(self, host: HostDefinition, line: str, is_stderr: bool) -> None:
+        """Print one live output line in piped format ("[host] line")."""
+        marker = " ERR: " if is_stderr else " "
+        self._plain.write(f"[{host.name}]{marker}{line}\n".encode(errors="replace"))
+        self._plain.flush()
+
+    def format_trailer(self, result: CommandResult, has_output: bool) -> None:
+        """Print the piped-mode trailer for a host whose lines were already streamed."""
+        self._format_piped_trailer(f"[{result.host.name}]", result, has_output)
+        self._plain.flush()
+
+    def _format_tty(self, result: CommandResult, label: str | None = None) -> None:
+        """Rich-formatted block output with host headers.
+
+        label replaces the host name in the header (used for aggregated groups).
+
+        Format:
+        - Header: "--- host ---" in bold cyan
+        - stdout lines printed as-is
+        - stderr lines prefixed with "ERR: " in red
+        - "(no output)" when both stdout and stderr are empty
+        - "exited with code N" in yellow for non-zero exit codes
+        - "(skipped)" alone for hosts a batch run never started
+        """
+        host_name = label or result.host.name
+
+        # Print host header
+        self.console.print(f"--- {host_name} ---", style="bold cyan")
+
+        if result.skipped:
+            self.console.print("(skipped)", style="dim")
+            return
+
+        has_output = False
+
+        # Print stdout lines
+        for line in _output_lines(result.stdout, result.stdout_file):
+            self.console.print(line)
+            has_output = True
+
+        # Print stderr lines with ERR: prefix
+        for line in _output_lines(result.stderr, result.stderr_file):
+            self.console.print(f"ERR: {line}", style="red")
+            has_output = True
+
+        # No output indicator
+        if not has_output:
+            self.console.print("(no output)", style="dim")
+
+        # Non-zero exit code indicator
+        if result.exit_code != 0:
+            self.console.print(f"exited with code {result.exit_code}", style="yellow")
+
+    def _format_piped(self, result: CommandResult, label: str | None = None) -> None:
+        """Plain prefixed output for piped/scripted usage.
+
+        label replaces the host name in the prefix (used for aggregated groups).
+
+        Format:
+        - stdout lines: "[host] line"
+        - stderr lines: "[host] ERR: line"
+        - "(no output)": "[host] (no output)"
+        - exit code: "[host] exited with code N"
+        - skipped host: "[host] (skipped)"
+
+        Output is queued on the PlainWriter; callers flush it.
+        """
+        prefix = f"[{label or result.host.name}]"
+        has_output = False
+        if not result.skipped:
+            has_output = self._write_piped_stream(
+                f"{prefix} ", result.stdout, result.stdout_file
+            )
+            has_output |= self._write_piped_stream(
+                f"{prefix} ERR: ", result.stderr, result.stderr_file
+            )
+        self._format_piped_trailer(prefix, result, has_output)
+
+    def _write_piped_stream(self, prefix: str, text: str, path: Path | None) -> bool:
+        """Queue one captured stream with prefix on every line."""
+        if path is not None:
+            return self._plain.write_file(prefix.encode(errors="replace"), path)
+        return self._plain.write_lines(
+            prefix.encode(errors="replace"), text.encode(errors="replace")
+        )
+
+    def _format_piped_trailer(
+        self, prefix: str, result: CommandResult, has_output: bool
+    ) -> None:
+        """Queue the skipped / no output / exit code lines for one host."""
+        if result.skipped:
+            self._plain.write(f"{prefix} (skipped)\n".encode(errors="replace"))
+            return
+        if not has_output:
+            self._plain.write(f"{prefix} (no output)\n".encode(errors="replace"))
+        if result.exit_code != 0:
+            self._plain.write(
+                f"{prefix} exited with code {result.exit_code}\n".encode(
+                    errors="replace"
+                )
+            )
+
+
+# ---------------------------------------------------------------------------
+# Latency History
+# ---------------------------------------------------------------------------
+
+# Weight of the newest sample in the moving averages
+_HISTORY_ALPHA = 0.3
+
+# Adaptive timeouts: runs needed before trusting history, and the bounds
+_ADAPTIVE_MIN_RUNS = 3
+_ADAPTIVE_MIN_TIMEOUT = 5.0
+
+# History rows not updated for this long are dropped, and at most this many
+# (the most recently updated) are kept per table
+_HISTORY_MAX_AGE = 30 * 24 * 3600.0
+_HISTORY_MAX_ROWS = 20_000
+
+
+@dataclass
+class HostLatency:
+    """Observed latency of one command on one host (exponential moving averages)."""
+
+    runs: int = 0  # completed executions recorded
+    failures: int = 0  # of which failed (non-zero exit, timeout or connection error)
+    mean: float = 0.0  # average seconds from start to finish
+    var: float = 0.0  # variance of the same
+    connect: float | None = None  # average seconds to connect, when measured
+
+    @property
+    def success_rate(self) -> float:
+        """Fraction of recorded runs that succeeded."""
+        return 1.0 - self.failures / self.runs if self.runs else 1.0
+
+    def adaptive_timeout(self, ceiling: float) -> float | None:
+        """A timeout well above this host's usual duration, capped at ceiling.
+
+        Returns None until enough runs have been recorded.
+        """
+        if self.runs < _ADAPTIVE_MIN_RUNS:
+            return None
+        expected = self.mean + 4 * math.sqrt(self.var)
+        return min(ceiling, max(_ADAPTIVE_MIN_TIMEOUT, 2 * expected))
+
+
+def _history_key(host: HostDefinition) -> str:
+    """Identify a host across runs by its connection target."""
+    return _connection_key(host)
+
+
+def _command_digest(command: str) -> str:
+    """Identify a command in the history without storing its text."""
+    import hashlib
+
+    return hashlib.sha256(command.encode()).hexdigest()
+
+
+class LatencyStore:
+    """Per-host latency history kept in a small SQLite database.
+
+    Stored under $XDG_STATE_HOME/ssh-tool (default ~/.local/state/ssh-tool).
+    Statistics are kept per (host, command), with commands identified by a
+    digest so their text (and any secret in it) is never written; hosts with
+    no history for a command fall back to their average over all commands,
+    kept per host. Rows idle for `_HISTORY_MAX_AGE` are dropped and each
+    table is capped at `_HISTORY_MAX_ROWS`.
+    """
+
+    def __init__(self, path: Path | None = None) -> None:
+        """Initialize the store (the database is opened on first use).
+
+        Args:
+            path: Database file. Defaults to `LatencyStore.default_path()`.
+        """
+        self.path = path or self.default_path()
+        self._db: sqlite3.Connection | None = None
+
+    @staticmethod
+    def default_path() -> Path:
+        """The database location under the XDG state directory."""
+        state_home = (
+            os.environ.get("XDG_STATE_HOME") or Path.home() / ".local" / "state"
+        )
+        return Path(state_home) / "ssh-tool" / "latency.db"
+
+    def _connect(self) -> sqlite3.Connection:
+        import sqlite3
+
+        if self._db is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._db = sqlite3.connect(self.path)
+            if self._db.execute(
+                "SELECT 1 FROM sqlite_master WHERE name = 'latency'"
+            ).fetchone():
+                # Earlier versions stored command text: drop it from the file too
+                with self._db:
+                    self._db.execute("DROP TABLE latency")
+                self._db.execute("VACUUM")
+            with self._db:
+                self._db.execute(
+                    "CREATE TABLE IF NOT EXISTS command_latency ("
+                    " host TEXT NOT NULL, command TEXT NOT NULL,"
+                    " runs INTEGER NOT NULL, failures INTEGER NOT NULL,"
+                    " mean REAL NOT NULL, var REAL NOT NULL, connect REAL,"
+                    " updated REAL NOT NULL, PRIMARY KEY (host, command))"
+                )
+                self._db.execute(
+                    "CREATE TABLE IF NOT EXISTS host_latency ("
+                    " host TEXT PRIMARY KEY, mean REAL NOT NULL, connect REAL,"
+                    " updated REAL NOT NULL)"
+                )
+                for table in ("command_latency", "host_latency"):
+                    self._db.execute(
+                        f"CREATE INDEX IF NOT EXISTS {table}_updated ON {table} (updated)"
+                    )
+        return self._db
+
+    def load(self, command: str) -> dict[str, HostLatency]:
+        """Return the history for command, keyed by `_history_key`."""
+        db = self._connect()
+        history = {
+            host: HostLatency(0, 0, mean, 0.0, connect)
+            for host, mean, connect in db.execute(
+                "SELECT host, mean, connect FROM host_latency"
+            )
+        }
+        for host, runs, failures, mean, var, connect in db.execute(
+            "SELECT host, runs, failures, mean, var, connect FROM command_latency WHERE command = ?",
+            (_command_digest(command),),
+        ):
+            history[host] = HostLatency(runs, failures, mean, var, connect)
+        return history
+
+    def record(self, command: str, results: list[CommandResult]) -> None:
+        """Fold the results of one run into the history, then prune it."""
+        db = self._connect()
+        digest = _command_digest(command)
+        current = {
+            host: HostLatency(runs, failures, mean, var, connect)
+            for host, runs, failures, mean, var, connect in db.execute(
+                "SELECT host, runs, failures, mean, var, connect FROM command_latency WHERE command = ?",
+                (digest,),
+            )
+        }
+        totals = {
+            host: (mean, connect)
+            for host, mean, connect in db.execute(
+                "SELECT host, mean, connect FROM host_latency"
+            )
+        }
+        rows = []
+        host_rows = []
+        now = time.time()
+        for result in results:
+            elapsed = result.timing.elapsed
+            if result.skipped or elapsed is None:
+                continue
+            key = _history_key(result.host)
+            h = current.get(key) or HostLatency()
+            h.runs += 1
+            if result.exit_code != 0:
+                h.failures += 1
+            if not result.error:
+                # Connection errors say nothing about how long the command takes
+                if h.mean == 0.0:  # first timed sample
+                    h.mean, h.var = elapsed, 0.0
+                else:
+                    delta = elapsed - h.mean
+                    h.mean += _HISTORY_ALPHA * delta
+                    h.var = (1 - _HISTORY_ALPHA) * (
+                        h.var + _HISTORY_ALPHA * delta * delta
+                    )
+            connect = result.timing.connect_time
+            if connect is not None:
+                h.connect = (
+                    connect
+                    if h.connect is None
+                    else h.connect + _HISTORY_ALPHA * (connect - h.connect)
+                )
+            rows.append(
+                (key, digest, h.runs, h.failures, h.mean, h.var, h.connect, now)
+            )
+            if not result.error:
+                mean, total_connect = totals.get(key, (elapsed, None))
+                mean += _HISTORY_ALPHA * (elapsed - mean)
+                if connect is not None:
+                    total_connect = (
+                        connect
+                        if total_connect is None
+                        else total_connect + _HISTORY_ALPHA * (connect - total_connect)
+                    )
+                host_rows.append((key, mean, total_connect, now))
+        with db:
+            db.executemany(
+                "INSERT OR REPLACE INTO command_latency VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+            db.executemany(
+                "INSERT OR REPLACE INTO host_latency VALUES (?, ?, ?, ?)", host_rows
+            )
+            for table in ("command_latency", "host_latency"):
+                db.execute(
+                    f"DELETE FROM {table} WHERE updated < ?", (now - _HISTORY_MAX_AGE,)
+                )
+                db.execute(
+                    f"DELETE FROM {table} WHERE rowid IN"
+                    f" (SELECT rowid FROM {table} ORDER BY updated DESC LIMIT -1 OFFSET ?)",
+                    (_HISTORY_MAX_ROWS,),
+                )
+
+    def close(self) -> None:
+        """Close the database."""
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+
+# ---------------------------------------------------------------------------
+# Last Run Results
+# ---------------------------------------------------------------------------
+
+
+@dataclass
+class LastRun:
+    """The failed hosts of the previous immediate-mode run (--retry-failed)."""
+
+    command: str
+    stdin: bool  # whether the command read the broadcast stdin
+    failed: list[HostDefinition] = field(default_factory=list)
+    failures: dict[str, str] = field(default_factory=dict)  # host name -> failure kind
+
+
+class LastRunStore:
+    """The outcome of the most recent immediate-mode run, as a JSON file.
+
+    Stored next to the latency history. Only failed hosts are kept, with
+    their full connection parameters, so they can be rerun even when they
+    came from a host file or inventory that has changed since.
+    """
+
+    def __init__(self, path: Path | None = None) -> None:
+        """Initialize the store.
+
+        Args:
+            path: Results file. Defaults to `LastRunStore.default_path()`.
+        """
+        self.path = path or self.default_path()
+
+    @staticmethod
+    def default_path() -> Path:
+        """The results file location under the XDG state directory."""
+        return LatencyStore.default_path().with_name("last-run.json")
+
+    def save(
+        self,
+        command: str,
+        hosts: list[HostDefinition],
+        results: list[CommandResult],
+        used_stdin: bool = False,
+    ) -> None:
+        """Record a run. Hosts in hosts without a result count as "interrupted"."""
+        import json
+
+        kinds = {r.host.name: classify_failure(r) for r in results}
+        failed = [
+            [*_host_fields(h), kinds.get(h.name, "interrupted")]
+            for h in hosts
+            if kinds.get(h.name, "interrupted") is not None
+        ]
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=self.path.parent, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(
+                    {
+                        "command": command,
+                        "stdin": used_stdin,
+                        "finished_at": time.time(),
+                        "failed": failed,
+                    },
+                    f,
+                )
+            os.replace(tmp, self.path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    def load(self) -> LastRun | None:
+        """Return the last recorded run, or None if there is none (or it is unreadable)."""
+        import json
+
+        try:
+            data = json.loads(self.path.read_text())
+            run = LastRun(command=data["command"], stdin=bool(data["stdin"]))
+            for *fields, kind in data["failed"]:
+                host = _host_from_fields(fields)
+                run.failed.append(host)
+                run.failures[host.name] = kind
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+        return run
+
+
+# ---------------------------------------------------------------------------
+# Immediate Mode
+# ---------------------------------------------------------------------------
+
+
+def compute_exit_code(results: list[CommandResult]) -> int:
+    """Compute the aggregated exit code from a list of command results.
+
+    Returns 0 if all results have exit code 0, otherwise returns 1.
+
+    Args:
+        results: List of CommandResult objects from command execution.
+
+    Returns:
+        0 if every result has exit_code == 0, else 1.
+    """
+    if all(r.exit_code == 0 for r in results):
+        return 0
+    return 1
+
+
+def format_summary(results: list[CommandResult]) -> str:
+    """Render a one-line success/failure summary for a run."""
+    skipped = sum(1 for r in results if r.skipped)
+    failed = sum(1 for r in results if r.exit_code != 0) - skipped
+    summary = (
+        f"{len(results)} host(s): {len(results) - failed - skipped} ok, {failed} failed"
+    )
+    if skipped:
+        summary += f", {skipped} skipped"
+    return summary
+
+
+def format_stats(stats: ExecutionStats) -> str:
+    """Render an ExecutionStats as a one-line throughput summary."""
+    return (
+        f"{stats.hosts} host(s) in {stats.elapsed:.2f}s "
+        f"({stats.throughput:.1f} hosts/sec, forks={stats.forks})"
+    )
+
+
+def percentile(values: list[float], pct: float) -> float:
+    """Nearest-rank percentile of values (which must not be empty)."""
+    ordered = sorted(values)
+    rank = max(1, math.ceil(pct / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+
+# Number of slowest hosts listed by the --stats report
+_SLOWEST_HOSTS = 5
+
+
+def format_latency_report(results: list[CommandResult], stats: ExecutionStats) -> str:
+    """Render the --stats report: throughput, latency percentiles and slowest hosts."""
+    lines = [format_stats(stats)]
+    timed = [
+        (r.timing.elapsed, r.host.name) for r in results if r.timing.elapsed is not None
+    ]
+    phases = [
+        ("total", [elapsed for elapsed, _name in timed]),
+        (
+            "connect",
+            [
+                r.timing.connect_time
+                for r in results
+                if r.timing.connect_time is not None
+            ],
+        ),
+        (
+            "first byte",
+            [
+                r.timing.first_byte - r.timing.started
+                for r in results
+                if r.timing.first_byte is not None and r.timing.started is not None
+            ],
+        ),
+    ]
+    for label, values in phases:
+        if values:
+            lines.append(
+                f"  {label + ':':<12}"
+                + "  ".join(f"p{p} {percentile(values, p):.3f}s" for p in (50, 90, 99))
+                + f"  max {max(values):.3f}s"
+            )
+    if timed:
+        slowest = sorted(timed, reverse=True)[:_SLOWEST_HOSTS]
+        lines.append(
+            "  slowest:    "
+            + ", ".join(f"{name} ({elapsed:.3f}s)" for elapsed, name in slowest)
+        )
+    return "\n".join(lines)
+
+
+def write_chrome_trace(results: list[CommandResult], path: Path) -> None:
+    """Write per-host phase timings in Chrome trace-event format.
+
+    Open the file in chrome://tracing or https://ui.perfetto.dev. Each host
+    is a "complete" event on its own row, with nested connect and execute
+    phases and an instant event for the first output byte.
+    """
+    import json
+
+    timed = [
+        r
+        for r in results
+        if r.timing.started is not None and r.timing.finished is not None
+    ]
+    origin = min((r.timing.started for r in timed), default=0.0)
+
+    def us(t: float) -> float:
+        return round((t - origin) * 1_000_000, 1)
+
+    events: list[dict] = []
+    for tid, result in enumerate(
+        sorted(timed, key=lambda r: r.timing.started), start=1
+    ):
+        t = result.timing
+        args = {"hostname": result.host.hostname, "exit_code": result.exit_code}
+        events.append(
+            {
+                "name": result.host.name,
+                "ph": "X",
+                "pid": 1,
+                "tid": tid,
+                "ts": us(t.started),
+                "dur": us(t.finished) - us(t.started),
+                "args": args,
+            }
+        )
+        if t.connected is not None:
+            events.append(
+                {
+                    "name": "connect",
+                    "ph": "X",
+                    "pid": 1,
+                    "tid": tid,
+                    "ts": us(t.started),
+                    "dur": us(t.connected) - us(t.started),
+                }
+            )
+            events.append(
+                {
+                    "name": "execute",
+                    "ph": "X",
+                    "pid": 1,
+                    "tid": tid,
+                    "ts": us(t.connected),
+                    "dur": us(t.finished) - us(t.connected),
+                }
+            )
+        if t.first_byte is not None:
+            events.append(
+                {
+                    "name": "first byte",
+                    "ph": "i",
+                    "s": "t",
+                    "pid": 1,
+                    "tid": tid,
+                    "ts": us(t.first_byte),
+                }
+            )
+        events.append(
+            {
+                "name": "thread_name",
+                "ph": "M",
+                "pid": 1,
+                "tid": tid,
+                "args": {"name": result.host.name},
+            }
+        )
+    path.write_text(json.dumps({"traceEvents": events, "displayTimeUnit": "ms"}))
+
+
+def run_immediate_mode(
+    hosts: list[HostDefinition],
+    command: str,
+    formatter: OutputFormatter,
     timeout: float = 30.0,
     connection_timeout: float = 10.0,
     sequential: bool = False,
-) -> list[CommandResult]:
-    """Execute a command on all hosts (concurrently by default).
+    forks: int = _DEFAULT_FORKS,
+    show_stats: bool = False,
+    stream: bool = False,
+    transport: Transport | None = None,
+    batch: BatchPolicy | None = None,
+    capture: CaptureLimits | None = None,
+    trace_file: Path | None = None,
+    history: LatencyStore | None = None,
+    adaptive_timeout: bool = False,
+    stdin: InputSource | None = None,
+    retry: RetryPolicy | None = None,
+    results_store: LastRunStore | None = None,
+    bastion_forks: int | None = None,
+) -> int:
+    """Execute a command on all hosts and display results (immediate mode).
+
+    Validates that the command is non-empty, executes it on all hosts via
+    `run_command_on_all`, formats and displays results via the formatter,
+    and returns the aggregated exit code.
 
     Args:
         hosts: List of host definitions to execute the command on.
         command: The command string to execute on each remote host.
-        working_dirs: Optional mapping of host names to their working directory.
+        formatter: OutputFormatter instance for displaying results.
         timeout: Maximum time in seconds to wait for each command.
         connection_timeout: SSH connection timeout in seconds.
         sequential: If True, execute on hosts one at a time; otherwise concurrently.
+        forks: Maximum number of hosts executed concurrently.
+        show_stats: If True, print throughput, per-phase latency percentiles
+            and the slowest hosts to stderr.
+        stream: If True, print each host's output as soon as it is available
+            instead of after all hosts finish, followed by a summary on stderr.
+            In TTY mode a host's block is printed when it completes; in piped
+            mode lines are printed live as they arrive. Ignored when the
+            formatter aggregates: results are grouped as they arrive and
+            each distinct output is printed once at the end. With a jsonl
+            formatter each host's object is always written as it completes.
+        transport: Optional Transport to execute through instead of forking ssh.
+            It is closed before returning.
+        batch: Optional BatchPolicy for rolling execution. When it aborts the
+            run, the number of skipped hosts is reported on stderr.
+        capture: Optional CaptureLimits bounding the output kept per host
+            and/or spilling it to an output directory.
+        trace_file: Optional path to write per-host timings to in Chrome
+            trace-event format.
+        history: Optional LatencyStore. Hosts that were slowest on previous
+            runs of the same command are started first, and this run's
+            timings are recorded.
+        adaptive_timeout: If True (and history is given), hosts with enough
+            history get a timeout derived from their usual duration, with
+            `timeout` as the ceiling.
+        stdin: Optional InputSource fed to every host's remote command.
+        retry: Optional RetryPolicy for hosts whose connection failed
+            transiently. Only the final attempt of each host is displayed.
+        results_store: Optional LastRunStore to record the failed hosts in,
+            for a later --retry-failed.
+        bastion_forks: Optional maximum number of hosts executed concurrently
+            behind each bastion.
+
+    On SIGINT or SIGTERM every in-flight ssh process is terminated (see
+    `ProcessRegistry.terminate_all`) and the results of the hosts that had
+    already finished are displayed. A second signal kills the processes
+    without waiting for the grace period.
 
     Returns:
-        A list of CommandResult objects, one per host, in the same order as hosts.
+        0 if all hosts returned exit code 0, 128 + the signal number if the
+        run was interrupted, otherwise 1.
+
+    Raises:
+        ValidationError: If the command is empty or whitespace-only.
     """
-    if sequential:
-        results: list[CommandResult] = []
-        for host in hosts:
-            working_dir = working_dirs.get(host.name) if working_dirs else None
-            result = await run_command_on_host(
-                host, command, working_dir, timeout, connection_timeout
-            )
-            results.append(result)
-        return results
-    else:
-        tasks = [
-            run_command_on_host(
-                host,
-                command,
-                working_dirs.get(host.name) if working_dirs else None,
-                timeout,
-                connection_timeout,
+    if not command or not command.strip():
+        raise ValidationError("command must not be empty")
+
+    stats = ExecutionStats()
+    on_result = None
+    on_line = None
+    jsonl = formatter.output_format == "jsonl"
+    aggregator = ResultAggregator() if formatter.aggregate and not jsonl else None
+    if jsonl:
+        # One object per host as soon as it completes
+        on_result = formatter.format_result
+    elif aggregator is not None:
+        on_result = aggregator.add
+    elif stream and formatter.is_tty:
+        on_result = formatter.format_result
+    elif stream:
+        streamed: set[str] = set()  # hosts that have printed at least one line
+
+        def on_line(host: HostDefinition, line: str, is_stderr: bool) -> None:
+            streamed.add(host.name)
+            formatter.format_line(host, line, is_stderr)
+
+        def on_result(result: CommandResult) -> None:
+            formatter.format_trailer(result, result.host.name in streamed)
+
+    priority = None
+    timeouts = None
+    if history is not None:
+        import sqlite3
+
+        try:
+            past = history.load(command)
+        except (sqlite3.Error, OSError) as e:
+            print(f"Warning: latency history unavailable: {e}", file=sys.stderr)
+            history = None
+        else:
+            # Hosts never seen before are started first
+            def priority(host: HostDefinition) -> float:
+                entry = past.get(_history_key(host))
+                return entry.mean if entry is not None else math.inf
+
+            if adaptive_timeout:
+                timeouts = {}
+                for host in hosts:
+                    entry = past.get(_history_key(host))
+                    limit = (
+                        entry.adaptive_timeout(timeout) if entry is not None else None
+                    )
+                    if limit is not None:
+                        timeouts[host.name] = limit
+
+    # Results in completion order, kept for display if the run is interrupted
+    finished: list[CommandResult] = []
+    report = on_result
+
+    def on_result(result: CommandResult) -> None:
+        finished.append(result)
+        if report is not None:
+            report(result)
+
+    interrupted: list[int] = []  # signals received
+    terminated = 0
+
+    async def execute() -> list[CommandResult]:
+        nonlocal terminated
+        loop = asyncio.get_running_loop()
+        work = asyncio.ensure_future(
+            run_command_on_all(
+                hosts=hosts,
+                command=command,
+                timeout=timeout,
+                connection_timeout=connection_timeout,
+                sequential=sequential,
+                forks=forks,
+                stats=stats,
+                on_result=on_result,
+                on_line=on_line,
+                transport=transport,
+                batch=batch,
+                capture=capture,
+                trace=show_stats or trace_file is not None,
+                priority=priority,
+                timeouts=timeouts,
+                stdin=stdin,
+                retry=retry,
+                bastion_forks=bastion_forks,
             )
-            for host in hosts
-        ]
-        return list(await asyncio.gather(*tasks))
+        )
+
+        def interrupt(signum: int) -> None:
+            if interrupted:
+                _process_registry.signal_all(signal.SIGKILL)
+            interrupted.append(signum)
+            work.cancel()
+
+        handled = []
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(signum, interrupt, signum)
+            except (NotImplementedError, RuntimeError):
+                continue  # not the main thread, or no signal support
+            handled.append(signum)
+        try:
+            try:
+                return await work
+            except asyncio.CancelledError:
+                if not interrupted:
+                    raise
+                terminated = await _process_registry.terminate_all()
+                order = {host.name: i for i, host in enumerate(hosts)}
+                return sorted(finished, key=lambda r: order.get(r.host.name, 0))
+        finally:
+            for signum in handled:
+                loop.remove_signal_handler(signum)
+            if stdin is not None:
+                await stdin.aclose()
+            if transport is not None:
+                await transport.close()
+
+    results = asyncio.run(execute())
+
+    if history is not None:
+        import sqlite3
+
+        try:
+            history.record(command, results)
+        except (sqlite3.Error, OSError) as e:
+            print(f"Warning: could not record latency history: {e}", file=sys.stderr)
+        finally:
+            history.close()
+
+    if results_store is not None:
+        try:
+            results_store.save(command, hosts, results, used_stdin=stdin is not None)
+        except OSError as e:
+            print(f"Warning: could not record run results: {e}", file=sys.stderr)
+
+    if aggregator is not None:
+        formatter.format_groups(aggregator.groups())
+    elif stream:
+        print(format_summary(results), file=sys.stderr)
+    elif not jsonl:
+        formatter.format_results(results)
+
+    skipped = sum(1 for r in results if r.skipped)
+    if skipped:
+        print(
+            f"Error: failure threshold exceeded, {skipped} host(s) skipped",
+            file=sys.stderr,
+        )
+
+    if show_stats:
+        print(format_latency_report(results, stats), file=sys.stderr)
+
+    if trace_file is not None:
+        write_chrome_trace(results, trace_file)
+
+    if interrupted:
+        print(
+            f"Interrupted: {len(results)} of {len(hosts)} host(s) finished, "
+            f"{terminated} ssh process(es) terminated",
+            file=sys.stderr,
+        )
+        return 128 + interrupted[0]
+
+    return compute_exit_code(results)
 
 
 # ---------------------------------------------------------------------------
-# Output Formatting
+# Watch Mode
 # ---------------------------------------------------------------------------
 
+# Trailing lines of each host's output shown in the --watch table
+_WATCH_OUTPUT_LINES = 5
 
-class OutputFormatter:
-    """Formats command results for display.
 
-    Supports two modes:
-    - TTY mode: Rich-formatted block output with bold cyan host headers,
-      red ERR: prefixes for stderr, and yellow exit code indicators.
-    - Piped mode: Plain prefixed output suitable for grep/filtering,
-      with [host] prefix on stdout lines and [host] ERR: on stderr lines.
+class ChangeTracker:
+    """Remembers each host's last result, to report only the hosts that changed.
 
-    The --color option controls colorization:
-    - "auto": colorize only when stdout is a TTY
-    - "always": colorize regardless of TTY
-    - "never": no colorization regardless of TTY
+    Results are compared by digest (see `ResultAggregator`), so no output
+    is kept beyond the current iteration.
     """
 
-    def __init__(
-        self,
-        color: str = "auto",
-        is_tty: bool | None = None,
-        file: object | None = None,
-    ) -> None:
-        """Initialize the OutputFormatter.
+    def __init__(self) -> None:
+        self._digests: dict[str, bytes] = {}  # host name -> digest of its last result
 
-        Args:
-            color: Color mode — "always", "never", or "auto".
-            is_tty: Override TTY detection (for testing). If None, uses sys.stdout.isatty().
-            file: Override output file (for testing). If None, uses sys.stdout.
-        """
-        self._color = color
+    def update(self, results: list[CommandResult]) -> list[CommandResult]:
+        """Record an iteration's results and return those that differ from the last one."""
+        changed = []
+        for result in results:
+            digest = ResultAggregator._digest(result)
+            if self._digests.get(result.host.name) != digest:
+                self._digests[result.host.name] = digest
+                changed.append(result)
+        return changed
 
-        # Determine if we're in TTY mode
-        if is_tty is not None:
-            self._is_tty = is_tty
-        else:
-            self._is_tty = sys.stdout.isatty()
 
-        # Determine if color should be enabled
-        if color == "always":
-            force_terminal = True
-        elif color == "never":
-            force_terminal = False
-        else:  # auto
-            force_terminal = None  # let Rich auto-detect
+def _watch_row(result: CommandResult, iteration: int) -> tuple:
+    """The --watch table cells for one host's result."""
+    from rich.text import Text
 
-        # Create the Rich Console
-        self._console = Console(
-            file=file if file is not None else sys.stdout,
-            force_terminal=force_terminal,
-            no_color=(color == "never"),
-            highlight=False,
+    if result.timed_out:
+        status = Text("timeout", style="yellow")
+    elif result.error is not None or result.exit_code == 255:
+        status = Text("error", style="red")
+    elif result.exit_code != 0:
+        status = Text(f"exit {result.exit_code}", style="yellow")
+    else:
+        status = Text("ok", style="green")
+    lines = [Text(line) for line in result.stdout.splitlines()]
+    lines += [Text(line, style="red") for line in result.stderr.splitlines()]
+    output = Text("\n").join(lines[-_WATCH_OUTPUT_LINES:])
+    return (result.host.name, status, output, Text(f"#{iteration}", style="dim"))
+
+
+def run_watch_mode(
+    hosts: list[HostDefinition],
+    command: str,
+    formatter: OutputFormatter,
+    interval: float,
+    timeout: float = 30.0,
+    connection_timeout: float = 10.0,
+    sequential: bool = False,
+    forks: int = _DEFAULT_FORKS,
+    transport: Transport | None = None,
+    pool: ConnectionPool | None = None,
+    batch: BatchPolicy | None = None,
+    retry: RetryPolicy | None = None,
+    bastion_forks: int | None = None,
+    iterations: int | None = None,
+) -> int:
+    """Run a command on all hosts every `interval` seconds (--watch).
+
+    One event loop and one set of connections (the pool's masters, or the
+    transport's connections) serve every iteration, so only the first pays
+    for the handshakes. Iterations start `interval` seconds apart, or right
+    after the previous one if it took longer.
+
+    In TTY mode a live table shows each host's status and last lines of
+    output; only the rows of hosts whose result changed are rebuilt. In
+    piped mode the results of hosts that changed are printed after each
+    iteration (every host after the first).
+
+    Args:
+        hosts: List of host definitions to execute the command on.
+        command: The command string to execute on each remote host.
+        formatter: OutputFormatter instance for displaying results.
+        interval: Seconds between the starts of consecutive iterations.
+        timeout, connection_timeout, sequential, forks, transport, batch,
+            retry, bastion_forks: As for `run_command_on_all`.
+        pool: Optional ConnectionPool; masters are opened for all hosts
+            before the first iteration (hosts behind a bastion over one
+            master to it, bastion_forks at a time) and closed on exit.
+        iterations: Stop after this many iterations (default: until SIGINT
+            or SIGTERM).
+
+    Returns:
+        The exit code of the last completed iteration (see `compute_exit_code`).
+
+    Raises:
+        ValidationError: If the command is empty or the interval is not positive.
+    """
+    if not command or not command.strip():
+        raise ValidationError("command must not be empty")
+    if interval <= 0:
+        raise ValidationError(f"invalid --watch interval {interval}: must be positive")
+
+    changes = ChangeTracker()
+    rows: dict[str, tuple] = {}  # host name -> cells, rebuilt only on change
+    results: list[CommandResult] = []
+    live = None
+    if formatter.is_tty:
+        from rich.live import Live
+
+        live = Live(console=formatter.console, auto_refresh=False)
+
+    def show(iteration: int, changed: list[CommandResult]) -> None:
+        if live is None:
+            for result in changed:
+                formatter.format_result(result)
+            return
+        from rich.table import Table
+        from rich.text import Text
+
+        for result in changed:
+            rows[result.host.name] = _watch_row(result, iteration)
+        updated = {result.host.name for result in changed}
+        table = Table(
+            title=Text(
+                f"every {interval:g}s: {command}  [run {iteration}, {len(changed)} changed]"
+            ),
+            title_justify="left",
+            expand=True,
         )
+        for column in ("host", "status", "output", "changed"):
+            table.add_column(column, ratio=1 if column == "output" else None)
+        for host in hosts:
+            if host.name in rows:
+                table.add_row(
+                    *rows[host.name], style="bold" if host.name in updated else None
+                )
+        live.update(table, refresh=True)
+
+    async def watch() -> None:
+        nonlocal results
+        loop = asyncio.get_running_loop()
+        stop = asyncio.Event()
+        handled = []
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(signum, stop.set)
+            except (NotImplementedError, RuntimeError):
+                continue  # not the main thread, or no signal support
+            handled.append(signum)
+        try:
+            if pool is not None:
+                await pool.open_all(hosts, forks, bastion_forks)
+            iteration = 0
+            while not stop.is_set():
+                started = loop.time()
+                iteration += 1
+                run = asyncio.ensure_future(
+                    run_command_on_all(
+                        hosts=hosts,
+                        command=command,
+                        timeout=timeout,
+                        connection_timeout=connection_timeout,
+                        sequential=sequential,
+                        pool=pool,
+                        forks=forks,
+                        transport=transport,
+                        batch=batch,
+                        retry=retry,
+                        bastion_forks=bastion_forks,
+                    )
+                )
+                stopping = asyncio.ensure_future(stop.wait())
+                await asyncio.wait({run, stopping}, return_when=asyncio.FIRST_COMPLETED)
+                stopping.cancel()
+                if not run.done():
+                    run.cancel()
+                    await asyncio.gather(run, return_exceptions=True)
+                    await _process_registry.terminate_all()
+                    break
+                results = run.result()
+                show(iteration, changes.update(results))
+                if iterations is not None and iteration >= iterations:
+                    break
+                try:
+                    await asyncio.wait_for(
+                        stop.wait(), max(0.0, started + interval - loop.time())
+                    )
+                except TimeoutError:
+                    pass
+        finally:
+            for signum in handled:
+                loop.remove_signal_handler(signum)
+            if pool is not None:
+                await pool.close_all()
+            if transport is not None:
+                await transport.close()
+
+    if live is not None:
+        with live:
+            asyncio.run(watch())
+    else:
+        asyncio.run(watch())
+    return compute_exit_code(results)
 
-    @property
-    def is_tty(self) -> bool:
-        """Whether output is in TTY (interactive) mode."""
-        return self._is_tty
 
-    @property
-    def console(self) -> Console:
-        """The Rich Console instance used for output."""
-        return self._console
+# ---------------------------------------------------------------------------
+# File Distribution
+# ---------------------------------------------------------------------------
 
-    def format_results(self, results: list[CommandResult]) -> None:
-        """Print all results grouped by host using the appropriate mode.
+# Suffix of the partial file a push writes before renaming it into place
+_PUSH_PARTIAL_SUFFIX = ".ssh-tool-part"
 
-        Each host's output is printed contiguously (no interleaving).
-        Results are sorted alphabetically by host name.
 
-        Args:
-            results: List of CommandResult objects to format.
-        """
-        for result in results:
-            if self._is_tty:
-                self._format_tty(result)
-            else:
-                self._format_piped(result)
+def resolve_push_dest(local: Path, dest: str | None) -> str:
+    """Remote path for a pushed file: dest, dest/<name> if dest ends in "/", or <name>."""
+    if not dest:
+        return local.name
+    if dest.endswith("/"):
+        return dest + local.name
+    return dest
 
-    def _format_tty(self, result: CommandResult) -> None:
-        """Rich-formatted block output with host headers.
 
-        Format:
-        - Header: "--- host ---" in bold cyan
-        - stdout lines printed as-is
-        - stderr lines prefixed with "ERR: " in red
-        - "(no output)" when both stdout and stderr are empty
-        - "exited with code N" in yellow for non-zero exit codes
-        """
-        host_name = result.host.name
+def build_push_command(dest: str, mode: int, then: str | None = None) -> str:
+    """Remote command that stores its stdin at dest, then optionally runs `then`.
 
-        # Print host header
-        self._console.print(f"--- {host_name} ---", style="bold cyan")
+    Missing parent directories are created. The file is written next to
+    dest and renamed into place, so dest is never seen half-written. `then`
+    only runs if the file was stored.
+    """
+    partial = shlex.quote(dest + _PUSH_PARTIAL_SUFFIX)
+    store = f"cat > {partial} && chmod {mode:o} {partial} && mv -f {partial} {shlex.quote(dest)}"
+    parent = posixpath.dirname(dest)
+    if parent:
+        store = f"mkdir -p {shlex.quote(parent)} && {store}"
+    push = f"{{ {store}; }} || {{ rm -f {partial}; exit 1; }}"
+    return f"{push}\n{then}" if then else push
+
+
+def build_script_command(args: list[str]) -> str:
+    """Remote command that stores its stdin as a temporary script and runs it with args."""
+    run = " ".join(['"$tmp"', *(shlex.quote(a) for a in args)])
+    return (
+        "tmp=$(mktemp) || exit 1\n"
+        f'cat > "$tmp" && chmod 700 "$tmp" && {run}; rc=$?\n'
+        'rm -f "$tmp"; exit $rc'
+    )
 
-        has_output = False
 
-        # Print stdout lines
-        if result.stdout:
-            for line in result.stdout.splitlines():
-                self._console.print(line)
-                has_output = True
+def build_relay_command(
+    receiver: HostDefinition, push_cmd: str, dest: str, connection_timeout: float
+) -> str:
+    """Command run on a host that has the file, forwarding it to receiver.
 
-        # Print stderr lines with ERR: prefix
-        if result.stderr:
-            for line in result.stderr.splitlines():
-                self._console.print(f"ERR: {line}", style="red")
-                has_output = True
+    The hop authenticates with the forwarded agent, so the local identity
+    file path (meaningless on the sender) is not passed on.
+    """
+    args = build_ssh_args(replace(receiver, identity_file=None), connection_timeout)
+    return f"{shlex.join(args)} {shlex.quote(push_cmd)} < {shlex.quote(dest)}"
 
-        # No output indicator
-        if not has_output:
-            self._console.print("(no output)", style="dim")
 
-        # Non-zero exit code indicator
-        if result.exit_code != 0:
-            self._console.print(
-                f"exited with code {result.exit_code}", style="yellow"
+async def relay_push(
+    hosts: list[HostDefinition],
+    local: Path,
+    dest: str,
+    timeout: float = 30.0,
+    connection_timeout: float = 10.0,
+    forks: int = _DEFAULT_FORKS,
+    transport: Transport | None = None,
+    on_result: Callable[[CommandResult], None] | None = None,
+) -> list[CommandResult]:
+    """Distribute a file to every host along a binomial tree.
+
+    In each round the origin and every host that already has the file send
+    it to one more host each, so the number of copies doubles per round and
+    the origin uploads the file only about log2(N) times. Hosts forward over
+    ssh using the origin's forwarded agent; a host whose relay fails is sent
+    the file directly from the origin at the end.
+
+    Args:
+        hosts: Hosts to receive the file.
+        local: Local file to distribute.
+        dest: Remote path to store it at (see `resolve_push_dest`).
+        timeout: Maximum time in seconds for each transfer.
+        connection_timeout: SSH connection timeout in seconds.
+        forks: Maximum number of transfers running at once.
+        transport: Transport to run transfers through. It must forward the
+            agent; defaults to SubprocessTransport(forward_agent=True).
+        on_result: Optional callback invoked with each host's final result.
+
+    Returns:
+        One CommandResult per host, in the same order as hosts.
+    """
+    transport = transport or SubprocessTransport(forward_agent=True)
+    push_cmd = build_push_command(dest, stat.S_IMODE(local.stat().st_mode))
+    source = FileInput(local)
+    results: dict[str, CommandResult] = {}
+    holders: list[HostDefinition] = []  # hosts that have the file
+    pending = list(hosts)
+    fallback: list[HostDefinition] = []  # relay failed, send directly
+
+    async def send(pair: tuple[HostDefinition | None, HostDefinition]) -> CommandResult:
+        sender, receiver = pair
+        if sender is None:
+            return await run_command_on_host(
+                receiver,
+                push_cmd,
+                timeout=timeout,
+                connection_timeout=connection_timeout,
+                transport=transport,
+                stdin=source,
+            )
+        hop = build_relay_command(receiver, push_cmd, dest, connection_timeout)
+        result = await run_command_on_host(
+            sender,
+            hop,
+            timeout=timeout,
+            connection_timeout=connection_timeout,
+            transport=transport,
+        )
+        return replace(result, host=receiver)
+
+    def finish(result: CommandResult) -> None:
+        results[result.host.name] = result
+        if on_result is not None:
+            on_result(result)
+
+    while pending:
+        senders: list[HostDefinition | None] = [None, *holders]
+        pairs = list(zip(senders, pending))
+        pending = pending[len(pairs) :]
+        for (sender, receiver), result in zip(
+            pairs, await _bounded_map(send, pairs, forks)
+        ):
+            if result.exit_code == 0:
+                holders.append(receiver)
+                finish(result)
+            elif sender is None:
+                finish(result)
+            else:
+                fallback.append(receiver)
+
+    for result in await _bounded_map(send, [(None, h) for h in fallback], forks):
+        finish(result)
+    return [results[h.name] for h in hosts]
+
+
+def run_relay_mode(
+    hosts: list[HostDefinition],
+    local: Path,
+    dest: str,
+    command: str | None,
+    formatter: OutputFormatter,
+    timeout: float = 30.0,
+    connection_timeout: float = 10.0,
+    forks: int = _DEFAULT_FORKS,
+    transport: Transport | None = None,
+) -> int:
+    """Push a file with `relay_push`, then optionally run a command (relay mode).
+
+    The command runs on every host that received the file; hosts where the
+    transfer failed show the transfer's result instead.
+
+    Returns:
+        0 if every transfer (and command) succeeded, otherwise 1.
+    """
+
+    async def execute() -> list[CommandResult]:
+        try:
+            results = await relay_push(
+                hosts, local, dest, timeout, connection_timeout, forks, transport
             )
+            received = [r.host for r in results if r.exit_code == 0]
+            if command and received:
+                ran = await run_command_on_all(
+                    received,
+                    command,
+                    timeout=timeout,
+                    connection_timeout=connection_timeout,
+                    forks=forks,
+                    transport=transport,
+                )
+                by_name = {r.host.name: r for r in ran}
+                results = [by_name.get(r.host.name, r) for r in results]
+            return results
+        finally:
+            if transport is not None:
+                await transport.close()
 
-    def _format_piped(self, result: CommandResult) -> None:
-        """Plain prefixed output for piped/scripted usage.
+    results = asyncio.run(execute())
+    formatter.format_results(results)
+    return compute_exit_code(results)
 
-        Format:
-        - stdout lines: "[host] line"
-        - stderr lines: "[host] ERR: line"
-        - "(no output)": "[host] (no output)"
-        - exit code: "[host] exited with code N"
-        """
-        host_name = result.host.name
-        prefix = f"[{host_name}]"
 
-        has_output = False
+# ---------------------------------------------------------------------------
+# Background Event Loop
+# ---------------------------------------------------------------------------
+
+
+class EventLoopThread:
+    """An asyncio event loop running forever in a background daemon thread.
+
+    The REPL reads input with readline on the main thread and hands work to
+    this loop, so connections, shells and background tasks (health checks,
+    reconnects) live for the whole session and keep running between prompts.
+    """
+
+    def __init__(self) -> None:
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._thread: threading.Thread | None = None
 
-        # Print stdout lines with prefix
-        if result.stdout:
-            for line in result.stdout.splitlines():
-                self._console.print(f"{prefix} {line}", markup=False, highlight=False)
-                has_output = True
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        """The running loop (started on first use)."""
+        if self._loop is None:
+            self._loop = asyncio.new_event_loop()
+            self._thread = threading.Thread(
+                target=self._loop.run_forever, name="ssh-tool-loop", daemon=True
+            )
+            self._thread.start()
+        return self._loop
 
-        # Print stderr lines with prefix and ERR: marker
-        if result.stderr:
-            for line in result.stderr.splitlines():
-                self._console.print(f"{prefix} ERR: {line}", markup=False, highlight=False)
-                has_output = True
+    def submit(self, coro: Coroutine) -> Future:
+        """Schedule a coroutine on the loop without waiting for it."""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
 
-        # No output indicator
-        if not has_output:
-            self._console.print(f"{prefix} (no output)", markup=False, highlight=False)
+    def run(self, coro: Coroutine):
+        """Run a coroutine on the loop and block until it completes.
 
-        # Non-zero exit code indicator
-        if result.exit_code != 0:
-            self._console.print(f"{prefix} exited with code {result.exit_code}", markup=False, highlight=False)
+        If the caller is interrupted (Ctrl+C), the coroutine is cancelled
+        before the interrupt propagates.
+        """
+        future = self.submit(coro)
+        try:
+            return future.result()
+        except KeyboardInterrupt:
+            future.cancel()
+            raise
 
+    def stop(self) -> None:
+        """Cancel outstanding tasks, stop the loop and join the thread."""
+        if self._loop is None:
+            return
+        loop = self._loop
 
-# ---------------------------------------------------------------------------
-# Immediate Mode
-# ---------------------------------------------------------------------------
+        async def cancel_tasks() -> None:
+            current = asyncio.current_task()
+            tasks = [t for t in asyncio.all_tasks() if t is not current]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
 
+        asyncio.run_coroutine_threadsafe(cancel_tasks(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        self._thread.join()
+        loop.close()
+        self._loop = None
+        self._thread = None
 
-def compute_exit_code(results: list[CommandResult]) -> int:
-    """Compute the aggregated exit code from a list of command results.
 
-    Returns 0 if all results have exit code 0, otherwise returns 1.
+# ---------------------------------------------------------------------------
+# REPL Mode
+# ---------------------------------------------------------------------------
 
-    Args:
-        results: List of CommandResult objects from command execution.
+# Seconds between background health checks of persistent connections
+_KEEPALIVE_INTERVAL = 30.0
 
-    Returns:
-        0 if every result has exit_code == 0, else 1.
-    """
-    if all(r.exit_code == 0 for r in results):
-        return 0
-    return 1
+# Seconds between background reconnect passes
+_RECONNECT_TICK = 1.0
 
 
-def run_immediate_mode(
-    hosts: list[HostDefinition],
-    command: str,
-    formatter: OutputFormatter,
-    timeout: float = 30.0,
-    connection_timeout: float = 10.0,
-    sequential: bool = False,
-) -> int:
-    """Execute a command on all hosts and display results (immediate mode).
+@dataclass
+class HostHealth:
+    """Reconnect state for one disconnected host."""
 
-    Validates that the command is non-empty, executes it on all hosts via
-    `run_command_on_all`, formats and displays results via the formatter,
-    and returns the aggregated exit code.
+    failures: int = 0  # consecutive failed connection attempts
+    last_failure: float = 0.0  # monotonic time of the last failure
+    next_retry: float = 0.0  # monotonic time of the next allowed attempt
+    last_error: str | None = None  # reason for the last failure
 
-    Args:
-        hosts: List of host definitions to execute the command on.
-        command: The command string to execute on each remote host.
-        formatter: OutputFormatter instance for displaying results.
-        timeout: Maximum time in seconds to wait for each command.
-        connection_timeout: SSH connection timeout in seconds.
-        sequential: If True, execute on hosts one at a time; otherwise concurrently.
 
-    Returns:
-        0 if all hosts returned exit code 0, otherwise 1.
+class ReconnectManager:
+    """Schedules reconnect attempts with exponential backoff and jitter.
 
-    Raises:
-        ValidationError: If the command is empty or whitespace-only.
+    Each failure doubles the delay before the host is probed again (up to
+    max_delay), randomized by +/- jitter so that hosts that dropped together
+    are not retried in lockstep.
     """
-    if not command or not command.strip():
-        raise ValidationError("command must not be empty")
-
-    results = asyncio.run(
-        run_command_on_all(
-            hosts=hosts,
-            command=command,
-            timeout=timeout,
-            connection_timeout=connection_timeout,
-            sequential=sequential,
-        )
-    )
 
-    formatter.format_results(results)
+    def __init__(
+        self,
+        base_delay: float = 1.0,
+        max_delay: float = 60.0,
+        jitter: float = 0.2,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        """Initialize the manager.
 
-    return compute_exit_code(results)
+        Args:
+            base_delay: Delay in seconds after the first failure.
+            max_delay: Upper bound on the delay between attempts.
+            jitter: Relative randomization applied to each delay (0.2 = +/-20%).
+            clock: Monotonic time source (injectable for testing).
+        """
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.clock = clock
+        self.health: dict[str, HostHealth] = {}  # host_name -> state
 
+    def record_failure(self, host_name: str, reason: str | None = None) -> float:
+        """Record a failed attempt and schedule the next one.
 
-# ---------------------------------------------------------------------------
-# REPL Mode
-# ---------------------------------------------------------------------------
+        Returns:
+            The delay in seconds until the host is due again.
+        """
+        state = self.health.setdefault(host_name, HostHealth())
+        state.failures += 1
+        state.last_failure = self.clock()
+        state.last_error = reason
+        delay = min(self.max_delay, self.base_delay * 2 ** (state.failures - 1))
+        delay *= 1 + self.jitter * (2 * random.random() - 1)
+        state.next_retry = state.last_failure + delay
+        return delay
+
+    def record_success(self, host_name: str) -> None:
+        """Forget a host's failure history."""
+        self.health.pop(host_name, None)
+
+    def is_due(self, host_name: str) -> bool:
+        """Whether the host's backoff window has elapsed."""
+        state = self.health.get(host_name)
+        return state is None or self.clock() >= state.next_retry
+
+    def retry_in(self, host_name: str) -> float:
+        """Seconds until the host is due (0 if due now)."""
+        state = self.health.get(host_name)
+        if state is None:
+            return 0.0
+        return max(0.0, state.next_retry - self.clock())
 
 
 class MetaCommandHandler:
@@ -1054,16 +5120,25 @@ class MetaCommandHandler:
     def _cmd_hosts(self) -> bool:
         """Display hosts with their connection status and current directory."""
         for host in self.session.hosts:
-            status = "connected" if self.session.connected.get(host.name, False) else "disconnected"
+            status = (
+                "connected"
+                if self.session.connected.get(host.name, False)
+                else "disconnected"
+            )
             wd = self.session.working_dirs.get(host.name, "~")
             if self.session.connected.get(host.name, False):
                 print(f"  {host.name} ({host.hostname}): {status}  cwd={wd}")
             else:
-                print(f"  {host.name} ({host.hostname}): {status}")
+                retry_in = self.session.reconnect.retry_in(host.name)
+                print(
+                    f"  {host.name} ({host.hostname}): {status}  retry in {retry_in:.0f}s"
+                )
         return False
 
     def _cmd_history(self) -> bool:
         """Display the last 50 history entries with line numbers."""
+        import readline
+
         history_len = readline.get_current_history_length()
         start = max(1, history_len - 49)
         for i in range(start, history_len + 1):
@@ -1085,7 +5160,8 @@ class MetaCommandHandler:
     def _cmd_reconnect(self) -> bool:
         """Attempt to reconnect to all disconnected hosts."""
         disconnected = [
-            h for h in self.session.hosts
+            h
+            for h in self.session.hosts
             if not self.session.connected.get(h.name, False)
         ]
         if not disconnected:
@@ -1093,20 +5169,16 @@ class MetaCommandHandler:
             return False
 
         print(f"Attempting to reconnect to {len(disconnected)} host(s)...")
-        results = asyncio.run(
-            run_command_on_all(
-                hosts=disconnected,
-                command="echo ok",
-                timeout=self.session.timeout,
-                connection_timeout=self.session.connection_timeout,
-            )
-        )
+        # Explicit request: ignore any backoff window
+        results = self.session._run(self.session._probe_hosts(disconnected))
         for result in results:
             if result.exit_code == 0 and not result.error and not result.timed_out:
                 self.session.connected[result.host.name] = True
+                self.session.reconnect.record_success(result.host.name)
                 print(f"  {result.host.name}: reconnected")
             else:
                 reason = _format_connection_failure(result)
+                self.session.reconnect.record_failure(result.host.name, reason)
                 print(f"  {result.host.name}: failed ({reason})", file=sys.stderr)
         return False
 
@@ -1125,6 +5197,12 @@ class ReplSession:
         timeout: float = 30.0,
         connection_timeout: float = 10.0,
         history_file: Path | None = None,
+        pool: ConnectionPool | None = None,
+        forks: int = _DEFAULT_FORKS,
+        transport: Transport | None = None,
+        persistent_shell: bool = False,
+        keepalive_interval: float = _KEEPALIVE_INTERVAL,
+        reconnect: ReconnectManager | None = None,
     ) -> None:
         """Initialize the REPL session.
 
@@ -1134,11 +5212,33 @@ class ReplSession:
             timeout: Command timeout in seconds.
             connection_timeout: SSH connection timeout in seconds.
             history_file: Path to the history file. Defaults to ~/.ssh_tool_history.
+            pool: Optional ConnectionPool; masters are opened at session start
+                and reused by every command until the session ends.
+            forks: Maximum number of hosts to run on concurrently.
+            transport: Optional Transport to execute through instead of forking ssh.
+            persistent_shell: If True, keep one long-lived remote shell per host
+                and run every command in it (cwd, env vars and functions persist).
+            keepalive_interval: Seconds between background health checks of
+                persistent connections while the prompt is idle (0 disables).
+            reconnect: ReconnectManager scheduling background reconnects of
+                disconnected hosts. Defaults to exponential backoff from 1s to 60s.
         """
         self.hosts = hosts
         self.formatter = formatter
         self.timeout = timeout
         self.connection_timeout = connection_timeout
+        self.pool = pool
+        self.forks = forks
+        self.transport = transport
+        self.persistent_shell = persistent_shell
+        self.shells: dict[str, RemoteShell] = {}  # host_name -> persistent shell
+        # host_name -> lock serializing (re)connects of that host, which
+        # :reconnect and the background reconnect loop may start at once
+        self._connect_locks: dict[str, asyncio.Lock] = {}
+        self.keepalive_interval = keepalive_interval
+        self._loop_thread = EventLoopThread()
+        self._busy = False  # a command is running on the loop
+        self.reconnect = reconnect or ReconnectManager()
         self.working_dirs: dict[str, str] = {}  # host_name -> cwd
         self.connected: dict[str, bool] = {}  # host_name -> connected
         self.history_file = history_file or Path.home() / ".ssh_tool_history"
@@ -1158,6 +5258,9 @@ class ReplSession:
         Returns:
             0 on clean exit, 1 if all hosts were unreachable.
         """
+        # Importing readline gives input() line editing and history
+        import readline
+
         # Load command history
         self._load_history()
 
@@ -1166,12 +5269,20 @@ class ReplSession:
 
         # Initial connection attempt
         if not self._initial_connect():
+            self._close_connections()
             return 1
 
+        # Health-check connections in the background while the user types
+        if self.keepalive_interval > 0 and (self.persistent_shell or self.pool):
+            self._loop_thread.submit(self._keepalive())
+        self._loop_thread.submit(self._reconnect_loop())
+
         # Display readiness prompt
         connected_count = sum(1 for v in self.connected.values() if v)
         total_count = len(self.hosts)
-        print(f"Connected to {connected_count}/{total_count} host(s). Type :help for commands.")
+        print(
+            f"Connected to {connected_count}/{total_count} host(s). Type :help for commands."
+        )
 
         try:
             while True:
@@ -1206,9 +5317,101 @@ class ReplSession:
             print("\nInterrupted.")
         finally:
             self._save_history()
+            self._close_connections()
 
         return 0
 
+    def _run(self, coro):
+        """Run a coroutine on the session's background event loop and wait for it.
+
+        A single loop is kept for the whole session so that connections and
+        shells created by one command are still usable by the next.
+        """
+        self._busy = True
+        try:
+            return self._loop_thread.run(coro)
+        finally:
+            self._busy = False
+
+    def _notify(self, message: str) -> None:
+        """Report an asynchronous event (from the background loop) on stderr."""
+        print(f"\n{message}", file=sys.stderr)
+
+    async def _keepalive(self) -> None:
+        """Periodically health-check connected hosts while the prompt is idle.
+
+        Hosts whose shell or master has died are marked disconnected so the
+        next command does not wait on them.
+        """
+        while True:
+            await asyncio.sleep(self.keepalive_interval)
+            if self._busy:
+                continue
+            hosts = self._get_connected_hosts()
+            alive = await _bounded_map(self._is_alive, hosts, self.forks)
+            for host, ok in zip(hosts, alive):
+                if not ok and self.connected.get(host.name, False):
+                    self.connected[host.name] = False
+                    self.reconnect.record_failure(host.name, "health check failed")
+                    self._notify(
+                        f"Error: host '{host.name}' disconnected: health check failed"
+                    )
+
+    async def _reconnect_loop(self) -> None:
+        """Keep retrying disconnected hosts in the background."""
+        while True:
+            await asyncio.sleep(_RECONNECT_TICK)
+            if not self._busy:
+                await self._reconnect_due()
+
+    async def _reconnect_due(self) -> None:
+        """Probe the disconnected hosts whose backoff window has elapsed.
+
+        Successful hosts are marked connected and announced; failures push
+        the host's next attempt further out without further output.
+        """
+        due = [
+            h
+            for h in self.hosts
+            if not self.connected.get(h.name, False) and self.reconnect.is_due(h.name)
+        ]
+        if not due:
+            return
+        results = await self._probe_hosts(due)
+        for result in results:
+            if result.exit_code == 0 and not result.error and not result.timed_out:
+                self.connected[result.host.name] = True
+                self.reconnect.record_success(result.host.name)
+                self._notify(f"  [{result.host.name}] reconnected")
+            else:
+                self.reconnect.record_failure(
+                    result.host.name, _format_connection_failure(result)
+                )
+
+    async def _is_alive(self, host: HostDefinition) -> bool:
+        """Cheap liveness check for a host's persistent connection."""
+        if self.persistent_shell:
+            shell = self.shells.get(host.name)
+            if shell is None:
+                return False
+            result = await shell.run(":", self.connection_timeout)
+            return result.exit_code == 0 and not result.error and not result.timed_out
+        if self.pool is not None:
+            return await self.pool.check(host)
+        return True
+
+    def _close_connections(self) -> None:
+        """Tear down all persistent connections (shells, pool masters, transport)."""
+        shells = list(self.shells.values())
+        self.shells.clear()
+        for shell in shells:
+            self._run(shell.close())
+        if self.pool is not None:
+            self._run(self.pool.close_all())
+        if self.transport is not None:
+            self._run(self.transport.close())
+        self._loop_thread.stop()
+
     def _initial_connect(self) -> bool:
         """Test connectivity to all hosts. Returns False if all unreachable.
 
@@ -1220,22 +5423,21 @@ class ReplSession:
             True if at least one host is reachable, False if all failed.
         """
         start_time = time.time()
-        results = asyncio.run(
-            run_command_on_all(
-                hosts=self.hosts,
-                command="echo ok",
-                timeout=self.timeout,
-                connection_timeout=self.connection_timeout,
-            )
-        )
+        if self.pool is not None:
+            # Failures surface through the `echo ok` probe below
+            self._run(self.pool.open_all(self.hosts, self.forks))
+        results = self._run(self._probe_hosts(self.hosts))
 
         for result in results:
-            elapsed = time.time() - start_time
+            elapsed = result.timing.elapsed
+            if elapsed is None:
+                elapsed = time.time() - start_time
             if result.exit_code == 0 and not result.error and not result.timed_out:
                 self.connected[result.host.name] = True
             else:
                 self.connected[result.host.name] = False
                 reason = _format_connection_failure(result)
+                self.reconnect.record_failure(result.host.name, reason)
                 print(
                     f"Error: host '{result.host.name}' ({result.host.hostname}): "
                     f"{reason} ({elapsed:.1f}s)",
@@ -1258,6 +5460,8 @@ class ReplSession:
         If the history file exists, attempts to read it.
         On failure (corrupt file), warns and starts with empty history.
         """
+        import readline
+
         if self.history_file.exists():
             try:
                 readline.read_history_file(str(self.history_file))
@@ -1270,6 +5474,8 @@ class ReplSession:
 
     def _save_history(self) -> None:
         """Persist readline history to file (max 1000 entries)."""
+        import readline
+
         readline.set_history_length(1000)
         try:
             readline.write_history_file(str(self.history_file))
@@ -1285,24 +5491,29 @@ class ReplSession:
         return [h for h in self.hosts if self.connected.get(h.name, False)]
 
     def _execute_command(self, command: str) -> None:
-        """Execute a command on all hosts, auto-reconnecting disconnected ones.
+        """Execute a command on all connected hosts.
 
-        Before executing, attempts to reconnect any disconnected hosts.
-        If reconnection succeeds, includes them in the command execution.
-        Detects cd commands and handles them specially via _handle_cd.
-        For all other commands, prepends cd to working directory before execution.
+        Disconnected hosts are skipped; they are reconnected in the background
+        (see `_reconnect_loop`) and rejoin once a probe succeeds.
+        With persistent shells, the command is written to each host's shell
+        as-is. Otherwise cd commands are handled specially via _handle_cd, and
+        all other commands are prefixed with cd to the working directory.
 
         Args:
             command: The command string entered by the user.
         """
-        # Auto-reconnect disconnected hosts
-        self._auto_reconnect()
-
         connected_hosts = self._get_connected_hosts()
         if not connected_hosts:
             print("Error: no connected hosts available.", file=sys.stderr)
             return
 
+        if self.persistent_shell:
+            # The remote shell keeps its own state, including cd
+            results = self._run(self._run_in_shells(connected_hosts, command))
+            self._check_connection_state(results)
+            self.formatter.format_results(results)
+            return
+
         # Detect if this is a cd command
         is_cd = self._is_cd_command(command)
 
@@ -1312,53 +5523,123 @@ class ReplSession:
             self._run_cd(cd_target, connected_hosts)
         else:
             # Regular command: run with working directory context
-            results = asyncio.run(
+            results = self._run(
                 run_command_on_all(
                     hosts=connected_hosts,
                     command=command,
                     working_dirs=self.working_dirs,
                     timeout=self.timeout,
                     connection_timeout=self.connection_timeout,
+                    pool=self.pool,
+                    forks=self.forks,
+                    transport=self.transport,
                 )
             )
             # Check for connection drops
             self._check_connection_state(results)
             self.formatter.format_results(results)
 
-    def _auto_reconnect(self) -> None:
-        """Silently attempt to reconnect any disconnected hosts.
+    async def _probe_hosts(self, hosts: list[HostDefinition]) -> list[CommandResult]:
+        """Re-establish connections to the given hosts and verify them.
 
-        On success, marks the host as connected and prints a notice.
-        On failure, prints a warning with the host name and reason.
+        With persistent shells, a fresh shell is opened per host and checked
+        with a no-op command; otherwise masters are re-established (if pooled)
+        and `echo ok` is run.
         """
-        disconnected = [
-            h for h in self.hosts
-            if not self.connected.get(h.name, False)
-        ]
-        if not disconnected:
-            return
-
-        results = asyncio.run(
-            run_command_on_all(
-                hosts=disconnected,
-                command="echo ok",
-                timeout=self.timeout,
-                connection_timeout=self.connection_timeout,
-            )
+        if self.persistent_shell:
+            return await _bounded_map(self._open_shell, hosts, self.forks)
+        started: dict[str, float] = {}
+        if self.pool is not None:
+
+            async def ensure(host: HostDefinition) -> None:
+                started[host.name] = time.time()
+                async with self._connect_lock(host):
+                    await self.pool.ensure(host)
+
+            await _bounded_map(ensure, hosts, self.forks)
+        results = await run_command_on_all(
+            hosts=hosts,
+            command="echo ok",
+            timeout=self.timeout,
+            connection_timeout=self.connection_timeout,
+            pool=self.pool,
+            forks=self.forks,
+            transport=self.transport,
         )
+        # Time from the start of this host's probe, including its master
         for result in results:
-            if result.exit_code == 0 and not result.error and not result.timed_out:
-                self.connected[result.host.name] = True
-                print(
-                    f"  [{result.host.name}] reconnected",
-                    file=sys.stderr,
-                )
-            else:
-                reason = _format_connection_failure(result)
-                print(
-                    f"  [{result.host.name}] still disconnected: {reason}",
-                    file=sys.stderr,
+            result.timing.started = started.get(result.host.name, result.timing.started)
+        return results
+
+    def _connect_lock(self, host: HostDefinition) -> asyncio.Lock:
+        """The lock serializing reconnects of host."""
+        return self._connect_locks.setdefault(host.name, asyncio.Lock())
+
+    async def _open_shell(self, host: HostDefinition) -> CommandResult:
+        """Start (or restart) the persistent shell for a host.
+
+        Concurrent calls for the same host run one after the other, and each
+        closes the shell it replaces, so no shell is ever leaked.
+
+        Returns:
+            The result of a no-op command run in the new shell.
+        """
+        async with self._connect_lock(host):
+            return await self._replace_shell(host)
+
+    async def _replace_shell(self, host: HostDefinition) -> CommandResult:
+        old_shell = self.shells.pop(host.name, None)
+        if old_shell is not None:
+            await old_shell.close()
+
+        started = time.time()
+        transport = self.transport or SubprocessTransport(self.pool)
+        try:
+            shell = await transport.open_shell(host, self.connection_timeout)
+        except OSError as e:
+            return CommandResult(
+                host=host,
+                stdout="",
+                stderr="",
+                exit_code=1,
+                error=str(e),
+                timing=HostTiming(started=started, finished=time.time()),
+            )
+
+        result = await shell.run(":", self.connection_timeout + self.timeout)
+        result.timing = HostTiming(started=started, finished=time.time())
+        if result.exit_code == 0 and not result.error and not result.timed_out:
+            replaced = self.shells.get(host.name)
+            self.shells[host.name] = shell
+            if replaced is not None:
+                await replaced.close()
+            if shell.cwd:
+                self.working_dirs[host.name] = shell.cwd
+        else:
+            await shell.close()
+        return result
+
+    async def _run_in_shells(
+        self, hosts: list[HostDefinition], command: str
+    ) -> list[CommandResult]:
+        """Run a command in each host's persistent shell, tracking its cwd."""
+
+        async def run_one(host: HostDefinition) -> CommandResult:
+            shell = self.shells.get(host.name)
+            if shell is None:
+                return CommandResult(
+                    host=host,
+                    stdout="",
+                    stderr="",
+                    exit_code=255,
+                    error="remote shell closed",
                 )
+            result = await shell.run(command, self.timeout)
+            if shell.cwd:
+                self.working_dirs[host.name] = shell.cwd
+            return result
+
+        return await _bounded_map(run_one, hosts, self.forks)
 
     def _is_cd_command(self, command: str) -> bool:
         """Check if a command is a cd command.
@@ -1370,7 +5651,11 @@ class ReplSession:
             True if the command is a cd invocation.
         """
         stripped = command.strip()
-        return stripped == "cd" or stripped.startswith("cd ") or stripped.startswith("cd\t")
+        return (
+            stripped == "cd"
+            or stripped.startswith("cd ")
+            or stripped.startswith("cd\t")
+        )
 
     def _extract_cd_target(self, command: str) -> str:
         """Extract the target directory from a cd command.
@@ -1404,13 +5689,16 @@ class ReplSession:
             # cd with no argument: go to home directory
             cd_command = "cd && pwd"
 
-        results = asyncio.run(
+        results = self._run(
             run_command_on_all(
                 hosts=connected_hosts,
                 command=cd_command,
                 working_dirs=self.working_dirs,
                 timeout=self.timeout,
                 connection_timeout=self.connection_timeout,
+                pool=self.pool,
+                forks=self.forks,
+                transport=self.transport,
             )
         )
 
@@ -1475,8 +5763,7 @@ class ReplSession:
                     result.exit_code == 255
                     and result.stderr
                     and any(
-                        err in result.stderr.lower()
-                        for err in _SSH_CONNECTION_ERRORS
+                        err in result.stderr.lower() for err in _SSH_CONNECTION_ERRORS
                     )
                 )
             )
@@ -1484,6 +5771,7 @@ class ReplSession:
                 if self.connected.get(result.host.name, False):
                     self.connected[result.host.name] = False
                     reason = _format_connection_failure(result)
+                    self.reconnect.record_failure(result.host.name, reason)
                     print(
                         f"Error: host '{result.host.name}' disconnected: {reason}",
                         file=sys.stderr,
@@ -1514,6 +5802,219 @@ def _format_connection_failure(result: CommandResult) -> str:
 
 app = typer.Typer(help="Execute commands on multiple remote hosts via SSH.")
 
+# Options are defined here and used by name in main's signature (see the coding standards)
+_INVENTORY_OPTION = typer.Option(
+    [],
+    "--inventory",
+    help="Inventory source: exec:COMMAND (prints JSON), file:PATH (.json/.yaml/plain) or py:MODULE:FUNCTION.",
+)
+
+_INVENTORY_TTL_OPTION = typer.Option(
+    _DEFAULT_INVENTORY_TTL,
+    "--inventory-ttl",
+    help="Seconds an inventory result is fresh; stale results are used while refreshing in the background.",
+)
+
+_MAX_HOSTS_OPTION = typer.Option(
+    _MAX_HOST_FILE_ENTRIES,
+    "--max-hosts",
+    help="Maximum number of entries accepted from a host file or inventory source.",
+)
+
+_SELECT_OPTION = typer.Option(
+    [],
+    "--select",
+    help="Config hosts matching a label expression, e.g. 'web and region=eu-* not canary'.",
+)
+
+_VIA_OPTION = typer.Option(
+    None,
+    "--via",
+    help="Bastion ([user@]host[:port]) to reach --hosts and --host-file hosts through.",
+)
+
+_FORKS_OPTION = typer.Option(
+    _DEFAULT_FORKS,
+    "--forks",
+    "-j",
+    help="Maximum number of hosts to run on concurrently.",
+)
+
+_BASTION_FORKS_OPTION = typer.Option(
+    _DEFAULT_BASTION_FORKS,
+    "--bastion-forks",
+    help="Maximum number of hosts to run on concurrently behind each bastion.",
+)
+
+_BATCH_SIZE_OPTION = typer.Option(
+    None,
+    "--batch-size",
+    help="Run in rolling batches of N hosts or N% of hosts.",
+)
+
+_BATCH_PAUSE_OPTION = typer.Option(
+    0.0,
+    "--batch-pause",
+    help="Seconds to wait between batches.",
+)
+
+_CANARY_OPTION = typer.Option(
+    0,
+    "--canary",
+    help="Run this many hosts first and stop if any of them fail.",
+)
+
+_MAX_FAILURES_OPTION = typer.Option(
+    None,
+    "--max-failures",
+    help="Skip the remaining hosts once more than N hosts have failed.",
+)
+
+_MAX_FAIL_PERCENT_OPTION = typer.Option(
+    None,
+    "--max-fail-percent",
+    help="Skip the remaining hosts once more than N% of hosts have failed.",
+)
+
+_PUSH_OPTION = typer.Option(
+    None,
+    "--push",
+    help="Upload this local file to every host (then run COMMAND, if given).",
+)
+
+_DEST_OPTION = typer.Option(
+    None,
+    "--dest",
+    help="Remote path for --push (a trailing / means a directory). Defaults to the file name in the remote home.",
+)
+
+_RELAY_OPTION = typer.Option(
+    False,
+    "--relay",
+    help="With --push, let hosts that already have the file forward it to others (needs agent forwarding).",
+)
+
+_SCRIPT_OPTION = typer.Option(
+    None,
+    "--script",
+    help="Upload this local script to a temporary file on every host and run it; COMMAND words become its arguments.",
+)
+
+_BROADCAST_STDIN_OPTION = typer.Option(
+    False,
+    "--stdin/--no-stdin",
+    help="Stream local stdin to every host's command.",
+)
+
+_MAX_OUTPUT_OPTION = typer.Option(
+    None,
+    "--max-output",
+    help="Keep at most this much of each host's stdout/stderr in memory (head and tail, e.g. 1M).",
+)
+
+_OUTPUT_DIR_OPTION = typer.Option(
+    None,
+    "--output-dir",
+    help="Write each host's full output to DIR/<host>.stdout and DIR/<host>.stderr.",
+)
+
+_RETRIES_OPTION = typer.Option(
+    0,
+    "--retries",
+    help="Retry hosts whose connection was refused, timed out or reset up to N times, with exponential backoff.",
+)
+
+_RETRY_DELAY_OPTION = typer.Option(
+    1.0,
+    "--retry-delay",
+    help="Seconds before the first retry (doubled for each further retry, up to 30).",
+)
+
+_RETRY_FAILED_OPTION = typer.Option(
+    False,
+    "--retry-failed",
+    help=(
+        "Run only on the hosts that failed in the previous run recorded with --history, --retries or"
+        " --retry-failed (of those given, if any); COMMAND defaults to the previous one."
+    ),
+)
+
+_WATCH_OPTION = typer.Option(
+    None,
+    "--watch",
+    help="Rerun COMMAND every N seconds over the same connections, showing only hosts whose output changed.",
+)
+
+_STREAM_OPTION = typer.Option(
+    False,
+    "--stream",
+    help="Print each host's output as soon as it completes (live lines when piped).",
+)
+
+_STATS_OPTION = typer.Option(
+    False,
+    "--stats",
+    help=(
+        "Print execution statistics (throughput, latency percentiles, slowest hosts) to stderr."
+        " To time the connection, a printf to stderr runs before COMMAND (needs a POSIX login shell)."
+    ),
+)
+
+_HISTORY_OPTION = typer.Option(
+    None,
+    "--history/--no-history",
+    help=(
+        "Record per-host latency and the failed hosts (for --retry-failed) under ~/.local/state/ssh-tool,"
+        " and start historically slow hosts first. --no-history writes nothing there."
+    ),
+)
+
+_ADAPTIVE_TIMEOUT_OPTION = typer.Option(
+    False,
+    "--adaptive-timeout",
+    help="Derive each host's timeout from its latency history (--timeout is the upper bound; implies --history).",
+)
+
+_TRACE_FILE_OPTION = typer.Option(
+    None,
+    "--trace-file",
+    help=(
+        "Write per-host phase timings to this file in Chrome trace-event format"
+        " (runs a printf before COMMAND, as for --stats)."
+    ),
+)
+
+_OUTPUT_FORMAT_OPTION = typer.Option(
+    "text",
+    "--format",
+    help="Output format: text, or jsonl (one JSON object per host as it completes).",
+)
+
+_AGGREGATE_OPTION = typer.Option(
+    False,
+    "--aggregate",
+    "-a",
+    help="Print identical outputs once with a compact list of the hosts that produced them.",
+)
+
+_ENGINE_OPTION = typer.Option(
+    "ssh",
+    "--engine",
+    help="SSH engine: ssh (fork the ssh binary) or asyncssh (in-process).",
+)
+
+_PERSISTENT_SHELL_OPTION = typer.Option(
+    True,
+    "--persistent-shell/--no-persistent-shell",
+    help="In REPL mode, run commands in one long-lived remote shell per host.",
+)
+
+_MULTIPLEX_OPTION = typer.Option(
+    True,
+    "--multiplex/--no-multiplex",
+    help="In REPL mode, keep one ControlMaster connection per host and reuse it for every command.",
+)
+
 
 @app.command()
 def main(
@@ -1533,6 +6034,9 @@ def main(
         "-f",
         help="File containing host list (one per line).",
     ),
+    inventory: list[str] = _INVENTORY_OPTION,
+    inventory_ttl: float = _INVENTORY_TTL_OPTION,
+    max_hosts: int = _MAX_HOSTS_OPTION,
     config: Path = typer.Option(
         None,
         "--config",
@@ -1545,12 +6049,14 @@ def main(
         "-g",
         help="Host group names from config to target.",
     ),
+    select: list[str] = _SELECT_OPTION,
     user: str = typer.Option(
         None,
         "--user",
         "-u",
         help="SSH username.",
     ),
+    via: str = _VIA_OPTION,
     identity: Path = typer.Option(
         None,
         "--identity",
@@ -1580,11 +6086,39 @@ def main(
         "-s",
         help="Execute commands sequentially instead of concurrently.",
     ),
+    forks: int = _FORKS_OPTION,
+    bastion_forks: int = _BASTION_FORKS_OPTION,
+    batch_size: str = _BATCH_SIZE_OPTION,
+    batch_pause: float = _BATCH_PAUSE_OPTION,
+    canary: int = _CANARY_OPTION,
+    max_failures: int = _MAX_FAILURES_OPTION,
+    max_fail_percent: float = _MAX_FAIL_PERCENT_OPTION,
+    push: Path = _PUSH_OPTION,
+    dest: str = _DEST_OPTION,
+    relay: bool = _RELAY_OPTION,
+    script: Path = _SCRIPT_OPTION,
+    broadcast_stdin: bool = _BROADCAST_STDIN_OPTION,
+    max_output: str = _MAX_OUTPUT_OPTION,
+    output_dir: Path = _OUTPUT_DIR_OPTION,
+    retries: int = _RETRIES_OPTION,
+    retry_delay: float = _RETRY_DELAY_OPTION,
+    retry_failed: bool = _RETRY_FAILED_OPTION,
+    watch: float = _WATCH_OPTION,
+    stream: bool = _STREAM_OPTION,
+    stats: bool = _STATS_OPTION,
+    history: bool = _HISTORY_OPTION,
+    adaptive_timeout: bool = _ADAPTIVE_TIMEOUT_OPTION,
+    trace_file: Path = _TRACE_FILE_OPTION,
     color: str = typer.Option(
         "auto",
         "--color",
         help="Color mode: always, never, or auto.",
     ),
+    output_format: str = _OUTPUT_FORMAT_OPTION,
+    aggregate: bool = _AGGREGATE_OPTION,
+    engine: str = _ENGINE_OPTION,
+    persistent_shell: bool = _PERSISTENT_SHELL_OPTION,
+    multiplex: bool = _MULTIPLEX_OPTION,
 ) -> None:
     """Execute commands on multiple remote hosts via SSH."""
     # Validate --color option
@@ -1595,6 +6129,25 @@ def main(
         )
         raise SystemExit(1)
 
+    # Validate --format option
+    if output_format not in ("text", "jsonl"):
+        print(
+            f"Error: invalid --format value '{output_format}': must be text or jsonl",
+            file=sys.stderr,
+        )
+        raise SystemExit(1)
+    if output_format == "jsonl" and aggregate:
+        print("Error: --aggregate cannot be used with --format jsonl", file=sys.stderr)
+        raise SystemExit(1)
+
+    # Validate --engine option
+    if engine not in ("ssh", "asyncssh"):
+        print(
+            f"Error: invalid --engine value '{engine}': must be ssh or asyncssh",
+            file=sys.stderr,
+        )
+        raise SystemExit(1)
+
     # Validate port range
     if not validate_port(port):
         print(
@@ -1603,6 +6156,145 @@ def main(
         )
         raise SystemExit(1)
 
+    if max_hosts < 1:
+        print(
+            f"Error: invalid --max-hosts value {max_hosts}: must be at least 1",
+            file=sys.stderr,
+        )
+        raise SystemExit(1)
+
+    # Validate concurrency limit
+    if forks < 1:
+        print(
+            f"Error: invalid --forks value {forks}: must be at least 1",
+            file=sys.stderr,
+        )
+        raise SystemExit(1)
+    if bastion_forks < 1:
+        print(
+            f"Error: invalid --bastion-forks value {bastion_forks}: must be at least 1",
+            file=sys.stderr,
+        )
+        raise SystemExit(1)
+
+    bastion: HostDefinition | None = None
+    if via is not None:
+        try:
+            bastion = parse_bastion(via)
+        except ValidationError as e:
+            print(f"Error: {e}", file=sys.stderr)
+            raise SystemExit(1)
+
+    # Validate retry options
+    retry: RetryPolicy | None = None
+    for name, value in (("--retries", retries), ("--retry-delay", retry_delay)):
+        if value < 0:
+            print(
+                f"Error: invalid {name} value {value}: must not be negative",
+                file=sys.stderr,
+            )
+            raise SystemExit(1)
+    if retries:
+        retry = RetryPolicy(attempts=retries, base_delay=retry_delay)
+
+    # Validate watch mode options
+    if watch is not None:
+        if watch <= 0:
+            print(
+                f"Error: invalid --watch value {watch}: must be positive",
+                file=sys.stderr,
+            )
+            raise SystemExit(1)
+        for name, used in (
+            ("--push", push is not None),
+            ("--script", script is not None),
+            ("--stdin", broadcast_stdin),
+            ("--stream", stream),
+            ("--aggregate", aggregate),
+            ("--retry-failed", retry_failed),
+        ):
+            if used:
+                print(f"Error: --watch cannot be combined with {name}", file=sys.stderr)
+                raise SystemExit(1)
+        if not command:
+            print("Error: --watch requires a COMMAND", file=sys.stderr)
+            raise SystemExit(1)
+
+    # Validate rolling execution options
+    batch: BatchPolicy | None = None
+    if (
+        batch_size is not None
+        or batch_pause
+        or canary
+        or max_failures is not None
+        or max_fail_percent is not None
+    ):
+        size, percent = None, None
+        if batch_size is not None:
+            try:
+                size, percent = parse_batch_size(batch_size)
+            except ValidationError as e:
+                print(f"Error: {e}", file=sys.stderr)
+                raise SystemExit(1)
+        for name, value in (
+            ("--batch-pause", batch_pause),
+            ("--canary", canary),
+            ("--max-failures", max_failures),
+            ("--max-fail-percent", max_fail_percent),
+        ):
+            if value is not None and value < 0:
+                print(
+                    f"Error: invalid {name} value {value}: must not be negative",
+                    file=sys.stderr,
+                )
+                raise SystemExit(1)
+        batch = BatchPolicy(
+            size=size,
+            percent=percent,
+            pause=batch_pause,
+            canary=canary,
+            max_failures=max_failures,
+            max_fail_percent=max_fail_percent,
+        )
+
+    # Validate file distribution options
+    for option, path in (("--push", push), ("--script", script)):
+        if path is not None and not path.is_file():
+            print(f"Error: {option} '{path}': No such file", file=sys.stderr)
+            raise SystemExit(1)
+    if push is not None and script is not None:
+        print("Error: --push and --script cannot be used together", file=sys.stderr)
+        raise SystemExit(1)
+    if broadcast_stdin and (push is not None or script is not None):
+        print(
+            "Error: --stdin cannot be combined with --push or --script", file=sys.stderr
+        )
+        raise SystemExit(1)
+    if (dest is not None or relay) and push is None:
+        print("Error: --dest and --relay require --push", file=sys.stderr)
+        raise SystemExit(1)
+
+    # Validate output capture options
+    capture: CaptureLimits | None = None
+    if max_output is not None or output_dir is not None:
+        max_bytes = None
+        if max_output is not None:
+            try:
+                max_bytes = parse_size(max_output)
+            except ValidationError as e:
+                print(f"Error: --max-output: {e}", file=sys.stderr)
+                raise SystemExit(1)
+        if output_dir is not None:
+            try:
+                output_dir.mkdir(parents=True, exist_ok=True)
+            except OSError as e:
+                print(
+                    f"Error: output directory '{output_dir}': {e.strerror}",
+                    file=sys.stderr,
+                )
+                raise SystemExit(1)
+        capture = CaptureLimits(max_bytes=max_bytes, output_dir=output_dir)
+
     # Validate identity file if provided
     if identity is not None:
         if not identity.exists():
@@ -1636,7 +6328,7 @@ def main(
 
     if config_path is not None:
         try:
-            loaded_config = load_config(config_path)
+            loaded_config = InventoryCache().load(config_path)
         except ConfigError as e:
             print(f"Error: {e}", file=sys.stderr)
             raise SystemExit(1)
@@ -1651,7 +6343,7 @@ def main(
     file_hostnames: list[str] = []
     if host_file is not None:
         try:
-            file_hostnames = parse_host_file(host_file)
+            file_hostnames = parse_host_file(host_file, max_hosts)
         except ValidationError as e:
             print(f"Error: {e}", file=sys.stderr)
             raise SystemExit(1)
@@ -1659,7 +6351,21 @@ def main(
     # Merge and deduplicate CLI + file hosts, then add to registry
     merged = merge_hosts(cli_hostnames, file_hostnames)
     identity_str = str(identity) if identity else None
-    registry.add_from_cli(merged, user=user, port=port, identity_file=identity_str)
+    registry.add_from_cli(
+        merged, user=user, port=port, identity_file=identity_str, via=bastion
+    )
+
+    # Add hosts from inventory sources
+    if inventory:
+        results_cache = InventoryResultCache(ttl=inventory_ttl)
+        try:
+            for spec in inventory:
+                registry.add_from_inventory(
+                    results_cache.load(make_inventory(spec), max_hosts)
+                )
+        except ValidationError as e:
+            print(f"Error: {e}", file=sys.stderr)
+            raise SystemExit(1)
 
     # Add hosts from config groups
     if group and loaded_config is not None:
@@ -1675,24 +6381,131 @@ def main(
         )
         raise SystemExit(1)
 
+    # Add hosts matched by label expressions
+    if select and loaded_config is not None:
+        try:
+            registry.add_from_selection(loaded_config, select)
+        except (ConfigError, ValidationError) as e:
+            print(f"Error: {e}", file=sys.stderr)
+            raise SystemExit(1)
+    elif select and loaded_config is None:
+        print("Error: --select requires --config to be specified", file=sys.stderr)
+        raise SystemExit(1)
+
     # Deduplicate
     registry.deduplicate()
 
     # Validate at least one host was resolved
     resolved_hosts = registry.all_hosts()
+    # State under ~/.local/state/ssh-tool is only written when asked for
+    record_latency = history if history is not None else adaptive_timeout
+    record_run = history if history is not None else bool(retries or retry_failed)
+    results_store = LastRunStore()
+    if retry_failed:
+        last = results_store.load()
+        if last is None:
+            print("Error: --retry-failed: no previous run recorded", file=sys.stderr)
+            raise SystemExit(1)
+        if resolved_hosts:
+            wanted = {host.name for host in resolved_hosts}
+            resolved_hosts = [host for host in last.failed if host.name in wanted]
+        else:
+            resolved_hosts = last.failed
+        if not resolved_hosts:
+            print("No hosts failed in the last run", file=sys.stderr)
+            raise SystemExit(0)
+        if not command and push is None and script is None:
+            if last.stdin:
+                print(
+                    "Error: --retry-failed: the last command read stdin; give the command again",
+                    file=sys.stderr,
+                )
+                raise SystemExit(1)
+            command = [last.command]
     if not resolved_hosts:
         print(
-            "Error: no hosts specified. Use --hosts, --host-file, or --config with --group.",
+            "Error: no hosts specified. Use --hosts, --host-file, --inventory, or --config with --group or --select.",
             file=sys.stderr,
         )
         raise SystemExit(1)
 
     # Create OutputFormatter
-    formatter = OutputFormatter(color=color)
+    formatter = OutputFormatter(
+        color=color, aggregate=aggregate, output_format=output_format
+    )
+
+    # Create the transport (the default ssh engine forks ssh per command)
+    transport: Transport | None = None
+    if engine != "ssh":
+        try:
+            transport = make_transport(engine, forward_agent=relay)
+        except ValidationError as e:
+            print(f"Error: {e}", file=sys.stderr)
+            raise SystemExit(1)
+
+    # File distribution turns the command into an upload (plus optional run)
+    stdin: InputSource | None = None
+    command_str = " ".join(command) if command else ""
+    if push is not None:
+        push_dest = resolve_push_dest(push, dest)
+        if relay:
+            exit_code = run_relay_mode(
+                hosts=resolved_hosts,
+                local=push,
+                dest=push_dest,
+                command=command_str or None,
+                formatter=formatter,
+                timeout=timeout,
+                connection_timeout=connect_timeout,
+                forks=forks,
+                transport=transport or SubprocessTransport(forward_agent=True),
+            )
+            sys.exit(exit_code)
+        command_str = build_push_command(
+            push_dest, stat.S_IMODE(push.stat().st_mode), command_str or None
+        )
+        stdin = FileInput(push)
+    elif script is not None:
+        command_str = build_script_command(list(command or []))
+        stdin = FileInput(script)
+    elif command_str and broadcast_stdin:
+        # Hosts that start once the head of the input has left memory
+        # (queued, in a later batch, behind a bastion or retried) replay it
+        # from a spool file
+        stdin = BroadcastInput(
+            sys.stdin.buffer,
+            spool=(
+                sequential
+                or batch is not None
+                or retry is not None
+                or len(resolved_hosts) > forks
+                or any(host.via is not None for host in resolved_hosts)
+            ),
+        )
 
-    # Route to immediate mode or REPL mode
-    if command:
-        command_str = " ".join(command)
+    # Route to watch mode, immediate mode or REPL mode
+    if watch is not None:
+        exit_code = run_watch_mode(
+            hosts=resolved_hosts,
+            command=command_str,
+            formatter=formatter,
+            interval=watch,
+            timeout=timeout,
+            connection_timeout=connect_timeout,
+            sequential=sequential,
+            forks=forks,
+            transport=transport,
+            # Masters kept open for the whole watch
+            pool=ConnectionPool(connect_timeout) if transport is None else None,
+            batch=batch,
+            retry=retry,
+            bastion_forks=bastion_forks,
+        )
+        sys.exit(exit_code)
+    if command_str:
+        if transport is None and any(host.via is not None for host in resolved_hosts):
+            # One master per bastion, shared by every host behind it
+            transport = SubprocessTransport(bastions=ConnectionPool(connect_timeout))
         exit_code = run_immediate_mode(
             hosts=resolved_hosts,
             command=command_str,
@@ -1700,6 +6513,19 @@ def main(
             timeout=timeout,
             connection_timeout=connect_timeout,
             sequential=sequential,
+            forks=forks,
+            show_stats=stats,
+            stream=stream,
+            transport=transport,
+            batch=batch,
+            capture=capture,
+            trace_file=trace_file,
+            history=LatencyStore() if record_latency else None,
+            adaptive_timeout=adaptive_timeout,
+            stdin=stdin,
+            retry=retry,
+            results_store=results_store if record_run else None,
+            bastion_forks=bastion_forks,
         )
         sys.exit(exit_code)
     else:
@@ -1708,6 +6534,12 @@ def main(
             formatter=formatter,
             timeout=timeout,
             connection_timeout=connect_timeout,
+            pool=ConnectionPool(connect_timeout)
+            if multiplex and transport is None
+            else None,
+            forks=forks,
+            transport=transport,
+            persistent_shell=persistent_shell,
         )
         exit_code = session.run()
         sys.exit(exit_code)
@@ -460,59 +460,35 @@ class TestLoadConfig:
     def test_missing_hostname_raises_config_error(self, tmp_path):
         """A host without 'hostname' raises ConfigError."""
         f = tmp_path / "config.yaml"
-        f.write_text(
-            "hosts:\n"
-            "  broken:\n"
-            "    user: deploy\n"
-            "    port: 22\n"
-        )
+        f.write_text("hosts:\n  broken:\n    user: deploy\n    port: 22\n")
         with pytest.raises(ConfigError, match="missing required field 'hostname'"):
             load_config(f)
 
     def test_empty_hostname_raises_config_error(self, tmp_path):
         """A host with empty hostname string raises ConfigError."""
         f = tmp_path / "config.yaml"
-        f.write_text(
-            "hosts:\n"
-            "  broken:\n"
-            '    hostname: ""\n'
-        )
+        f.write_text('hosts:\n  broken:\n    hostname: ""\n')
         with pytest.raises(ConfigError, match="missing required field 'hostname'"):
             load_config(f)
 
     def test_invalid_port_zero_raises_config_error(self, tmp_path):
         """Port 0 is out of valid range."""
         f = tmp_path / "config.yaml"
-        f.write_text(
-            "hosts:\n"
-            "  badport:\n"
-            "    hostname: 192.168.1.1\n"
-            "    port: 0\n"
-        )
+        f.write_text("hosts:\n  badport:\n    hostname: 192.168.1.1\n    port: 0\n")
         with pytest.raises(ConfigError, match="invalid port 0"):
             load_config(f)
 
     def test_invalid_port_too_high_raises_config_error(self, tmp_path):
         """Port 65536 is out of valid range."""
         f = tmp_path / "config.yaml"
-        f.write_text(
-            "hosts:\n"
-            "  badport:\n"
-            "    hostname: 192.168.1.1\n"
-            "    port: 65536\n"
-        )
+        f.write_text("hosts:\n  badport:\n    hostname: 192.168.1.1\n    port: 65536\n")
         with pytest.raises(ConfigError, match="invalid port 65536"):
             load_config(f)
 
     def test_invalid_port_negative_raises_config_error(self, tmp_path):
         """Negative port is out of valid range."""
         f = tmp_path / "config.yaml"
-        f.write_text(
-            "hosts:\n"
-            "  badport:\n"
-            "    hostname: 192.168.1.1\n"
-            "    port: -1\n"
-        )
+        f.write_text("hosts:\n  badport:\n    hostname: 192.168.1.1\n    port: -1\n")
         with pytest.raises(ConfigError, match="invalid port -1"):
             load_config(f)
 
@@ -556,11 +532,7 @@ class TestLoadConfig:
     def test_hosts_only_no_groups(self, tmp_path):
         """Config with only hosts and no groups is valid."""
         f = tmp_path / "config.yaml"
-        f.write_text(
-            "hosts:\n"
-            "  web1:\n"
-            "    hostname: 10.0.0.1\n"
-        )
+        f.write_text("hosts:\n  web1:\n    hostname: 10.0.0.1\n")
         config = load_config(f)
         assert "web1" in config.hosts
         assert config.groups == {}
@@ -568,11 +540,7 @@ class TestLoadConfig:
     def test_host_default_values(self, tmp_path):
         """Hosts use correct defaults when optional fields are omitted."""
         f = tmp_path / "config.yaml"
-        f.write_text(
-            "hosts:\n"
-            "  minimal:\n"
-            "    hostname: example.com\n"
-        )
+        f.write_text("hosts:\n  minimal:\n    hostname: example.com\n")
         config = load_config(f)
         host = config.hosts["minimal"]
         assert host.name == "minimal"
@@ -584,11 +552,7 @@ class TestLoadConfig:
     def test_host_definition_name_matches_key(self, tmp_path):
         """The HostDefinition.name field matches the YAML key."""
         f = tmp_path / "config.yaml"
-        f.write_text(
-            "hosts:\n"
-            "  my-server:\n"
-            "    hostname: 10.0.0.5\n"
-        )
+        f.write_text("hosts:\n  my-server:\n    hostname: 10.0.0.5\n")
         config = load_config(f)
         assert config.hosts["my-server"].name == "my-server"
 
@@ -610,13 +574,7 @@ class TestLoadConfig:
     def test_group_with_empty_hosts_list(self, tmp_path):
         """A group with an empty hosts list is valid."""
         f = tmp_path / "config.yaml"
-        f.write_text(
-            "groups:\n"
-            "  empty:\n"
-            "    hosts: []\n"
-            "    groups:\n"
-            "      - other\n"
-        )
+        f.write_text("groups:\n  empty:\n    hosts: []\n    groups:\n      - other\n")
         config = load_config(f)
         assert config.groups["empty"].hosts == []
         assert config.groups["empty"].groups == ["other"]
@@ -724,7 +682,8 @@ class TestResolveGroup:
             groups={"webservers": {"hosts": ["web1", "web99"]}},
         )
         with pytest.raises(
-            ConfigError, match="config group 'webservers': references undefined host 'web99'"
+            ConfigError,
+            match="config group 'webservers': references undefined host 'web99'",
         ):
             resolve_group(config, "webservers")
 
@@ -742,9 +701,7 @@ class TestResolveGroup:
     def test_undefined_top_level_group_raises_config_error(self):
         """Calling resolve_group with a group name that doesn't exist raises ConfigError."""
         config = self._make_config(hosts={"h1": "1.1.1.1"}, groups={})
-        with pytest.raises(
-            ConfigError, match="references undefined group 'missing'"
-        ):
+        with pytest.raises(ConfigError, match="references undefined group 'missing'"):
             resolve_group(config, "missing")
 
     def test_deduplication_case_insensitive(self):
@@ -939,8 +896,12 @@ class TestHostRegistry:
         """add_from_config resolves groups and adds the resulting hosts."""
         config = Config(
             hosts={
-                "web1": HostDefinition(name="web1", hostname="192.168.1.10", user="deploy"),
-                "web2": HostDefinition(name="web2", hostname="192.168.1.11", user="deploy"),
+                "web1": HostDefinition(
+                    name="web1", hostname="192.168.1.10", user="deploy"
+                ),
+                "web2": HostDefinition(
+                    name="web2", hostname="192.168.1.11", user="deploy"
+                ),
                 "db1": HostDefinition(name="db1", hostname="db.example.com"),
             },
             groups={
@@ -1030,7 +991,9 @@ class TestHostRegistry:
         """all_hosts returns whatever is currently in the registry."""
         registry = HostRegistry()
         assert registry.all_hosts() == []
-        registry.add_from_cli(hostnames=["host1"], user=None, port=22, identity_file=None)
+        registry.add_from_cli(
+            hostnames=["host1"], user=None, port=22, identity_file=None
+        )
         assert len(registry.all_hosts()) == 1
 
     def test_merge_cli_and_config_hosts_with_dedup(self):
@@ -1077,7 +1040,9 @@ class TestHostRegistry:
             groups={
                 "webservers": HostGroup(name="webservers", hosts=["web1", "web2"]),
                 "databases": HostGroup(name="databases", hosts=["db1"]),
-                "all": HostGroup(name="all", hosts=[], groups=["webservers", "databases"]),
+                "all": HostGroup(
+                    name="all", hosts=[], groups=["webservers", "databases"]
+                ),
             },
         )
         registry = HostRegistry()
@@ -1104,9 +1069,12 @@ class TestBuildSshArgs:
         result = build_ssh_args(host, connection_timeout=10.0)
         assert result == [
             "ssh",
-            "-o", "ConnectTimeout=10",
-            "-o", "BatchMode=yes",
-            "-o", "StrictHostKeyChecking=accept-new",
+            "-o",
+            "ConnectTimeout=10",
+            "-o",
+            "BatchMode=yes",
+            "-o",
+            "StrictHostKeyChecking=accept-new",
             "192.168.1.10",
         ]
 
@@ -1116,9 +1084,12 @@ class TestBuildSshArgs:
         result = build_ssh_args(host, connection_timeout=10.0)
         assert result == [
             "ssh",
-            "-o", "ConnectTimeout=10",
-            "-o", "BatchMode=yes",
-            "-o", "StrictHostKeyChecking=accept-new",
+            "-o",
+            "ConnectTimeout=10",
+            "-o",
+            "BatchMode=yes",
+            "-o",
+            "StrictHostKeyChecking=accept-new",
             "deploy@192.168.1.10",
         ]
 
@@ -1128,10 +1099,14 @@ class TestBuildSshArgs:
         result = build_ssh_args(host, connection_timeout=10.0)
         assert result == [
             "ssh",
-            "-o", "ConnectTimeout=10",
-            "-o", "BatchMode=yes",
-            "-o", "StrictHostKeyChecking=accept-new",
-            "-p", "2222",
+            "-o",
+            "ConnectTimeout=10",
+            "-o",
+            "BatchMode=yes",
+            "-o",
+            "StrictHostKeyChecking=accept-new",
+            "-p",
+            "2222",
             "db.example.com",
         ]
 
@@ -1149,10 +1124,14 @@ class TestBuildSshArgs:
         result = build_ssh_args(host, connection_timeout=10.0)
         assert result == [
             "ssh",
-            "-o", "ConnectTimeout=10",
-            "-o", "BatchMode=yes",
-            "-o", "StrictHostKeyChecking=accept-new",
-            "-i", "/home/user/.ssh/id_rsa",
+            "-o",
+            "ConnectTimeout=10",
+            "-o",
+            "BatchMode=yes",
+            "-o",
+            "StrictHostKeyChecking=accept-new",
+            "-i",
+            "/home/user/.ssh/id_rsa",
             "192.168.1.10",
         ]
 
@@ -1168,11 +1147,16 @@ class TestBuildSshArgs:
         result = build_ssh_args(host, connection_timeout=15.0)
         assert result == [
             "ssh",
-            "-o", "ConnectTimeout=15",
-            "-o", "BatchMode=yes",
-            "-o", "StrictHostKeyChecking=accept-new",
-            "-p", "2222",
-            "-i", "~/.ssh/id_deploy",
+            "-o",
+            "ConnectTimeout=15",
+            "-o",
+            "BatchMode=yes",
+            "-o",
+            "StrictHostKeyChecking=accept-new",
+            "-p",
+            "2222",
+            "-i",
+            "~/.ssh/id_deploy",
             "deploy@192.168.1.10",
         ]
 
@@ -1206,8 +1190,11 @@ class TestBuildSshArgs:
     def test_hostname_is_last_element(self):
         """The target (user@host or just host) is always the last element."""
         host = HostDefinition(
-            name="web1", hostname="10.0.0.1", user="admin", port=3333,
-            identity_file="/key"
+            name="web1",
+            hostname="10.0.0.1",
+            user="admin",
+            port=3333,
+            identity_file="/key",
         )
         result = build_ssh_args(host, connection_timeout=10.0)
         assert result[-1] == "admin@10.0.0.1"
@@ -1284,9 +1271,20 @@ CommandResult = ssh_tool.CommandResult
 class TestRunCommandOnHost:
     """Tests for async SSH runner using mocked subprocess."""
 
-    def _make_host(self, name="web1", hostname="192.168.1.10", user="deploy", port=22, identity_file=None):
+    def _make_host(
+        self,
+        name="web1",
+        hostname="192.168.1.10",
+        user="deploy",
+        port=22,
+        identity_file=None,
+    ):
         return HostDefinition(
-            name=name, hostname=hostname, user=user, port=port, identity_file=identity_file
+            name=name,
+            hostname=hostname,
+            user=user,
+            port=port,
+            identity_file=identity_file,
         )
 
     def _make_mock_process(self, stdout=b"", stderr=b"", returncode=0):
@@ -1305,7 +1303,11 @@ class TestRunCommandOnHost:
             stdout=b"hello world\n", stderr=b"", returncode=0
         )
 
-        with patch("asyncio.create_subprocess_exec", new_callable=AsyncMock, return_value=mock_proc):
+        with patch(
+            "asyncio.create_subprocess_exec",
+            new_callable=AsyncMock,
+            return_value=mock_proc,
+        ):
             result = asyncio.run(run_command_on_host(host, "echo hello world"))
 
         assert result.host == host
@@ -1322,7 +1324,11 @@ class TestRunCommandOnHost:
             stdout=b"output\n", stderr=b"warning: something\n", returncode=0
         )
 
-        with patch("asyncio.create_subprocess_exec", new_callable=AsyncMock, return_value=mock_proc):
+        with patch(
+            "asyncio.create_subprocess_exec",
+            new_callable=AsyncMock,
+            return_value=mock_proc,
+        ):
             result = asyncio.run(run_command_on_host(host, "some-command"))
 
         assert result.stdout == "output\n"
@@ -1336,7 +1342,11 @@ class TestRunCommandOnHost:
             stdout=b"", stderr=b"error: not found\n", returncode=127
         )
 
-        with patch("asyncio.create_subprocess_exec", new_callable=AsyncMock, return_value=mock_proc):
+        with patch(
+            "asyncio.create_subprocess_exec",
+            new_callable=AsyncMock,
+            return_value=mock_proc,
+        ):
             result = asyncio.run(run_command_on_host(host, "nonexistent-cmd"))
 
         assert result.exit_code == 127
@@ -1351,10 +1361,12 @@ class TestRunCommandOnHost:
         mock_proc.kill = MagicMock()
         mock_proc.wait = AsyncMock()
 
-        with patch("asyncio.create_subprocess_exec", new_callable=AsyncMock, return_value=mock_proc):
-            result = asyncio.run(
-                run_command_on_host(host, "sleep 100", timeout=1.0)
-            )
+        with patch(
+            "asyncio.create_subprocess_exec",
+            new_callable=AsyncMock,
+            return_value=mock_proc,
+        ):
+            result = asyncio.run(run_command_on_host(host, "sleep 100", timeout=1.0))
 
         assert result.timed_out is True
         assert result.exit_code == 1
@@ -1383,10 +1395,12 @@ class TestRunCommandOnHost:
         host = self._make_host()
         mock_proc = self._make_mock_process(stdout=b"/var/log\n", returncode=0)
 
-        with patch("asyncio.create_subprocess_exec", new_callable=AsyncMock, return_value=mock_proc) as mock_exec:
-            asyncio.run(
-                run_command_on_host(host, "pwd", working_dir="/var/log")
-            )
+        with patch(
+            "asyncio.create_subprocess_exec",
+            new_callable=AsyncMock,
+            return_value=mock_proc,
+        ) as mock_exec:
+            asyncio.run(run_command_on_host(host, "pwd", working_dir="/var/log"))
 
         # Check that the remote command arg (last positional arg) includes cd prefix
         call_args = mock_exec.call_args[0]
@@ -1398,7 +1412,11 @@ class TestRunCommandOnHost:
         host = self._make_host()
         mock_proc = self._make_mock_process(stdout=b"ok\n", returncode=0)
 
-        with patch("asyncio.create_subprocess_exec", new_callable=AsyncMock, return_value=mock_proc) as mock_exec:
+        with patch(
+            "asyncio.create_subprocess_exec",
+            new_callable=AsyncMock,
+            return_value=mock_proc,
+        ) as mock_exec:
             asyncio.run(run_command_on_host(host, "uptime"))
 
         call_args = mock_exec.call_args[0]
@@ -1407,15 +1425,20 @@ class TestRunCommandOnHost:
     def test_ssh_args_constructed_correctly(self):
         """Verify the full ssh argument list is passed to create_subprocess_exec."""
         host = self._make_host(
-            name="db1", hostname="db.example.com", user="admin", port=2222,
-            identity_file="/home/admin/.ssh/id_rsa"
+            name="db1",
+            hostname="db.example.com",
+            user="admin",
+            port=2222,
+            identity_file="/home/admin/.ssh/id_rsa",
         )
         mock_proc = self._make_mock_process(stdout=b"", returncode=0)
 
-        with patch("asyncio.create_subprocess_exec", new_callable=AsyncMock, return_value=mock_proc) as mock_exec:
-            asyncio.run(
-                run_command_on_host(host, "whoami", connection_timeout=15.0)
-            )
+        with patch(
+            "asyncio.create_subprocess_exec",
+            new_callable=AsyncMock,
+            return_value=mock_proc,
+        ) as mock_exec:
+            asyncio.run(run_command_on_host(host, "whoami", connection_timeout=15.0))
 
         call_args = mock_exec.call_args[0]
         # Should be: ssh -o ConnectTimeout=15 -o BatchMode=yes -p 2222 -i /home/admin/.ssh/id_rsa admin@db.example.com whoami
@@ -1452,13 +1475,18 @@ class TestRunCommandOnAll:
 
     def test_concurrent_execution_all_succeed(self):
         """Concurrent mode runs all hosts and returns results for each."""
-        hosts = [self._make_host("web1", "10.0.0.1"), self._make_host("web2", "10.0.0.2")]
+        hosts = [
+            self._make_host("web1", "10.0.0.1"),
+            self._make_host("web2", "10.0.0.2"),
+        ]
         mock_proc = self._make_mock_process(stdout=b"ok\n", returncode=0)
 
-        with patch("asyncio.create_subprocess_exec", new_callable=AsyncMock, return_value=mock_proc):
-            results = asyncio.run(
-                run_command_on_all(hosts, "echo ok")
-            )
+        with patch(
+            "asyncio.create_subprocess_exec",
+            new_callable=AsyncMock,
+            return_value=mock_proc,
+        ):
+            results = asyncio.run(run_command_on_all(hosts, "echo ok"))
 
         assert len(results) == 2
         assert all(r.exit_code == 0 for r in results)
@@ -1466,10 +1494,17 @@ class TestRunCommandOnAll:
 
     def test_sequential_execution_all_succeed(self):
         """Sequential mode runs hosts one at a time and returns results for each."""
-        hosts = [self._make_host("web1", "10.0.0.1"), self._make_host("web2", "10.0.0.2")]
+        hosts = [
+            self._make_host("web1", "10.0.0.1"),
+            self._make_host("web2", "10.0.0.2"),
+        ]
         mock_proc = self._make_mock_process(stdout=b"done\n", returncode=0)
 
-        with patch("asyncio.create_subprocess_exec", new_callable=AsyncMock, return_value=mock_proc):
+        with patch(
+            "asyncio.create_subprocess_exec",
+            new_callable=AsyncMock,
+            return_value=mock_proc,
+        ):
             results = asyncio.run(
                 run_command_on_all(hosts, "echo done", sequential=True)
             )
@@ -1486,7 +1521,11 @@ class TestRunCommandOnAll:
         ]
         mock_proc = self._make_mock_process(stdout=b"x\n", returncode=0)
 
-        with patch("asyncio.create_subprocess_exec", new_callable=AsyncMock, return_value=mock_proc):
+        with patch(
+            "asyncio.create_subprocess_exec",
+            new_callable=AsyncMock,
+            return_value=mock_proc,
+        ):
             results = asyncio.run(run_command_on_all(hosts, "echo x"))
 
         # asyncio.gather preserves order
@@ -1497,14 +1536,19 @@ class TestRunCommandOnAll:
 
     def test_working_dirs_passed_per_host(self):
         """working_dirs maps host names to their working directory."""
-        hosts = [self._make_host("web1", "10.0.0.1"), self._make_host("web2", "10.0.0.2")]
+        hosts = [
+            self._make_host("web1", "10.0.0.1"),
+            self._make_host("web2", "10.0.0.2"),
+        ]
         working_dirs = {"web1": "/var/www", "web2": "/opt/app"}
         mock_proc = self._make_mock_process(stdout=b"", returncode=0)
 
-        with patch("asyncio.create_subprocess_exec", new_callable=AsyncMock, return_value=mock_proc) as mock_exec:
-            asyncio.run(
-                run_command_on_all(hosts, "ls", working_dirs=working_dirs)
-            )
+        with patch(
+            "asyncio.create_subprocess_exec",
+            new_callable=AsyncMock,
+            return_value=mock_proc,
+        ) as mock_exec:
+            asyncio.run(run_command_on_all(hosts, "ls", working_dirs=working_dirs))
 
         # Check that different working dirs were used for each call
         calls = mock_exec.call_args_list
@@ -1519,24 +1563,31 @@ class TestRunCommandOnAll:
         hosts = [self._make_host("web1", "10.0.0.1")]
         mock_proc = self._make_mock_process(stdout=b"", returncode=0)
 
-        with patch("asyncio.create_subprocess_exec", new_callable=AsyncMock, return_value=mock_proc) as mock_exec:
-            asyncio.run(
-                run_command_on_all(hosts, "uptime", working_dirs=None)
-            )
+        with patch(
+            "asyncio.create_subprocess_exec",
+            new_callable=AsyncMock,
+            return_value=mock_proc,
+        ) as mock_exec:
+            asyncio.run(run_command_on_all(hosts, "uptime", working_dirs=None))
 
         call_args = mock_exec.call_args[0]
         assert call_args[-1] == "uptime"
 
     def test_working_dirs_host_not_in_map(self):
         """If a host is not in working_dirs, no cd prefix is used for it."""
-        hosts = [self._make_host("web1", "10.0.0.1"), self._make_host("web2", "10.0.0.2")]
+        hosts = [
+            self._make_host("web1", "10.0.0.1"),
+            self._make_host("web2", "10.0.0.2"),
+        ]
         working_dirs = {"web1": "/tmp"}  # web2 not mapped
         mock_proc = self._make_mock_process(stdout=b"", returncode=0)
 
-        with patch("asyncio.create_subprocess_exec", new_callable=AsyncMock, return_value=mock_proc) as mock_exec:
-            asyncio.run(
-                run_command_on_all(hosts, "pwd", working_dirs=working_dirs)
-            )
+        with patch(
+            "asyncio.create_subprocess_exec",
+            new_callable=AsyncMock,
+            return_value=mock_proc,
+        ) as mock_exec:
+            asyncio.run(run_command_on_all(hosts, "pwd", working_dirs=working_dirs))
 
         calls = mock_exec.call_args_list
         assert calls[0][0][-1] == "cd /tmp && pwd"
@@ -1556,10 +1607,12 @@ class TestRunCommandOnAll:
         ]
         mock_proc = self._make_mock_process(stdout=b"ok\n", returncode=0)
 
-        with patch("asyncio.create_subprocess_exec", new_callable=AsyncMock, return_value=mock_proc):
-            results = asyncio.run(
-                run_command_on_all(hosts, "echo ok", sequential=True)
-            )
+        with patch(
+            "asyncio.create_subprocess_exec",
+            new_callable=AsyncMock,
+            return_value=mock_proc,
+        ):
+            results = asyncio.run(run_command_on_all(hosts, "echo ok", sequential=True))
 
         assert results[0].host.name == "first"
         assert results[1].host.name == "second"
@@ -1573,17 +1626,22 @@ class TestRunCommandOnAll:
         mock_proc.kill = MagicMock()
         mock_proc.wait = AsyncMock()
 
-        with patch("asyncio.create_subprocess_exec", new_callable=AsyncMock, return_value=mock_proc):
-            results = asyncio.run(
-                run_command_on_all(hosts, "sleep 100", timeout=1.0)
-            )
+        with patch(
+            "asyncio.create_subprocess_exec",
+            new_callable=AsyncMock,
+            return_value=mock_proc,
+        ):
+            results = asyncio.run(run_command_on_all(hosts, "sleep 100", timeout=1.0))
 
         assert len(results) == 1
         assert results[0].timed_out is True
 
     def test_mixed_success_and_failure(self):
         """Some hosts succeed and some fail; all results are returned."""
-        hosts = [self._make_host("good", "10.0.0.1"), self._make_host("bad", "10.0.0.2")]
+        hosts = [
+            self._make_host("good", "10.0.0.1"),
+            self._make_host("bad", "10.0.0.2"),
+        ]
 
         call_count = [0]
 
@@ -1596,7 +1654,9 @@ class TestRunCommandOnAll:
                 mock_proc.returncode = 0
             else:
                 # Second host fails
-                mock_proc.communicate = AsyncMock(return_value=(b"", b"connection refused\n"))
+                mock_proc.communicate = AsyncMock(
+                    return_value=(b"", b"connection refused\n")
+                )
                 mock_proc.returncode = 255
             mock_proc.kill = MagicMock()
             mock_proc.wait = AsyncMock()
@@ -1654,7 +1714,9 @@ class TestOutputFormatterTTY:
 
     def _make_result(self, host_name="web1", stdout="", stderr="", exit_code=0):
         host = HostDefinition(name=host_name, hostname="10.0.0.1")
-        return CommandResult(host=host, stdout=stdout, stderr=stderr, exit_code=exit_code)
+        return CommandResult(
+            host=host, stdout=stdout, stderr=stderr, exit_code=exit_code
+        )
 
     def _get_output(self, results, color="never"):
         """Helper to capture formatted output as plain text."""
@@ -1753,7 +1815,9 @@ class TestOutputFormatterPiped:
 
     def _make_result(self, host_name="web1", stdout="", stderr="", exit_code=0):
         host = HostDefinition(name=host_name, hostname="10.0.0.1")
-        return CommandResult(host=host, stdout=stdout, stderr=stderr, exit_code=exit_code)
+        return CommandResult(
+            host=host, stdout=stdout, stderr=stderr, exit_code=exit_code
+        )
 
     def _get_output(self, results, color="never"):
         """Helper to capture formatted output as plain text."""
@@ -1974,7 +2038,11 @@ class TestRunImmediateMode:
         formatter = OutputFormatter(color="never", is_tty=False, file=buf)
         mock_proc = self._make_mock_process(stdout=b"ok\n", returncode=0)
 
-        with patch("asyncio.create_subprocess_exec", new_callable=AsyncMock, return_value=mock_proc):
+        with patch(
+            "asyncio.create_subprocess_exec",
+            new_callable=AsyncMock,
+            return_value=mock_proc,
+        ):
             exit_code = run_immediate_mode(hosts, "echo ok", formatter)
 
         assert exit_code == 0
@@ -1986,7 +2054,11 @@ class TestRunImmediateMode:
         formatter = OutputFormatter(color="never", is_tty=False, file=buf)
         mock_proc = self._make_mock_process(stdout=b"", stderr=b"error\n", returncode=1)
 
-        with patch("asyncio.create_subprocess_exec", new_callable=AsyncMock, return_value=mock_proc):
+        with patch(
+            "asyncio.create_subprocess_exec",
+            new_callable=AsyncMock,
+            return_value=mock_proc,
+        ):
             exit_code = run_immediate_mode(hosts, "failing-cmd", formatter)
 
         assert exit_code == 1
@@ -1998,7 +2070,11 @@ class TestRunImmediateMode:
         formatter = OutputFormatter(color="never", is_tty=False, file=buf)
         mock_proc = self._make_mock_process(stdout=b"hello world\n", returncode=0)
 
-        with patch("asyncio.create_subprocess_exec", new_callable=AsyncMock, return_value=mock_proc):
+        with patch(
+            "asyncio.create_subprocess_exec",
+            new_callable=AsyncMock,
+            return_value=mock_proc,
+        ):
             run_immediate_mode(hosts, "echo hello world", formatter)
 
         output = buf.getvalue()
@@ -2011,7 +2087,11 @@ class TestRunImmediateMode:
         formatter = OutputFormatter(color="never", is_tty=True, file=buf)
         mock_proc = self._make_mock_process(stdout=b"data\n", returncode=0)
 
-        with patch("asyncio.create_subprocess_exec", new_callable=AsyncMock, return_value=mock_proc):
+        with patch(
+            "asyncio.create_subprocess_exec",
+            new_callable=AsyncMock,
+            return_value=mock_proc,
+        ):
             run_immediate_mode(hosts, "cat file", formatter)
 
         output = buf.getvalue()
@@ -2025,16 +2105,21 @@ class TestRunImmediateMode:
         formatter = OutputFormatter(color="never", is_tty=False, file=buf)
         mock_proc = self._make_mock_process(stdout=b"ok\n", returncode=0)
 
-        with patch("asyncio.create_subprocess_exec", new_callable=AsyncMock, return_value=mock_proc):
-            exit_code = run_immediate_mode(
-                hosts, "echo ok", formatter, sequential=True
-            )
+        with patch(
+            "asyncio.create_subprocess_exec",
+            new_callable=AsyncMock,
+            return_value=mock_proc,
+        ):
+            exit_code = run_immediate_mode(hosts, "echo ok", formatter, sequential=True)
 
         assert exit_code == 0
 
     def test_mixed_results_returns_one(self):
         """When some hosts succeed and some fail, returns 1."""
-        hosts = [self._make_host("good", "10.0.0.1"), self._make_host("bad", "10.0.0.2")]
+        hosts = [
+            self._make_host("good", "10.0.0.1"),
+            self._make_host("bad", "10.0.0.2"),
+        ]
         buf = io.StringIO()
         formatter = OutputFormatter(color="never", is_tty=False, file=buf)
 
@@ -2065,7 +2150,11 @@ class TestRunImmediateMode:
         formatter = OutputFormatter(color="never", is_tty=False, file=buf)
         mock_proc = self._make_mock_process(stdout=b"ok\n", returncode=0)
 
-        with patch("asyncio.create_subprocess_exec", new_callable=AsyncMock, return_value=mock_proc):
+        with patch(
+            "asyncio.create_subprocess_exec",
+            new_callable=AsyncMock,
+            return_value=mock_proc,
+        ):
             exit_code = run_immediate_mode(
                 hosts, "echo ok", formatter, timeout=60.0, connection_timeout=20.0
             )
@@ -2230,7 +2319,11 @@ class TestMetaCommandHandler:
         mock_proc.kill = MagicMock()
         mock_proc.wait = AsyncMock()
 
-        with patch("asyncio.create_subprocess_exec", new_callable=AsyncMock, return_value=mock_proc):
+        with patch(
+            "asyncio.create_subprocess_exec",
+            new_callable=AsyncMock,
+            return_value=mock_proc,
+        ):
             handler.handle(":reconnect")
 
         assert session.connected["web2"] is True
@@ -2270,7 +2363,9 @@ class TestHandleCd:
         host = session.hosts[0]
         results = [
             CommandResult(host=host, stdout="/var/log\n", stderr="", exit_code=0),
-            CommandResult(host=session.hosts[1], stdout="/opt/app\n", stderr="", exit_code=0),
+            CommandResult(
+                host=session.hosts[1], stdout="/opt/app\n", stderr="", exit_code=0
+            ),
         ]
         session._handle_cd("/var/log", results)
         assert session.working_dirs["web1"] == "/var/log"
@@ -2283,7 +2378,9 @@ class TestHandleCd:
         host = session.hosts[0]
         results = [
             CommandResult(host=host, stdout="", stderr="No such file\n", exit_code=1),
-            CommandResult(host=session.hosts[1], stdout="/opt/app\n", stderr="", exit_code=0),
+            CommandResult(
+                host=session.hosts[1], stdout="/opt/app\n", stderr="", exit_code=0
+            ),
         ]
         session._handle_cd("/nonexistent", results)
         # web1 retains previous dir
@@ -2300,7 +2397,9 @@ class TestHandleCd:
         host = session.hosts[0]
         results = [
             CommandResult(host=host, stdout="/home/deploy\n", stderr="", exit_code=0),
-            CommandResult(host=session.hosts[1], stdout="/home/deploy\n", stderr="", exit_code=0),
+            CommandResult(
+                host=session.hosts[1], stdout="/home/deploy\n", stderr="", exit_code=0
+            ),
         ]
         session._handle_cd("", results)
         assert session.working_dirs["web1"] == "/home/deploy"
@@ -2313,7 +2412,9 @@ class TestHandleCd:
         host = session.hosts[0]
         results = [
             CommandResult(host=host, stdout="/tmp\n", stderr="", exit_code=0),
-            CommandResult(host=session.hosts[1], stdout="/tmp\n", stderr="", exit_code=0),
+            CommandResult(
+                host=session.hosts[1], stdout="/tmp\n", stderr="", exit_code=0
+            ),
         ]
         session._handle_cd("/tmp", results)
         assert session.working_dirs["web1"] == "/tmp"
@@ -2437,7 +2538,9 @@ class TestConnectionState:
         session = self._make_session()
         host = session.hosts[0]
         results = [
-            CommandResult(host=host, stdout="", stderr="", exit_code=1, error="Connection refused"),
+            CommandResult(
+                host=host, stdout="", stderr="", exit_code=1, error="Connection refused"
+            ),
         ]
         session._check_connection_state(results)
         assert session.connected["web1"] is False
@@ -2480,7 +2583,11 @@ class TestConnectionState:
         mock_proc.kill = MagicMock()
         mock_proc.wait = AsyncMock()
 
-        with patch("asyncio.create_subprocess_exec", new_callable=AsyncMock, return_value=mock_proc):
+        with patch(
+            "asyncio.create_subprocess_exec",
+            new_callable=AsyncMock,
+            return_value=mock_proc,
+        ):
             result = session._initial_connect()
 
         assert result is False
@@ -2614,17 +2721,23 @@ class TestFormatConnectionFailure:
 
     def test_timeout(self):
         host = HostDefinition(name="web1", hostname="10.0.0.1")
-        result = CommandResult(host=host, stdout="", stderr="", exit_code=1, timed_out=True)
+        result = CommandResult(
+            host=host, stdout="", stderr="", exit_code=1, timed_out=True
+        )
         assert _format_connection_failure(result) == "connection timed out"
 
     def test_error_message(self):
         host = HostDefinition(name="web1", hostname="10.0.0.1")
-        result = CommandResult(host=host, stdout="", stderr="", exit_code=1, error="Connection refused")
+        result = CommandResult(
+            host=host, stdout="", stderr="", exit_code=1, error="Connection refused"
+        )
         assert _format_connection_failure(result) == "Connection refused"
 
     def test_stderr_message(self):
         host = HostDefinition(name="web1", hostname="10.0.0.1")
-        result = CommandResult(host=host, stdout="", stderr="Permission denied\n", exit_code=255)
+        result = CommandResult(
+            host=host, stdout="", stderr="Permission denied\n", exit_code=255
+        )
         assert _format_connection_failure(result) == "Permission denied"
 
     def test_generic_failure(self):
@@ -2653,7 +2766,10 @@ class TestCLIEntryPoint:
         """When no hosts are provided via any source, exits with error."""
         result = self.runner.invoke(app, [])
         assert result.exit_code != 0
-        assert "no hosts specified" in result.output.lower() or "no hosts specified" in (result.stdout or "").lower()
+        assert (
+            "no hosts specified" in result.output.lower()
+            or "no hosts specified" in (result.stdout or "").lower()
+        )
 
     def test_no_hosts_with_command_exits_nonzero(self):
         """When a command is given but no hosts, exits with error."""
@@ -2662,13 +2778,17 @@ class TestCLIEntryPoint:
 
     def test_invalid_port_zero_exits_nonzero(self):
         """Port 0 is rejected."""
-        result = self.runner.invoke(app, ["--hosts", "server1", "--port", "0", "uptime"])
+        result = self.runner.invoke(
+            app, ["--hosts", "server1", "--port", "0", "uptime"]
+        )
         assert result.exit_code != 0
         assert "invalid port" in result.output.lower()
 
     def test_invalid_port_too_high_exits_nonzero(self):
         """Port above 65535 is rejected."""
-        result = self.runner.invoke(app, ["--hosts", "server1", "--port", "70000", "uptime"])
+        result = self.runner.invoke(
+            app, ["--hosts", "server1", "--port", "70000", "uptime"]
+        )
         assert result.exit_code != 0
         assert "invalid port" in result.output.lower()
 
@@ -2720,36 +2840,4120 @@ class TestCLIEntryPoint:
 
     def test_group_without_config_exits_nonzero(self):
         """Using --group without --config exits with error."""
-        result = self.runner.invoke(app, ["--group", "webservers", "uptime"], env={"HOME": "/nonexistent"})
+        result = self.runner.invoke(
+            app, ["--group", "webservers", "uptime"], env={"HOME": "/nonexistent"}
+        )
         assert result.exit_code != 0
         # Either "--group requires --config" or an undefined group error
         output_lower = result.output.lower()
-        assert "--group requires --config" in output_lower or "undefined group" in output_lower
+        assert (
+            "--group requires --config" in output_lower
+            or "undefined group" in output_lower
+        )
 
     def test_config_file_not_found_exits_nonzero(self, tmp_path):
         """Non-existent config file exits with error."""
         fake_config = tmp_path / "nonexistent.yaml"
         result = self.runner.invoke(
             app,
-            ["--config", str(fake_config), "--group", "web", "--hosts", "server1", "uptime"],
+            [
+                "--config",
+                str(fake_config),
+                "--group",
+                "web",
+                "--hosts",
+                "server1",
+                "uptime",
+            ],
         )
         assert result.exit_code != 0
 
     def test_host_file_not_found_exits_nonzero(self, tmp_path):
         """Non-existent host file exits with error."""
         fake_file = tmp_path / "nonexistent_hosts.txt"
-        result = self.runner.invoke(
-            app, ["--host-file", str(fake_file), "uptime"]
-        )
+        result = self.runner.invoke(app, ["--host-file", str(fake_file), "uptime"])
         assert result.exit_code != 0
 
     def test_host_file_with_valid_hosts(self, tmp_path):
         """Valid host file entries are accepted (tool will fail at SSH, not validation)."""
         host_file = tmp_path / "hosts.txt"
         host_file.write_text("server1.example.com\nserver2.example.com\n")
-        result = self.runner.invoke(
-            app, ["--host-file", str(host_file), "uptime"]
-        )
+        result = self.runner.invoke(app, ["--host-file", str(host_file), "uptime"])
         # Should get past validation — will fail at SSH execution, not at arg parsing
         assert "no hosts specified" not in (result.output or "").lower()
         assert "invalid" not in (result.output or "").lower()
+
+
+# ---------------------------------------------------------------------------
+# Unit Tests: ConnectionPool (ControlMaster multiplexing)
+# ---------------------------------------------------------------------------
+
+ConnectionPool = ssh_tool.ConnectionPool
+build_ssh_args = ssh_tool.build_ssh_args
+
+
+class TestConnectionPool:
+    """Tests for ControlMaster connection pool management."""
+
+    def _make_host(self, name="web1", hostname="10.0.0.1", user="deploy", port=22):
+        return HostDefinition(name=name, hostname=hostname, user=user, port=port)
+
+    def _make_mock_process(self, stderr=b"", returncode=0):
+        mock_proc = MagicMock()
+        mock_proc.communicate = AsyncMock(return_value=(b"", stderr))
+        mock_proc.returncode = returncode
+        mock_proc.kill = MagicMock()
+        mock_proc.wait = AsyncMock()
+        return mock_proc
+
+    def test_build_ssh_args_with_control_path(self):
+        """A control path multiplexes over the master without becoming one."""
+        args = build_ssh_args(self._make_host(), 10, control_path="/tmp/x/sock")
+        assert "ControlMaster=no" in args
+        assert "ControlPath=/tmp/x/sock" in args
+        assert args[-1] == "deploy@10.0.0.1"
+
+    def test_build_ssh_args_master(self):
+        """master=True makes the invocation a persistent master."""
+        args = build_ssh_args(
+            self._make_host(), 10, control_path="/tmp/x/sock", master=True
+        )
+        assert "ControlMaster=yes" in args
+        assert any(a.startswith("ControlPersist=") for a in args)
+
+    def test_build_ssh_args_without_control_path_unchanged(self):
+        """No control options are added without a control path."""
+        args = build_ssh_args(self._make_host(), 10)
+        assert not any(a.startswith("Control") for a in args)
+
+    def test_control_path_is_stable_and_short(self, tmp_path):
+        """The same target always maps to the same short socket path."""
+        pool = ConnectionPool(control_dir=tmp_path)
+        host = self._make_host(hostname="a" * 200)
+        path = pool.control_path(host)
+        assert path == pool.control_path(
+            self._make_host(name="alias", hostname="a" * 200)
+        )
+        assert Path(path).parent == tmp_path
+        assert len(Path(path).name) == 16
+
+    def test_control_path_differs_per_target(self, tmp_path):
+        """Different user/host/port combinations get different sockets."""
+        pool = ConnectionPool(control_dir=tmp_path)
+        a = pool.control_path(self._make_host(port=22))
+        b = pool.control_path(self._make_host(port=2222))
+        c = pool.control_path(self._make_host(user="root"))
+        assert len({a, b, c}) == 3
+
+    def test_open_starts_background_master(self, tmp_path):
+        """open() runs ssh -N -f with ControlMaster=yes and records the master."""
+        pool = ConnectionPool(control_dir=tmp_path)
+        host = self._make_host()
+        mock_proc = self._make_mock_process()
+
+        with patch(
+            "asyncio.create_subprocess_exec",
+            new_callable=AsyncMock,
+            return_value=mock_proc,
+        ) as mock_exec:
+            reason = asyncio.run(pool.open(host))
+
+        assert reason is None
+        args = mock_exec.call_args[0]
+        assert args[0] == "ssh"
+        assert "-N" in args and "-f" in args
+        assert "ControlMaster=yes" in args
+        assert pool.control_path(host) in pool.masters
+
+    def test_open_failure_returns_reason(self, tmp_path):
+        """A failed master start reports ssh's stderr and is not recorded."""
+        pool = ConnectionPool(control_dir=tmp_path)
+        mock_proc = self._make_mock_process(
+            stderr=b"Connection refused\n", returncode=255
+        )
+
+        with patch(
+            "asyncio.create_subprocess_exec",
+            new_callable=AsyncMock,
+            return_value=mock_proc,
+        ):
+            reason = asyncio.run(pool.open(self._make_host()))
+
+        assert reason == "Connection refused"
+        assert pool.masters == {}
+
+    def test_open_all_shares_master_between_aliases(self, tmp_path):
+        """Two host names for the same target open a single master."""
+        pool = ConnectionPool(control_dir=tmp_path)
+        hosts = [self._make_host("a"), self._make_host("b")]
+        mock_proc = self._make_mock_process()
+
+        with patch(
+            "asyncio.create_subprocess_exec",
+            new_callable=AsyncMock,
+            return_value=mock_proc,
+        ) as mock_exec:
+            reasons = asyncio.run(pool.open_all(hosts))
+
+        assert reasons == {"a": None, "b": None}
+        assert mock_exec.call_count == 1
+
+    def test_check_dead_master_is_forgotten(self, tmp_path):
+        """A failed -O check drops the master so ensure() reopens it."""
+        pool = ConnectionPool(control_dir=tmp_path)
+        host = self._make_host()
+        pool.masters[pool.control_path(host)] = host
+        mock_proc = self._make_mock_process(returncode=255)
+
+        with patch(
+            "asyncio.create_subprocess_exec",
+            new_callable=AsyncMock,
+            return_value=mock_proc,
+        ) as mock_exec:
+            alive = asyncio.run(pool.check(host))
+
+        assert alive is False
+        assert pool.masters == {}
+        args = mock_exec.call_args[0]
+        assert args[1:3] == ("-O", "check")
+
+    def test_close_all_exits_masters_and_removes_dir(self):
+        """close_all sends -O exit to each master and removes the socket dir."""
+        pool = ConnectionPool()
+        host = self._make_host()
+        pool.masters[pool.control_path(host)] = host
+        control_dir = pool.control_dir
+        assert control_dir.exists()
+        mock_proc = self._make_mock_process()
+
+        with patch(
+            "asyncio.create_subprocess_exec",
+            new_callable=AsyncMock,
+            return_value=mock_proc,
+        ) as mock_exec:
+            asyncio.run(pool.close_all())
+
+        assert mock_exec.call_args[0][1:3] == ("-O", "exit")
+        assert pool.masters == {}
+        assert not control_dir.exists()
+
+    def test_run_command_on_all_uses_control_path(self, tmp_path):
+        """Commands are multiplexed over the pool's control sockets."""
+        pool = ConnectionPool(control_dir=tmp_path)
+        hosts = [self._make_host()]
+        mock_proc = self._make_mock_process()
+        mock_proc.communicate = AsyncMock(return_value=(b"ok\n", b""))
+
+        with patch(
+            "asyncio.create_subprocess_exec",
+            new_callable=AsyncMock,
+            return_value=mock_proc,
+        ) as mock_exec:
+            asyncio.run(run_command_on_all(hosts, "uptime", pool=pool))
+
+        args = mock_exec.call_args[0]
+        assert f"ControlPath={pool.control_path(hosts[0])}" in args
+        assert args[-1] == "uptime"
+
+
+# ---------------------------------------------------------------------------
+# Unit Tests: bounded-concurrency scheduler (--forks)
+# ---------------------------------------------------------------------------
+
+ExecutionStats = ssh_tool.ExecutionStats
+format_stats = ssh_tool.format_stats
+
+
+class TestBoundedScheduler:
+    """Tests for the worker-limited fan-out in run_command_on_all."""
+
+    def _make_hosts(self, count):
+        return [
+            HostDefinition(name=f"h{i:03d}", hostname=f"10.0.{i // 256}.{i % 256}")
+            for i in range(count)
+        ]
+
+    def _tracking_exec(self, tracker, delay=0.01):
+        """Build a fake create_subprocess_exec that records concurrency."""
+
+        async def fake_exec(*args, **kwargs):
+            tracker["spawned"] += 1
+            tracker["in_flight"] += 1
+            tracker["peak"] = max(tracker["peak"], tracker["in_flight"])
+
+            async def communicate():
+                await asyncio.sleep(delay)
+                tracker["in_flight"] -= 1
+                return (args[-1].encode() + b"\n", b"")
+
+            mock_proc = MagicMock()
+            mock_proc.communicate = communicate
+            mock_proc.returncode = 0
+            return mock_proc
+
+        return fake_exec
+
+    def test_in_flight_never_exceeds_forks(self):
+        """No more than `forks` ssh processes run at once."""
+        tracker = {"spawned": 0, "in_flight": 0, "peak": 0}
+        hosts = self._make_hosts(50)
+
+        with patch(
+            "asyncio.create_subprocess_exec", side_effect=self._tracking_exec(tracker)
+        ):
+            results = asyncio.run(run_command_on_all(hosts, "uptime", forks=7))
+
+        assert len(results) == 50
+        assert tracker["spawned"] == 50
+        assert tracker["peak"] == 7
+
+    def test_results_in_host_order(self):
+        """Results are returned in host order regardless of completion order."""
+        hosts = self._make_hosts(20)
+
+        async def fake_exec(*args, **kwargs):
+            target = args[-2]
+            mock_proc = MagicMock()
+
+            async def communicate():
+                # Later hosts finish first
+                await asyncio.sleep(0.001 * (20 - int(target.rsplit(".", 1)[1])))
+                return (target.encode(), b"")
+
+            mock_proc.communicate = communicate
+            mock_proc.returncode = 0
+            return mock_proc
+
+        with patch("asyncio.create_subprocess_exec", side_effect=fake_exec):
+            results = asyncio.run(run_command_on_all(hosts, "uptime", forks=5))
+
+        assert [r.host.name for r in results] == [h.name for h in hosts]
+        assert [r.stdout for r in results] == [h.hostname for h in hosts]
+
+    def test_sequential_means_one_worker(self):
+        """sequential=True overrides forks and runs one host at a time."""
+        tracker = {"spawned": 0, "in_flight": 0, "peak": 0}
+
+        with patch(
+            "asyncio.create_subprocess_exec",
+            side_effect=self._tracking_exec(tracker, delay=0),
+        ):
+            asyncio.run(
+                run_command_on_all(
+                    self._make_hosts(5), "uptime", sequential=True, forks=10
+                )
+            )
+
+        assert tracker["peak"] == 1
+
+    def test_stats_report_throughput(self):
+        """ExecutionStats records host count, worker count and throughput."""
+        tracker = {"spawned": 0, "in_flight": 0, "peak": 0}
+        stats = ExecutionStats()
+
+        with patch(
+            "asyncio.create_subprocess_exec", side_effect=self._tracking_exec(tracker)
+        ):
+            asyncio.run(
+                run_command_on_all(self._make_hosts(10), "uptime", forks=4, stats=stats)
+            )
+
+        assert stats.hosts == 10
+        assert stats.forks == 4
+        assert stats.elapsed > 0
+        assert stats.throughput == pytest.approx(10 / stats.elapsed)
+
+    def test_format_stats(self):
+        """The throughput summary is a readable one-liner."""
+        line = format_stats(ExecutionStats(hosts=100, elapsed=2.0, forks=10))
+        assert line == "100 host(s) in 2.00s (50.0 hosts/sec, forks=10)"
+
+    def test_zero_elapsed_throughput(self):
+        """Throughput is zero rather than a division error for empty runs."""
+        assert ExecutionStats().throughput == 0.0
+
+    def test_immediate_mode_prints_stats(self, capsys):
+        """show_stats prints the throughput line to stderr."""
+        hosts = self._make_hosts(3)
+        formatter = OutputFormatter(color="never", is_tty=False, file=io.StringIO())
+        outputs = {h.hostname: ([b"up\n"], [], 0) for h in hosts}
+
+        with patch(
+            "asyncio.create_subprocess_exec", side_effect=_make_streaming_exec(outputs)
+        ):
+            run_immediate_mode(hosts, "uptime", formatter, forks=2, show_stats=True)
+
+        assert "3 host(s) in" in capsys.readouterr().err
+
+    def test_cli_rejects_zero_forks(self):
+        """--forks must be at least 1."""
+        runner = CliRunner()
+        result = runner.invoke(app, ["--hosts", "server1", "--forks", "0", "uptime"])
+        assert result.exit_code != 0
+        assert "invalid --forks" in result.output.lower()
+
+
+# ---------------------------------------------------------------------------
+# Unit Tests: streaming output (--stream)
+# ---------------------------------------------------------------------------
+
+format_summary = ssh_tool.format_summary
+
+
+class _FakeStream:
+    """Minimal asyncio.StreamReader stand-in that yields preset chunks."""
+
+    def __init__(self, chunks, delay=0.0):
+        self._chunks = list(chunks)
+        self._delay = delay
+
+    async def read(self, n=-1):
+        if self._delay:
+            await asyncio.sleep(self._delay)
+        return self._chunks.pop(0) if self._chunks else b""
+
+
+def _make_streaming_exec(outputs, delays=None):
+    """Fake create_subprocess_exec: outputs maps hostname -> (stdout chunks, stderr chunks, rc)."""
+    delays = delays or {}
+
+    async def fake_exec(*args, **kwargs):
+        target = args[-2]
+        out_chunks, err_chunks, returncode = outputs[target]
+        delay = delays.get(target, 0.0)
+        mock_proc = MagicMock()
+        mock_proc.stdout = _FakeStream(out_chunks, delay)
+        mock_proc.stderr = _FakeStream(err_chunks)
+
+        async def communicate():
+            await asyncio.sleep(delay)
+            return b"".join(out_chunks), b"".join(err_chunks)
+
+        mock_proc.communicate = communicate
+        mock_proc.wait = AsyncMock(return_value=returncode)
+        mock_proc.returncode = returncode
+        return mock_proc
+
+    return fake_exec
+
+
+class TestStreamingOutput:
+    """Tests for completion-order and live line streaming."""
+
+    def test_on_line_reports_lines_as_they_arrive(self):
+        """Lines split across chunks are reassembled; a final partial line is emitted."""
+        host = HostDefinition(name="web1", hostname="10.0.0.1")
+        fake = _make_streaming_exec(
+            {"10.0.0.1": ([b"one\ntw", b"o\nthree"], [b"warn\n"], 0)}
+        )
+        seen = []
+
+        with patch("asyncio.create_subprocess_exec", side_effect=fake):
+            result = asyncio.run(
+                run_command_on_host(
+                    host, "cmd", on_line=lambda h, line, err: seen.append((line, err))
+                )
+            )
+
+        assert (
+            ("one", False) in seen
+            and ("two", False) in seen
+            and ("three", False) in seen
+        )
+        assert ("warn", True) in seen
+        assert result.stdout == "one\ntwo\nthree"
+        assert result.stderr == "warn\n"
+
+    def test_on_result_fires_in_completion_order(self):
+        """on_result is called as each host finishes, fastest first."""
+        hosts = [
+            HostDefinition(name="slow", hostname="10.0.0.1"),
+            HostDefinition(name="fast", hostname="10.0.0.2"),
+        ]
+        fake = _make_streaming_exec(
+            {"10.0.0.1": ([b"s\n"], [], 0), "10.0.0.2": ([b"f\n"], [], 0)},
+            delays={"10.0.0.1": 0.05},
+        )
+        order = []
+
+        with patch("asyncio.create_subprocess_exec", side_effect=fake):
+            results = asyncio.run(
+                run_command_on_all(
+                    hosts, "cmd", on_result=lambda r: order.append(r.host.name)
+                )
+            )
+
+        assert order == ["fast", "slow"]
+        assert [r.host.name for r in results] == ["slow", "fast"]
+
+    def test_stream_piped_prints_live_lines_and_trailers(self, capsys):
+        """Piped streaming prints prefixed lines, trailers and a summary."""
+        hosts = [
+            HostDefinition(name="slow", hostname="10.0.0.1"),
+            HostDefinition(name="fast", hostname="10.0.0.2"),
+        ]
+        fake = _make_streaming_exec(
+            {"10.0.0.1": ([b"late\n"], [], 3), "10.0.0.2": ([], [], 0)},
+            delays={"10.0.0.1": 0.05},
+        )
+        buf = io.StringIO()
+        formatter = OutputFormatter(color="never", is_tty=False, file=buf)
+
+        with patch("asyncio.create_subprocess_exec", side_effect=fake):
+            exit_code = run_immediate_mode(hosts, "cmd", formatter, stream=True)
+
+        lines = buf.getvalue().splitlines()
+        assert lines == [
+            "[fast] (no output)",
+            "[slow] late",
+            "[slow] exited with code 3",
+        ]
+        assert exit_code == 1
+        assert "2 host(s): 1 ok, 1 failed" in capsys.readouterr().err
+
+    def test_stream_tty_prints_blocks_in_completion_order(self):
+        """TTY streaming prints each host's block as it completes."""
+        hosts = [
+            HostDefinition(name="slow", hostname="10.0.0.1"),
+            HostDefinition(name="fast", hostname="10.0.0.2"),
+        ]
+        fake = _make_streaming_exec(
+            {"10.0.0.1": ([b"s\n"], [], 0), "10.0.0.2": ([b"f\n"], [], 0)},
+            delays={"10.0.0.1": 0.05},
+        )
+        buf = io.StringIO()
+        formatter = OutputFormatter(color="never", is_tty=True, file=buf)
+
+        with patch("asyncio.create_subprocess_exec", side_effect=fake):
+            run_immediate_mode(hosts, "cmd", formatter, stream=True)
+
+        output = buf.getvalue()
+        assert output.index("--- fast ---") < output.index("--- slow ---")
+
+    def test_format_summary(self):
+        """The summary counts successful and failed hosts."""
+        host = HostDefinition(name="web1", hostname="10.0.0.1")
+        results = [
+            CommandResult(host=host, stdout="", stderr="", exit_code=0),
+            CommandResult(host=host, stdout="", stderr="", exit_code=2),
+        ]
+        assert format_summary(results) == "2 host(s): 1 ok, 1 failed"
+
+
+# ---------------------------------------------------------------------------
+# Unit Tests: Transports (subprocess and in-process asyncssh)
+# ---------------------------------------------------------------------------
+
+Transport = ssh_tool.Transport
+SubprocessTransport = ssh_tool.SubprocessTransport
+AsyncSSHTransport = ssh_tool.AsyncSSHTransport
+make_transport = ssh_tool.make_transport
+
+
+async def _start_test_sshd():
+    """Start an in-process asyncssh server on localhost that needs no auth.
+
+    Supported commands: 'echo <text>', 'fail' (stderr + exit 3), 'sleep'.
+    """
+    asyncssh = pytest.importorskip("asyncssh")
+
+    class NoAuthServer(asyncssh.SSHServer):
+        def begin_auth(self, username):
+            return False
+
+    async def handle(process):
+        command = process.command or ""
+        if command.startswith("echo "):
+            process.stdout.write(command[5:] + "\n")
+        elif command == "fail":
+            process.stderr.write("boom\n")
+            process.exit(3)
+            return
+        elif command == "sleep":
+            await asyncio.sleep(10)
+        process.exit(0)
+
+    server = await asyncssh.listen(
+        "127.0.0.1",
+        0,
+        server_factory=NoAuthServer,
+        server_host_keys=[asyncssh.generate_private_key("ssh-ed25519")],
+        process_factory=handle,
+    )
+    port = server.sockets[0].getsockname()[1]
+    return server, port
+
+
+class TestTransports:
+    """Tests for the pluggable transport layer."""
+
+    def test_base_transport_run_not_implemented(self):
+        host = HostDefinition(name="web1", hostname="10.0.0.1")
+        with pytest.raises(NotImplementedError):
+            asyncio.run(Transport().run(host, "ls", 1.0, 1.0))
+
+    def test_subprocess_transport_uses_pool_control_path(self, tmp_path):
+        """SubprocessTransport forks ssh and multiplexes over the pool."""
+        pool = ConnectionPool(control_dir=tmp_path)
+        host = HostDefinition(name="web1", hostname="10.0.0.1")
+        mock_proc = MagicMock()
+        mock_proc.communicate = AsyncMock(return_value=(b"ok\n", b""))
+        mock_proc.returncode = 0
+
+        with patch(
+            "asyncio.create_subprocess_exec",
+            new_callable=AsyncMock,
+            return_value=mock_proc,
+        ) as mock_exec:
+            result = asyncio.run(
+                run_command_on_host(
+                    host,
+                    "uptime",
+                    working_dir="/srv",
+                    transport=SubprocessTransport(pool),
+                )
+            )
+
+        assert result.stdout == "ok\n"
+        args = mock_exec.call_args[0]
+        assert f"ControlPath={pool.control_path(host)}" in args
+        assert args[-1] == "cd /srv && uptime"
+
+    def test_make_transport(self):
+        assert isinstance(make_transport("ssh"), SubprocessTransport)
+        with pytest.raises(ValidationError, match="invalid --engine"):
+            make_transport("telnet")
+
+    def test_cli_rejects_unknown_engine(self):
+        result = CliRunner().invoke(
+            app, ["--hosts", "server1", "--engine", "telnet", "uptime"]
+        )
+        assert result.exit_code != 0
+        assert "invalid --engine" in result.output.lower()
+
+
+class TestAsyncSSHTransport:
+    """End-to-end tests of the asyncssh engine against an in-process server."""
+
+    def _hosts(self, port, count=2):
+        return [
+            HostDefinition(name=f"h{i}", hostname="127.0.0.1", user="test", port=port)
+            for i in range(count)
+        ]
+
+    def _transport(self):
+        return AsyncSSHTransport(known_hosts=None, client_keys=None, agent_path=None)
+
+    def test_runs_commands_over_one_shared_connection(self):
+        """Hosts with the same target share a connection; each command is a channel."""
+
+        async def scenario():
+            server, port = await _start_test_sshd()
+            transport = self._transport()
+            try:
+                results = await run_command_on_all(
+                    self._hosts(port, 3), "echo hi", transport=transport
+                )
+                again = await run_command_on_host(
+                    self._hosts(port, 1)[0], "echo again", transport=transport
+                )
+                connections = len(transport._connections)
+            finally:
+                await transport.close()
+                server.close()
+            return results, again, connections
+
+        results, again, connections = asyncio.run(scenario())
+        assert [r.stdout for r in results] == ["hi\n"] * 3
+        assert all(r.exit_code == 0 for r in results)
+        assert again.stdout == "again\n"
+        assert connections == 1
+
+    def test_exit_code_and_stderr(self):
+        async def scenario():
+            server, port = await _start_test_sshd()
+            transport = self._transport()
+            try:
+                return await run_command_on_host(
+                    self._hosts(port, 1)[0], "fail", transport=transport
+                )
+            finally:
+                await transport.close()
+                server.close()
+
+        result = asyncio.run(scenario())
+        assert result.exit_code == 3
+        assert result.stderr == "boom\n"
+
+    def test_streams_lines(self):
+        async def scenario():
+            server, port = await _start_test_sshd()
+            transport = self._transport()
+            seen = []
+            try:
+                await run_command_on_host(
+                    self._hosts(port, 1)[0],
+                    "echo live",
+                    on_line=lambda h, line, err: seen.append(line),
+                    transport=transport,
+                )
+            finally:
+                await transport.close()
+                server.close()
+            return seen
+
+        assert asyncio.run(scenario()) == ["live"]
+
+    def test_timeout(self):
+        async def scenario():
+            server, port = await _start_test_sshd()
+            transport = self._transport()
+            try:
+                return await run_command_on_host(
+                    self._hosts(port, 1)[0], "sleep", timeout=0.2, transport=transport
+                )
+            finally:
+                await transport.close()
+                server.close()
+
+        result = asyncio.run(scenario())
+        assert result.timed_out is True
+        assert result.exit_code == 1
+
+    def test_connection_refused_sets_error(self):
+        """A closed port yields a connection error result, not an exception."""
+        pytest.importorskip("asyncssh")
+
+        async def scenario():
+            server, port = await _start_test_sshd()
+            server.close()
+            await server.wait_closed()
+            transport = self._transport()
+            try:
+                return await run_command_on_host(
+                    self._hosts(port, 1)[0], "echo hi", transport=transport
+                )
+            finally:
+                await transport.close()
+
+        result = asyncio.run(scenario())
+        assert result.error
+        assert result.exit_code == 255
+
+
+# ---------------------------------------------------------------------------
+# Unit Tests: persistent remote shell (sentinel-framed REPL protocol)
+# ---------------------------------------------------------------------------
+
+RemoteShell = ssh_tool.RemoteShell
+
+
+async def _local_shell(host, login_shell="/bin/sh"):
+    """Start a local shell standing in for a remote shell channel.
+
+    It is started like a remote one, for a user whose login shell is
+    login_shell. The shell gets its own process group so that terminating it
+    also ends any command it is running (as closing an ssh channel would).
+    """
+    import os
+    import signal
+
+    process = await asyncio.create_subprocess_exec(
+        "sh",
+        "-c",
+        ssh_tool._REMOTE_SHELL_CMD,
+        env={**os.environ, "SHELL": login_shell},
+        stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+        start_new_session=True,
+    )
+    return RemoteShell(host, process, lambda: os.killpg(process.pid, signal.SIGKILL))
+
+
+class _LocalShellTransport(Transport):
+    """Transport whose shells are local `sh` processes."""
+
+    def __init__(self, fail_hosts=()):
+        self.fail_hosts = set(fail_hosts)
+        self.opened = 0
+        self.attempts = 0
+
+    async def open_shell(self, host, connection_timeout):
+        self.attempts += 1
+        if host.name in self.fail_hosts:
+            raise OSError("Connection refused")
+        self.opened += 1
+        return await _local_shell(host)
+
+
+class TestRemoteShell:
+    """Tests for RemoteShell framing against a local sh."""
+
+    host = HostDefinition(name="web1", hostname="10.0.0.1")
+
+    def _run_commands(self, *commands, timeout=5.0, login_shell="/bin/sh"):
+        async def scenario():
+            shell = await _local_shell(self.host, login_shell)
+            try:
+                return (
+                    [await shell.run(c, timeout) for c in commands],
+                    shell.cwd,
+                    shell.alive,
+                )
+            finally:
+                await shell.close()
+
+        return asyncio.run(scenario())
+
+    def test_output_and_exit_code(self):
+        (result,), _cwd, _alive = self._run_commands(
+            "echo hello; echo oops >&2; exit_code() { return 4; }; exit_code"
+        )
+        assert result.stdout == "hello\n"
+        assert result.stderr == "oops\n"
+        assert result.exit_code == 4
+
+    def test_output_without_trailing_newline(self):
+        (result,), _cwd, _alive = self._run_commands("printf abc")
+        assert result.stdout == "abc"
+
+    def test_state_persists_between_commands(self, tmp_path):
+        """cwd, variables and functions survive across commands."""
+        results, cwd, _alive = self._run_commands(
+            f"cd {tmp_path}",
+            'GREETING=hi; greet() { echo "$GREETING there"; }',
+            "greet; pwd",
+        )
+        assert results[2].stdout == f"hi there\n{tmp_path}\n"
+        assert cwd == str(tmp_path)
+
+    def test_syntax_error_does_not_kill_shell(self):
+        results, _cwd, alive = self._run_commands("if", "echo still here")
+        assert results[0].exit_code == 2
+        assert (
+            "Syntax error" in results[0].stderr or "syntax error" in results[0].stderr
+        )
+        assert results[1].stdout == "still here\n"
+        assert alive is True
+
+    @pytest.mark.skipif(not Path("/bin/bash").exists(), reason="needs bash")
+    def test_runs_in_the_login_shell(self):
+        results, _cwd, alive = self._run_commands(
+            "a=(x y); echo ${a[1]}",
+            "cat <(echo sub)",
+            "echo $BASH_VERSION",
+            login_shell="/bin/bash",
+        )
+        assert [r.exit_code for r in results] == [0, 0, 0]
+        assert results[0].stdout == "y\n"
+        assert results[1].stdout == "sub\n"
+        assert results[2].stdout.strip()
+        assert alive is True
+
+    def test_non_posix_login_shell_falls_back_to_sh(self):
+        (result,), _cwd, _alive = self._run_commands(
+            "echo $0", login_shell="/usr/bin/fish"
+        )
+        assert result.stdout == "sh\n"
+
+    def test_command_cannot_read_protocol_stdin(self):
+        """A command reading stdin sees EOF instead of the framing lines."""
+        results, _cwd, _alive = self._run_commands("cat", "echo next")
+        assert results[0].stdout == ""
+        assert results[1].stdout == "next\n"
+
+    def test_exit_closes_shell(self):
+        results, _cwd, alive = self._run_commands("exit 7", "echo never")
+        assert results[0].error
+        assert alive is False
+        assert results[1].error == "remote shell closed"
+
+    def test_timeout_kills_shell(self):
+        (result,), _cwd, alive = self._run_commands("sleep 5", timeout=0.2)
+        assert result.timed_out is True
+        assert alive is False
+
+
+class TestReplPersistentShell:
+    """Tests for ReplSession running commands through persistent shells."""
+
+    def _make_session(self, transport, hosts=None):
+        hosts = hosts or [
+            HostDefinition(name="web1", hostname="10.0.0.1"),
+            HostDefinition(name="web2", hostname="10.0.0.2"),
+        ]
+        buf = io.StringIO()
+        formatter = OutputFormatter(color="never", is_tty=False, file=buf)
+        session = ReplSession(
+            hosts=hosts,
+            formatter=formatter,
+            history_file=Path("/tmp/test_history_nonexistent"),
+            transport=transport,
+            persistent_shell=True,
+        )
+        return session, buf
+
+    def test_initial_connect_opens_one_shell_per_host(self):
+        transport = _LocalShellTransport()
+        session, _buf = self._make_session(transport)
+        try:
+            assert session._initial_connect() is True
+            assert set(session.shells) == {"web1", "web2"}
+            assert session.working_dirs["web1"]
+        finally:
+            session._close_connections()
+
+    def test_cd_runs_in_shell_without_extra_round_trip(self, tmp_path):
+        transport = _LocalShellTransport()
+        session, buf = self._make_session(transport)
+        try:
+            session._initial_connect()
+            session._execute_command(f"cd {tmp_path}")
+            session._execute_command("pwd")
+        finally:
+            session._close_connections()
+        assert session.working_dirs == {"web1": str(tmp_path), "web2": str(tmp_path)}
+        assert f"[web1] {tmp_path}" in buf.getvalue()
+        assert transport.opened == 2
+
+    def test_unreachable_host_marked_disconnected(self, capsys):
+        transport = _LocalShellTransport(fail_hosts={"web2"})
+        session, _buf = self._make_session(transport)
+        try:
+            assert session._initial_connect() is True
+        finally:
+            session._close_connections()
+        assert session.connected == {"web1": True, "web2": False}
+        assert "Connection refused" in capsys.readouterr().err
+
+    def test_dead_shell_is_reopened_in_background(self, capsys):
+        transport = _LocalShellTransport()
+        session, buf = self._make_session(
+            transport, [HostDefinition(name="web1", hostname="10.0.0.1")]
+        )
+        session.reconnect = ReconnectManager(base_delay=0.0, jitter=0.0)
+        try:
+            session._initial_connect()
+            session._execute_command("exit 1")
+            assert session.connected["web1"] is False
+            session._run(session._reconnect_due())
+            assert session.connected["web1"] is True
+            session._execute_command("echo back")
+        finally:
+            session._close_connections()
+        assert "[web1] back" in buf.getvalue()
+        assert "[web1] reconnected" in capsys.readouterr().err
+        assert transport.opened == 2
+
+    def test_concurrent_reconnects_do_not_leak_shells(self):
+        shells = []
+
+        class Tracking(_LocalShellTransport):
+            async def open_shell(self, host, connection_timeout):
+                await asyncio.sleep(0.05)  # both reconnects are in flight
+                shells.append(await super().open_shell(host, connection_timeout))
+                return shells[-1]
+
+        host = HostDefinition(name="web1", hostname="10.0.0.1")
+        session, _buf = self._make_session(Tracking(), [host])
+
+        async def race():
+            return await asyncio.gather(
+                session._probe_hosts([host]), session._probe_hosts([host])
+            )
+
+        try:
+            session._run(race())
+            assert len(shells) == 2
+            assert [shell.alive for shell in shells] == [False, True]
+            assert session.shells["web1"] is shells[1]
+        finally:
+            session._close_connections()
+
+    def test_disconnected_host_is_skipped_without_reconnect_attempt(self, capsys):
+        transport = _LocalShellTransport()
+        session, buf = self._make_session(
+            transport, [HostDefinition(name="web1", hostname="10.0.0.1")]
+        )
+        try:
+            session._initial_connect()
+            session._execute_command("exit 1")
+            session._execute_command("echo back")
+        finally:
+            session._close_connections()
+        assert "[web1] back" not in buf.getvalue()
+        assert transport.opened == 1
+
+    def test_reconnect_failure_backs_off(self):
+        transport = _LocalShellTransport(fail_hosts={"web1"})
+        clock = [0.0]
+        session, _buf = self._make_session(
+            transport, [HostDefinition(name="web1", hostname="10.0.0.1")]
+        )
+        session.reconnect = ReconnectManager(
+            base_delay=10.0, jitter=0.0, clock=lambda: clock[0]
+        )
+        try:
+            session._initial_connect()
+            assert transport.attempts == 1
+            session._run(session._reconnect_due())  # still inside the 10s window
+            assert transport.attempts == 1
+            clock[0] = 10.0
+            session._run(session._reconnect_due())
+            assert transport.attempts == 2
+            assert session.reconnect.retry_in("web1") == 20.0
+        finally:
+            session._close_connections()
+
+
+# ---------------------------------------------------------------------------
+# Unit Tests: reconnect backoff
+# ---------------------------------------------------------------------------
+
+ReconnectManager = ssh_tool.ReconnectManager
+
+
+class TestReconnectManager:
+    """Tests for the exponential backoff schedule."""
+
+    def _manager(self, **kwargs):
+        clock = [100.0]
+        manager = ReconnectManager(clock=lambda: clock[0], **kwargs)
+        return manager, clock
+
+    def test_unknown_host_is_due(self):
+        manager, _clock = self._manager()
+        assert manager.is_due("web1")
+        assert manager.retry_in("web1") == 0.0
+
+    def test_delay_doubles_up_to_max(self):
+        manager, _clock = self._manager(base_delay=1.0, max_delay=5.0, jitter=0.0)
+        delays = [manager.record_failure("web1") for _ in range(5)]
+        assert delays == [1.0, 2.0, 4.0, 5.0, 5.0]
+
+    def test_not_due_until_window_elapses(self):
+        manager, clock = self._manager(base_delay=2.0, jitter=0.0)
+        manager.record_failure("web1", "Connection refused")
+        assert not manager.is_due("web1")
+        assert manager.retry_in("web1") == 2.0
+        assert manager.health["web1"].last_error == "Connection refused"
+        clock[0] += 2.0
+        assert manager.is_due("web1")
+
+    def test_jitter_stays_within_bounds(self):
+        manager, _clock = self._manager(base_delay=10.0, jitter=0.2)
+        for _ in range(50):
+            manager.health.clear()
+            assert 8.0 <= manager.record_failure("web1") <= 12.0
+
+    def test_success_resets_backoff(self):
+        manager, _clock = self._manager(jitter=0.0)
+        manager.record_failure("web1")
+        manager.record_failure("web1")
+        manager.record_success("web1")
+        assert manager.is_due("web1")
+        assert manager.record_failure("web1") == 1.0
+
+
+# ---------------------------------------------------------------------------
+# Unit Tests: background event loop for the REPL
+# ---------------------------------------------------------------------------
+
+EventLoopThread = ssh_tool.EventLoopThread
+
+
+class TestEventLoopThread:
+    """Tests for the long-lived background event loop."""
+
+    def test_run_returns_result_on_same_loop(self):
+        loop_thread = EventLoopThread()
+
+        async def current_loop():
+            return asyncio.get_running_loop()
+
+        try:
+            first = loop_thread.run(current_loop())
+            second = loop_thread.run(current_loop())
+        finally:
+            loop_thread.stop()
+        assert first is second
+
+    def test_runs_off_the_main_thread(self):
+        import threading
+
+        loop_thread = EventLoopThread()
+
+        async def thread_name():
+            return threading.current_thread().name
+
+        try:
+            assert loop_thread.run(thread_name()) == "ssh-tool-loop"
+        finally:
+            loop_thread.stop()
+
+    def test_submitted_work_runs_in_background(self):
+        """Work submitted without waiting progresses while the caller is idle."""
+        import time as _time
+
+        loop_thread = EventLoopThread()
+        ticks = []
+
+        async def ticker():
+            while True:
+                ticks.append(1)
+                await asyncio.sleep(0.01)
+
+        try:
+            loop_thread.submit(ticker())
+            _time.sleep(0.1)
+        finally:
+            loop_thread.stop()
+        assert len(ticks) >= 3
+
+    def test_stop_cancels_background_tasks(self):
+        loop_thread = EventLoopThread()
+        cancelled = []
+
+        async def forever():
+            try:
+                await asyncio.sleep(3600)
+            except asyncio.CancelledError:
+                cancelled.append(True)
+                raise
+
+        loop_thread.submit(forever())
+        loop_thread.run(asyncio.sleep(0))
+        loop_thread.stop()
+        assert cancelled == [True]
+
+    def test_exceptions_propagate(self):
+        loop_thread = EventLoopThread()
+
+        async def boom():
+            raise ValueError("boom")
+
+        try:
+            with pytest.raises(ValueError, match="boom"):
+                loop_thread.run(boom())
+        finally:
+            loop_thread.stop()
+
+
+class TestReplBackgroundLoop:
+    """Tests for ReplSession's use of one persistent loop."""
+
+    def _make_session(self, transport, keepalive_interval=0.0):
+        hosts = [HostDefinition(name="web1", hostname="10.0.0.1")]
+        formatter = OutputFormatter(color="never", is_tty=False, file=io.StringIO())
+        return ReplSession(
+            hosts=hosts,
+            formatter=formatter,
+            history_file=Path("/tmp/test_history_nonexistent"),
+            transport=transport,
+            persistent_shell=True,
+            keepalive_interval=keepalive_interval,
+        )
+
+    def test_commands_share_one_loop(self):
+        session = self._make_session(_LocalShellTransport())
+
+        async def current_loop():
+            return asyncio.get_running_loop()
+
+        try:
+            assert session._run(current_loop()) is session._run(current_loop())
+        finally:
+            session._close_connections()
+
+    def test_keepalive_marks_dead_host_disconnected(self, capsys):
+        import time as _time
+
+        session = self._make_session(_LocalShellTransport(), keepalive_interval=0.05)
+        try:
+            session._initial_connect()
+            assert session.connected["web1"] is True
+            # Kill the shell behind the session's back, then let the keepalive notice
+            session._run(session.shells["web1"].close())
+            session._loop_thread.submit(session._keepalive())
+            deadline = _time.monotonic() + 2.0
+            while session.connected["web1"] and _time.monotonic() < deadline:
+                _time.sleep(0.02)
+        finally:
+            session._close_connections()
+        assert session.connected["web1"] is False
+        assert "health check failed" in capsys.readouterr().err
+
+
+# ---------------------------------------------------------------------------
+# Unit Tests: rolling / batched execution
+# ---------------------------------------------------------------------------
+
+BatchPolicy = ssh_tool.BatchPolicy
+parse_batch_size = ssh_tool.parse_batch_size
+format_summary = ssh_tool.format_summary
+
+
+class _ScriptedTransport(Transport):
+    """Transport that fails the given hosts and records the start order."""
+
+    def __init__(self, fail_hosts=()):
+        self.fail_hosts = set(fail_hosts)
+        self.started = []
+
+    async def run(
+        self, host, remote_cmd, timeout, connection_timeout, on_line=None, **kwargs
+    ):
+        self.started.append(host.name)
+        await asyncio.sleep(0)
+        exit_code = 1 if host.name in self.fail_hosts else 0
+        return CommandResult(host=host, stdout="ok\n", stderr="", exit_code=exit_code)
+
+
+class TestBatchPolicy:
+    """Tests for batch splitting and the failure threshold."""
+
+    hosts = tuple(f"h{i}" for i in range(10))
+
+    def test_fixed_size_batches(self):
+        policy = BatchPolicy(size=4)
+        assert policy.batches(self.hosts) == [
+            self.hosts[0:4],
+            self.hosts[4:8],
+            self.hosts[8:],
+        ]
+
+    def test_percent_batches_round_up(self):
+        policy = BatchPolicy(percent=25)
+        assert [len(b) for b in policy.batches(self.hosts)] == [3, 3, 3, 1]
+
+    def test_canary_batch_comes_first(self):
+        policy = BatchPolicy(size=5, canary=1)
+        assert [len(b) for b in policy.batches(self.hosts)] == [1, 5, 4]
+
+    def test_no_size_is_one_batch(self):
+        assert BatchPolicy(max_failures=1).batches(self.hosts) == [self.hosts]
+
+    def test_failure_limit_uses_strictest_threshold(self):
+        assert BatchPolicy().failure_limit(100) is None
+        assert BatchPolicy(max_failures=5).failure_limit(100) == 5
+        assert BatchPolicy(max_failures=5, max_fail_percent=2).failure_limit(100) == 2
+
+    @pytest.mark.parametrize(
+        "value,expected",
+        [("10", (10, None)), ("25%", (None, 25.0)), ("100%", (None, 100.0))],
+    )
+    def test_parse_batch_size(self, value, expected):
+        assert parse_batch_size(value) == expected
+
+    @pytest.mark.parametrize("value", ["0", "-1", "abc", "0%", "150%", "%"])
+    def test_parse_batch_size_rejects_invalid(self, value):
+        with pytest.raises(ValidationError, match="invalid --batch-size value"):
+            parse_batch_size(value)
+
+
+class TestBatchedExecution:
+    """Tests for run_command_on_all with a BatchPolicy."""
+
+    def _make_hosts(self, count):
+        return [
+            HostDefinition(name=f"h{i:02d}", hostname=f"10.0.0.{i}")
+            for i in range(count)
+        ]
+
+    def _run(self, hosts, transport, **kwargs):
+        return asyncio.run(
+            run_command_on_all(hosts, "deploy", transport=transport, **kwargs)
+        )
+
+    def test_batches_run_in_order_and_never_overlap(self):
+        hosts = self._make_hosts(6)
+        in_flight = {"now": 0, "peak": 0}
+
+        class Tracking(_ScriptedTransport):
+            async def run(self, host, *args, **kwargs):
+                in_flight["now"] += 1
+                in_flight["peak"] = max(in_flight["peak"], in_flight["now"])
+                try:
+                    return await super().run(host, *args, **kwargs)
+                finally:
+                    in_flight["now"] -= 1
+
+        results = self._run(hosts, Tracking(), batch=BatchPolicy(size=2), forks=10)
+        assert in_flight["peak"] == 2
+        assert [r.host.name for r in results] == [h.name for h in hosts]
+        assert not any(r.skipped for r in results)
+
+    def test_max_failures_skips_remaining_hosts(self):
+        hosts = self._make_hosts(6)
+        transport = _ScriptedTransport(fail_hosts={"h00", "h01"})
+        results = self._run(hosts, transport, batch=BatchPolicy(size=2, max_failures=1))
+        assert transport.started == ["h00", "h01"]
+        assert [r.skipped for r in results] == [False, False, True, True, True, True]
+        assert format_summary(results) == "6 host(s): 0 ok, 2 failed, 4 skipped"
+
+    def test_trip_cancels_queued_hosts_within_batch(self):
+        hosts = self._make_hosts(5)
+        transport = _ScriptedTransport(fail_hosts={"h00"})
+        results = self._run(
+            hosts, transport, sequential=True, batch=BatchPolicy(max_failures=0)
+        )
+        assert transport.started == ["h00"]
+        assert sum(r.skipped for r in results) == 4
+
+    def test_failed_canary_stops_the_run(self):
+        hosts = self._make_hosts(5)
+        transport = _ScriptedTransport(fail_hosts={"h00"})
+        results = self._run(hosts, transport, batch=BatchPolicy(canary=1))
+        assert transport.started == ["h00"]
+        assert compute_exit_code(results) == 1
+
+    def test_failures_under_threshold_continue(self):
+        hosts = self._make_hosts(10)
+        transport = _ScriptedTransport(fail_hosts={"h03"})
+        results = self._run(
+            hosts, transport, batch=BatchPolicy(size=3, max_fail_percent=10)
+        )
+        assert len(transport.started) == 10
+        assert not any(r.skipped for r in results)
+
+    def test_pause_between_batches(self):
+        hosts = self._make_hosts(3)
+        with patch("asyncio.sleep", wraps=asyncio.sleep) as sleep:
+            self._run(
+                hosts, _ScriptedTransport(), batch=BatchPolicy(size=1, pause=0.01)
+            )
+        assert [c.args[0] for c in sleep.call_args_list].count(0.01) == 2
+
+    def test_immediate_mode_reports_skipped_hosts(self, capsys):
+        buf = io.StringIO()
+        formatter = OutputFormatter(color="never", is_tty=False, file=buf)
+        exit_code = run_immediate_mode(
+            self._make_hosts(3),
+            "deploy",
+            formatter,
+            sequential=True,
+            transport=_ScriptedTransport(fail_hosts={"h00"}),
+            batch=BatchPolicy(max_failures=0),
+        )
+        assert exit_code == 1
+        assert "[h01] (skipped)" in buf.getvalue()
+        assert "2 host(s) skipped" in capsys.readouterr().err
+
+    def test_cli_rejects_invalid_batch_size(self):
+        result = CliRunner().invoke(
+            app, ["--hosts", "web1", "--batch-size", "0", "uptime"]
+        )
+        assert result.exit_code == 1
+        assert "invalid --batch-size value" in result.output
+
+
+# ---------------------------------------------------------------------------
+# Unit Tests: output aggregation
+# ---------------------------------------------------------------------------
+
+ResultAggregator = ssh_tool.ResultAggregator
+format_host_ranges = ssh_tool.format_host_ranges
+
+
+class TestFormatHostRanges:
+    """Tests for compact host list rendering."""
+
+    def test_consecutive_numbers_collapse(self):
+        assert (
+            format_host_ranges(["web01", "web02", "web03", "web05"]) == "web[01-03,05]"
+        )
+
+    def test_unordered_input_is_sorted(self):
+        assert format_host_ranges(["db3", "db1", "db2"]) == "db[1-3]"
+
+    def test_single_numbered_host_is_plain(self):
+        assert format_host_ranges(["web01"]) == "web01"
+
+    def test_names_without_numbers_listed_as_is(self):
+        assert format_host_ranges(["gamma", "alpha"]) == "alpha,gamma"
+
+    def test_suffix_and_ip_addresses(self):
+        assert format_host_ranges(["n1.dc", "n2.dc"]) == "n[1-2].dc"
+        assert (
+            format_host_ranges(["10.0.0.1", "10.0.0.2", "10.0.0.4"]) == "10.0.0.[1-2,4]"
+        )
+
+    def test_different_widths_are_not_merged(self):
+        assert format_host_ranges(["web9", "web10", "web11"]) == "web[10-11],web9"
+
+
+class TestResultAggregator:
+    """Tests for grouping identical results."""
+
+    def _result(self, name, stdout="5.15.0\n", stderr="", exit_code=0):
+        return CommandResult(
+            host=HostDefinition(name=name, hostname=name),
+            stdout=stdout,
+            stderr=stderr,
+            exit_code=exit_code,
+        )
+
+    def test_identical_results_share_a_group(self):
+        aggregator = ResultAggregator()
+        for i in range(100):
+            aggregator.add(self._result(f"web{i:03d}"))
+        groups = aggregator.groups()
+        assert len(groups) == 1
+        assert len(groups[0].hosts) == 100
+
+    def test_exit_code_and_stderr_distinguish_groups(self):
+        aggregator = ResultAggregator()
+        aggregator.add(self._result("a1"))
+        aggregator.add(self._result("a2", exit_code=1))
+        aggregator.add(self._result("a3", stderr="warn"))
+        aggregator.add(self._result("a4"))
+        groups = aggregator.groups()
+        assert [g.hosts for g in groups] == [["a1", "a4"], ["a2"], ["a3"]]
+
+    def test_formatter_prints_each_distinct_output_once(self):
+        buf = io.StringIO()
+        formatter = OutputFormatter(
+            color="never", is_tty=False, file=buf, aggregate=True
+        )
+        results = [self._result(f"web{i:02d}") for i in range(1, 6)] + [
+            self._result("db1", stdout="4.19\n")
+        ]
+        formatter.format_results(results)
+        assert buf.getvalue().splitlines() == ["[web[01-05]] 5.15.0", "[db1] 4.19"]
+
+    def test_tty_header_shows_host_count(self):
+        buf = io.StringIO()
+        formatter = OutputFormatter(
+            color="never", is_tty=True, file=buf, aggregate=True
+        )
+        formatter.format_results([self._result("web1"), self._result("web2")])
+        assert "--- web[1-2] (2 host(s)) ---" in buf.getvalue()
+
+    def test_immediate_mode_aggregates_incrementally(self):
+        buf = io.StringIO()
+        formatter = OutputFormatter(
+            color="never", is_tty=False, file=buf, aggregate=True
+        )
+        hosts = [
+            HostDefinition(name=f"h{i:02d}", hostname=f"10.0.0.{i}") for i in range(4)
+        ]
+        exit_code = run_immediate_mode(
+            hosts,
+            "uname -r",
+            formatter,
+            transport=_ScriptedTransport(fail_hosts={"h03"}),
+            stream=True,
+        )
+        assert exit_code == 1
+        assert buf.getvalue().splitlines() == [
+            "[h[00-02]] ok",
+            "[h03] ok",
+            "[h03] exited with code 1",
+        ]
+
+
+# ---------------------------------------------------------------------------
+# Unit Tests: bounded output capture
+# ---------------------------------------------------------------------------
+
+OutputCapture = ssh_tool.OutputCapture
+CaptureLimits = ssh_tool.CaptureLimits
+parse_size = ssh_tool.parse_size
+
+
+class TestOutputCapture:
+    """Tests for head/tail retention and spill files."""
+
+    def test_unlimited_keeps_everything(self):
+        capture = OutputCapture()
+        for chunk in (b"abc", b"def"):
+            capture.write(chunk)
+        assert capture.getvalue() == b"abcdef"
+        assert capture.omitted == 0
+
+    def test_limit_keeps_head_and_tail(self):
+        capture = OutputCapture(limit=8)
+        for i in range(100):
+            capture.write(b"%02d" % i)
+        assert capture.total == 200
+        assert capture.omitted == 192
+        assert capture.getvalue() == b"0001\n[... 192 bytes omitted ...]\n9899"
+
+    def test_output_within_limit_is_unchanged(self):
+        capture = OutputCapture(limit=100)
+        capture.write(b"hello\n")
+        assert capture.getvalue() == b"hello\n"
+
+    def test_spill_file_holds_full_output(self, tmp_path):
+        path = tmp_path / "web1.stdout"
+        capture = OutputCapture(limit=4, path=path)
+        capture.write(b"x" * 1000)
+        capture.close()
+        assert path.read_bytes() == b"x" * 1000
+        assert len(capture.getvalue()) < 100
+
+    @pytest.mark.parametrize(
+        "value,expected",
+        [("100", 100), ("4k", 4096), ("10M", 10 * 1024**2), ("1GB", 1024**3)],
+    )
+    def test_parse_size(self, value, expected):
+        assert parse_size(value) == expected
+
+    @pytest.mark.parametrize("value", ["0", "-1", "ten", "5T"])
+    def test_parse_size_rejects_invalid(self, value):
+        with pytest.raises(ValidationError, match="invalid size"):
+            parse_size(value)
+
+
+class TestCapturedExecution:
+    """Tests for run_command_on_host with CaptureLimits."""
+
+    host = HostDefinition(name="web1", hostname="10.0.0.1")
+
+    def _run(self, out_chunks, capture, on_line=None):
+        fake_exec = _make_streaming_exec({"10.0.0.1": (out_chunks, [b"warn\n"], 0)})
+        with patch("asyncio.create_subprocess_exec", side_effect=fake_exec):
+            return asyncio.run(
+                run_command_on_host(
+                    self.host, "cat big.log", capture=capture, on_line=on_line
+                )
+            )
+
+    def test_max_bytes_truncates_in_memory_output(self):
+        result = self._run([b"a" * 1000, b"b" * 1000], CaptureLimits(max_bytes=10))
+        assert result.stdout == "aaaaa\n[... 1990 bytes omitted ...]\nbbbbb"
+        assert result.stderr == "warn\n"
+        assert result.stdout_file is None
+
+    def test_output_dir_spills_full_output(self, tmp_path):
+        chunks = [b"line %d\n" % i for i in range(5000)]
+        result = self._run(chunks, CaptureLimits(output_dir=tmp_path))
+        assert result.stdout_file == tmp_path / "web1.stdout"
+        assert result.stdout_file.read_bytes() == b"".join(chunks)
+        assert (tmp_path / "web1.stderr").read_bytes() == b"warn\n"
+
+    def test_live_lines_still_reported(self):
+        lines = []
+        self._run(
+            [b"one\ntw", b"o\n"],
+            CaptureLimits(max_bytes=4),
+            on_line=lambda h, line, err: lines.append(line),
+        )
+        assert lines == ["one", "two", "warn"]
+
+    def test_formatter_streams_spilled_output_from_file(self, tmp_path):
+        chunks = [b"line %d\n" % i for i in range(3)]
+        result = self._run(chunks, CaptureLimits(max_bytes=4, output_dir=tmp_path))
+        buf = io.StringIO()
+        OutputFormatter(color="never", is_tty=False, file=buf).format_results([result])
+        assert buf.getvalue().splitlines() == [
+            "[web1] line 0",
+            "[web1] line 1",
+            "[web1] line 2",
+            "[web1] ERR: warn",
+        ]
+
+    def test_cli_rejects_invalid_max_output(self):
+        result = CliRunner().invoke(
+            app, ["--hosts", "web1", "--max-output", "lots", "uptime"]
+        )
+        assert result.exit_code == 1
+        assert "--max-output: invalid size" in result.output
+
+
+# ---------------------------------------------------------------------------
+# Unit Tests: plain-text piped output
+# ---------------------------------------------------------------------------
+
+PlainWriter = ssh_tool.PlainWriter
+from rich.console import Console
+
+
+class TestPlainWriter:
+    """Tests for the bulk piped-mode writer."""
+
+    def test_prefixes_every_line(self):
+        buf = io.StringIO()
+        writer = PlainWriter(buf)
+        assert writer.write_lines(b"[h] ", b"one\ntwo\n\nthree")
+        writer.flush()
+        assert buf.getvalue() == "[h] one\n[h] two\n[h] \n[h] three\n"
+
+    def test_empty_data_writes_nothing(self):
+        buf = io.StringIO()
+        writer = PlainWriter(buf)
+        assert not writer.write_lines(b"[h] ", b"")
+        writer.flush()
+        assert buf.getvalue() == ""
+
+    def test_crlf_is_normalized(self):
+        buf = io.StringIO()
+        writer = PlainWriter(buf)
+        writer.write_lines(b"[h] ", b"a\r\nb\r\n")
+        writer.flush()
+        assert buf.getvalue() == "[h] a\n[h] b\n"
+
+    @pytest.mark.parametrize(
+        "text",
+        [
+            "10%\r50%\r100%\n",
+            "a\x0bb\x0cc\x1cd",
+            "a\u2028b\u2029c\x85d\n",
+            "a\r\rb\r\n\n",
+            "caf\u00e9\r\n\udcff\n",
+        ],
+    )
+    def test_line_breaks_match_splitlines(self, text):
+        buf = io.StringIO()
+        writer = PlainWriter(buf)
+        writer.write_lines(b"[h] ", text.encode(errors="surrogateescape"))
+        writer.flush()
+        expected = "".join(f"[h] {line}\n" for line in text.splitlines())
+        assert buf.getvalue() == expected.encode(errors="surrogateescape").decode(
+            errors="replace"
+        )
+
+    @pytest.mark.parametrize(
+        "text",
+        [
+            "10%\r50%\r100%\n",
+            "a\x0bb\x0cc\x1cd",
+            "a\u2028b\u2029c\x85d\n",
+            "a\r\rb\r\n\n",
+            "one\r",
+        ],
+    )
+    def test_streamed_lines_match_piped_lines(self, text, monkeypatch):
+        monkeypatch.setattr(ssh_tool, "_READ_CHUNK_SIZE", 1)  # splits "\r\n" too
+
+        async def stream():
+            reader = asyncio.StreamReader()
+            reader.feed_data(text.encode())
+            reader.feed_eof()
+            lines = []
+            await ssh_tool._stream_lines(reader, io.BytesIO(), lines.append)
+            return lines
+
+        buf = io.StringIO()
+        writer = PlainWriter(buf)
+        writer.write_lines(b"", text.encode())
+        writer.flush()
+        assert asyncio.run(stream()) == text.splitlines() == buf.getvalue().splitlines()
+
+    def test_writes_bytes_to_binary_buffer(self):
+        raw = io.BytesIO()
+        text = io.TextIOWrapper(raw, encoding="ascii")
+        writer = PlainWriter(text)
+        text.write("before\n")
+        writer.write_lines(b"[h] ", "café\n".encode())
+        writer.flush()
+        assert raw.getvalue() == "before\n[h] café\n".encode()
+
+    def test_write_file_handles_lines_across_chunks(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(ssh_tool, "_PLAIN_BUFFER_SIZE", 7)
+        path = tmp_path / "out"
+        path.write_bytes(b"".join(b"line %d\n" % i for i in range(20)) + b"tail")
+        buf = io.StringIO()
+        writer = PlainWriter(buf)
+        assert writer.write_file(b"[h] ", path)
+        writer.flush()
+        assert buf.getvalue().splitlines() == [f"[h] line {i}" for i in range(20)] + [
+            "[h] tail"
+        ]
+
+    def test_long_lines_are_not_wrapped(self):
+        buf = io.StringIO()
+        formatter = OutputFormatter(color="never", is_tty=False, file=buf)
+        line = "x" * 500
+        formatter.format_results(
+            [
+                CommandResult(
+                    host=HostDefinition(name="h", hostname="h"),
+                    stdout=line,
+                    stderr="",
+                    exit_code=0,
+                )
+            ]
+        )
+        assert buf.getvalue() == f"[h] {line}\n"
+
+    def test_benchmark_against_rich_console(self):
+        """Piped formatting throughput vs. one Rich console.print per line."""
+        import time as _time
+
+        host = HostDefinition(name="web01", hostname="10.0.0.1")
+        stdout = "".join(
+            f"Oct 18 12:00:{i % 60:02d} web01 app[123]: request {i} served\n"
+            for i in range(5_000)
+        )
+        result = CommandResult(host=host, stdout=stdout, stderr="", exit_code=0)
+        line_count = stdout.count("\n")
+
+        console = Console(
+            file=io.StringIO(), force_terminal=False, no_color=True, highlight=False
+        )
+        start = _time.perf_counter()
+        for line in stdout.splitlines():
+            console.print(f"[{host.name}] {line}", markup=False, highlight=False)
+        rich_rate = line_count / (_time.perf_counter() - start)
+
+        formatter = OutputFormatter(color="never", is_tty=False, file=io.StringIO())
+        start = _time.perf_counter()
+        formatter.format_results([result])
+        plain_rate = line_count / (_time.perf_counter() - start)
+
+        print(
+            f"\nrich: {rich_rate:,.0f} lines/sec  plain: {plain_rate:,.0f} lines/sec  ({plain_rate / rich_rate:.0f}x)"
+        )
+        assert plain_rate > 10 * rich_rate
+
+
+# ---------------------------------------------------------------------------
+# Unit Tests: JSON Lines output
+# ---------------------------------------------------------------------------
+
+import json
+
+result_to_json = ssh_tool.result_to_json
+HostTiming = ssh_tool.HostTiming
+
+
+class TestJsonLinesOutput:
+    """Tests for --format jsonl."""
+
+    host = HostDefinition(name="web1", hostname="10.0.0.1")
+
+    def test_result_to_json_fields(self):
+        result = CommandResult(
+            host=self.host,
+            stdout="hi\n",
+            stderr="",
+            exit_code=0,
+            timing=HostTiming(started=1.0, connected=1.5, finished=2.0),
+        )
+        assert result_to_json(result) == {
+            "host": "web1",
+            "hostname": "10.0.0.1",
+            "exit_code": 0,
+            "timed_out": False,
+            "error": None,
+            "skipped": False,
+            "failure": None,
+            "attempts": 1,
+            "stdout": "hi\n",
+            "stderr": "",
+            "started": 1.0,
+            "spawned": None,
+            "connected": 1.5,
+            "first_byte": None,
+            "finished": 2.0,
+        }
+
+    def test_spilled_stream_reports_bytes_and_path(self, tmp_path):
+        path = tmp_path / "web1.stdout"
+        path.write_bytes(b"x" * 123)
+        result = CommandResult(
+            host=self.host, stdout="xx", stderr="", exit_code=0, stdout_file=path
+        )
+        record = result_to_json(result)
+        assert record["stdout"] is None
+        assert record["stdout_bytes"] == 123
+        assert record["stdout_file"] == str(path)
+
+    def test_formatter_writes_one_object_per_line(self):
+        buf = io.StringIO()
+        formatter = OutputFormatter(
+            color="never", is_tty=True, file=buf, output_format="jsonl"
+        )
+        formatter.format_results(
+            [
+                CommandResult(host=self.host, stdout="a", stderr="", exit_code=0),
+                CommandResult(
+                    host=HostDefinition(name="web2", hostname="10.0.0.2"),
+                    stdout="",
+                    stderr="boom",
+                    exit_code=2,
+                ),
+            ]
+        )
+        records = [json.loads(line) for line in buf.getvalue().splitlines()]
+        assert [(r["host"], r["exit_code"], r["stderr"]) for r in records] == [
+            ("web1", 0, ""),
+            ("web2", 2, "boom"),
+        ]
+
+    def test_immediate_mode_emits_each_host_as_it_completes(self):
+        buf = io.StringIO()
+        formatter = OutputFormatter(
+            color="never", is_tty=False, file=buf, output_format="jsonl"
+        )
+        hosts = [HostDefinition(name=f"h{i}", hostname=f"10.0.0.{i}") for i in range(3)]
+        seen = []
+
+        class Observing(_ScriptedTransport):
+            async def run(self, host, *args, **kwargs):
+                # Everything finished so far is already on the output
+                seen.append(len(buf.getvalue().splitlines()))
+                return await super().run(host, *args, **kwargs)
+
+        exit_code = run_immediate_mode(
+            hosts, "uptime", formatter, sequential=True, transport=Observing()
+        )
+        assert exit_code == 0
+        assert seen == [0, 1, 2]
+        records = [json.loads(line) for line in buf.getvalue().splitlines()]
+        assert [r["host"] for r in records] == ["h0", "h1", "h2"]
+        assert all(r["started"] <= r["finished"] for r in records)
+
+    def test_cli_rejects_unknown_format(self):
+        result = CliRunner().invoke(
+            app, ["--hosts", "web1", "--format", "xml", "uptime"]
+        )
+        assert result.exit_code == 1
+        assert "invalid --format value" in result.output
+
+
+# ---------------------------------------------------------------------------
+# Unit Tests: per-host timing instrumentation
+# ---------------------------------------------------------------------------
+
+percentile = ssh_tool.percentile
+format_latency_report = ssh_tool.format_latency_report
+write_chrome_trace = ssh_tool.write_chrome_trace
+
+_real_create_subprocess_exec = asyncio.create_subprocess_exec
+
+
+async def _exec_locally(*args, **kwargs):
+    """Run the remote command of an ssh invocation in a local sh instead."""
+    return await _real_create_subprocess_exec("sh", "-c", args[-1], **kwargs)
+
+
+class TestHostTiming:
+    """Tests for phase timestamps recorded with trace=True."""
+
+    host = HostDefinition(name="web1", hostname="10.0.0.1")
+
+    def test_subprocess_records_every_phase_and_strips_marker(self):
+        with patch("asyncio.create_subprocess_exec", side_effect=_exec_locally):
+            result = asyncio.run(
+                run_command_on_host(
+                    self.host, "sleep 0.05; echo hi; echo warn >&2", trace=True
+                )
+            )
+        t = result.timing
+        assert result.stdout == "hi\n"
+        assert result.stderr == "warn\n"
+        assert t.started <= t.spawned <= t.connected <= t.first_byte <= t.finished
+        assert t.first_byte - t.connected >= 0.04
+
+    def test_without_trace_only_start_and_finish(self):
+        with patch("asyncio.create_subprocess_exec", side_effect=_exec_locally):
+            result = asyncio.run(run_command_on_host(self.host, "echo hi"))
+        assert result.stdout == "hi\n"
+        assert result.timing.spawned is None and result.timing.connected is None
+        assert result.timing.elapsed is not None
+
+    def test_marker_split_across_reads(self):
+        timing = ssh_tool.HostTiming()
+        marker = ssh_tool._CONNECT_MARKER + b"\n"
+        stream = ssh_tool._ConnectMarkerStream(
+            _FakeStream([b"Warning: added key\n" + marker[:5], marker[5:] + b"err\n"]),
+            timing,
+        )
+
+        async def read_all():
+            chunks = []
+            while chunk := await stream.read(100):
+                chunks.append(chunk)
+            return b"".join(chunks)
+
+        assert asyncio.run(read_all()) == b"Warning: added key\nerr\n"
+        assert timing.connected is not None
+
+    def test_missing_marker_passes_output_through(self):
+        timing = ssh_tool.HostTiming()
+        stream = ssh_tool._ConnectMarkerStream(
+            _FakeStream([b"ssh: connect refused\n"]), timing
+        )
+        assert asyncio.run(stream.read(100)) == b"ssh: connect refused\n"
+        assert asyncio.run(stream.read(100)) == b""
+        assert timing.connected is None
+
+
+class TestLatencyReport:
+    """Tests for --stats percentiles and the Chrome trace."""
+
+    def _results(self, durations):
+        results = []
+        for i, duration in enumerate(durations):
+            timing = ssh_tool.HostTiming(
+                started=100.0, connected=100.0 + duration / 2, finished=100.0 + duration
+            )
+            results.append(
+                CommandResult(
+                    host=HostDefinition(name=f"h{i}", hostname=f"10.0.0.{i}"),
+                    stdout="",
+                    stderr="",
+                    exit_code=0,
+                    timing=timing,
+                )
+            )
+        return results
+
+    def test_percentile_nearest_rank(self):
+        values = list(range(1, 101))
+        assert percentile(values, 50) == 50
+        assert percentile(values, 90) == 90
+        assert percentile(values, 99) == 99
+        assert percentile([3.0], 99) == 3.0
+
+    def test_report_lists_percentiles_and_slowest(self):
+        results = self._results([0.1] * 9 + [2.0])
+        report = format_latency_report(
+            results, ExecutionStats(hosts=10, elapsed=2.0, forks=10)
+        )
+        lines = report.splitlines()
+        assert lines[0].startswith("10 host(s) in 2.00s")
+        assert (
+            "total:" in lines[1]
+            and "p50 0.100s" in lines[1]
+            and "max 2.000s" in lines[1]
+        )
+        assert "connect:" in lines[2]
+        assert lines[-1].strip().startswith("slowest:    h9 (2.000s)")
+
+    def test_chrome_trace(self, tmp_path):
+        path = tmp_path / "trace.json"
+        write_chrome_trace(self._results([1.0, 0.5]), path)
+        events = json.loads(path.read_text())["traceEvents"]
+        host_events = [
+            e for e in events if e["ph"] == "X" and e["name"].startswith("h")
+        ]
+        assert {e["name"]: e["dur"] for e in host_events} == {
+            "h0": 1_000_000.0,
+            "h1": 500_000.0,
+        }
+        assert {e["name"] for e in events if e["ph"] == "X"} >= {"connect", "execute"}
+        assert all(e["ts"] >= 0 for e in events if "ts" in e)
+
+    def test_immediate_mode_writes_trace_file(self, tmp_path):
+        path = tmp_path / "trace.json"
+        formatter = OutputFormatter(color="never", is_tty=False, file=io.StringIO())
+        hosts = [HostDefinition(name="h0", hostname="10.0.0.0")]
+        with patch("asyncio.create_subprocess_exec", side_effect=_exec_locally):
+            run_immediate_mode(hosts, "echo hi", formatter, trace_file=path)
+        names = {e["name"] for e in json.loads(path.read_text())["traceEvents"]}
+        assert {"h0", "connect", "execute", "first byte"} <= names
+
+
+# ---------------------------------------------------------------------------
+# Unit Tests: latency history
+# ---------------------------------------------------------------------------
+
+LatencyStore = ssh_tool.LatencyStore
+HostLatency = ssh_tool.HostLatency
+
+
+@pytest.fixture(autouse=True)
+def _isolated_state_home(tmp_path, monkeypatch):
+    """Keep CLI runs from writing history and caches into the real home directory."""
+    monkeypatch.setenv("XDG_STATE_HOME", str(tmp_path / "state"))
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+
+
+def _timed_result(name, elapsed, exit_code=0, error=None, connect=None):
+    timing = HostTiming(
+        started=100.0,
+        finished=100.0 + elapsed,
+        connected=100.0 + connect if connect is not None else None,
+    )
+    return CommandResult(
+        host=HostDefinition(name=name, hostname=name),
+        stdout="",
+        stderr="",
+        exit_code=exit_code,
+        error=error,
+        timing=timing,
+    )
+
+
+class TestLatencyStore:
+    """Tests for the SQLite latency history."""
+
+    def test_default_path_uses_xdg_state_home(self, tmp_path):
+        assert (
+            LatencyStore.default_path()
+            == tmp_path / "state" / "ssh-tool" / "latency.db"
+        )
+
+    def test_record_and_load_round_trip(self, tmp_path):
+        store = LatencyStore(tmp_path / "db")
+        store.record(
+            "uptime",
+            [
+                _timed_result("a", 2.0, connect=0.5),
+                _timed_result("b", 1.0, exit_code=1),
+            ],
+        )
+        history = store.load("uptime")
+        store.close()
+        assert history["@a:22"].mean == 2.0
+        assert history["@a:22"].connect == 0.5
+        assert history["@b:22"].success_rate == 0.0
+
+    def test_moving_average_and_persistence(self, tmp_path):
+        for elapsed in (1.0, 2.0):
+            store = LatencyStore(tmp_path / "db")
+            store.record("uptime", [_timed_result("a", elapsed)])
+            store.close()
+        entry = LatencyStore(tmp_path / "db").load("uptime")["@a:22"]
+        assert entry.runs == 2
+        assert entry.mean == pytest.approx(1.3)
+        assert entry.var > 0
+
+    def test_connection_errors_do_not_skew_duration(self, tmp_path):
+        store = LatencyStore(tmp_path / "db")
+        store.record("uptime", [_timed_result("a", 1.0)])
+        store.record(
+            "uptime",
+            [_timed_result("a", 10.0, exit_code=255, error="Connection refused")],
+        )
+        entry = store.load("uptime")["@a:22"]
+        assert entry.mean == 1.0
+        assert entry.failures == 1
+
+    def test_other_commands_are_a_fallback(self, tmp_path):
+        store = LatencyStore(tmp_path / "db")
+        store.record("make", [_timed_result("a", 30.0)])
+        entry = store.load("uptime")["@a:22"]
+        assert entry.mean == 30.0
+        assert entry.runs == 0
+
+    def test_command_text_is_never_stored(self, tmp_path):
+        import sqlite3
+
+        path = tmp_path / "db"
+        old = sqlite3.connect(path)
+        with old:
+            old.execute("CREATE TABLE latency (host TEXT, command TEXT)")
+            old.execute("INSERT INTO latency VALUES ('@a:22', 'mysql -psecret')")
+        old.close()
+        store = LatencyStore(path)
+        store.record("mysql -psecret", [_timed_result("a", 1.0)])
+        assert store.load("mysql -psecret")["@a:22"].runs == 1
+        store.close()
+        assert b"secret" not in path.read_bytes()
+
+    def test_rows_are_capped_and_expire(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(ssh_tool, "_HISTORY_MAX_ROWS", 3)
+        store = LatencyStore(tmp_path / "db")
+        for i in range(5):
+            store.record(
+                f"cmd{i}", [_timed_result("a", 1.0), _timed_result(f"h{i}", 1.0)]
+            )
+        db = store._connect()
+        assert db.execute("SELECT COUNT(*) FROM command_latency").fetchone()[0] == 3
+        assert db.execute("SELECT COUNT(*) FROM host_latency").fetchone()[0] == 3
+        with db:
+            db.execute("UPDATE command_latency SET updated = 0")
+        store.record("other", [_timed_result("b", 1.0)])
+        assert db.execute("SELECT COUNT(*) FROM command_latency").fetchone()[0] == 1
+        assert store.load("cmd4")["@a:22"].runs == 0
+        store.close()
+
+    def test_history_is_opt_in(self, fake_fleet, tmp_path):
+        result = CliRunner().invoke(app, ["--hosts", "h01", "echo hi"])
+        assert result.exit_code == 0, result.output
+        assert not LatencyStore.default_path().exists()
+        result = CliRunner().invoke(app, ["--hosts", "h01", "--history", "echo hi"])
+        assert result.exit_code == 0, result.output
+        assert (
+            LatencyStore(LatencyStore.default_path()).load("echo hi")["@h01:22"].runs
+            == 1
+        )
+
+    def test_adaptive_timeout_needs_history_and_is_capped(self):
+        assert HostLatency(runs=2, mean=1.0).adaptive_timeout(30.0) is None
+        assert HostLatency(runs=5, mean=1.0).adaptive_timeout(30.0) == 5.0
+        assert HostLatency(runs=5, mean=4.0, var=1.0).adaptive_timeout(30.0) == 16.0
+        assert HostLatency(runs=5, mean=60.0).adaptive_timeout(30.0) == 30.0
+
+
+class TestLongestFirstScheduling:
+    """Tests for history-driven start order and per-host timeouts."""
+
+    def _hosts(self, count):
+        return [HostDefinition(name=f"h{i}", hostname=f"h{i}") for i in range(count)]
+
+    def test_priority_starts_longest_first_and_keeps_result_order(self):
+        hosts = self._hosts(4)
+        expected = {"h0": 1.0, "h1": 9.0, "h2": 5.0, "h3": 9.0}
+        transport = _ScriptedTransport()
+        results = asyncio.run(
+            run_command_on_all(
+                hosts,
+                "uptime",
+                sequential=True,
+                transport=transport,
+                priority=lambda h: expected[h.name],
+            )
+        )
+        assert transport.started == ["h1", "h3", "h2", "h0"]
+        assert [r.host.name for r in results] == ["h0", "h1", "h2", "h3"]
+
+    def test_per_host_timeouts(self):
+        seen = {}
+
+        class Recording(_ScriptedTransport):
+            async def run(self, host, remote_cmd, timeout, *args, **kwargs):
+                seen[host.name] = timeout
+                return await super().run(host, remote_cmd, timeout, *args, **kwargs)
+
+        asyncio.run(
+            run_command_on_all(
+                self._hosts(2),
+                "uptime",
+                timeout=30.0,
+                transport=Recording(),
+                timeouts={"h0": 7.0},
+            )
+        )
+        assert seen == {"h0": 7.0, "h1": 30.0}
+
+    def test_immediate_mode_uses_and_updates_history(self, tmp_path):
+        path = tmp_path / "db"
+        seed = LatencyStore(path)
+        seed.record("uptime", [_timed_result("h0", 1.0), _timed_result("h1", 8.0)])
+        seed.close()
+        transport = _ScriptedTransport()
+        formatter = OutputFormatter(color="never", is_tty=False, file=io.StringIO())
+        run_immediate_mode(
+            self._hosts(3),
+            "uptime",
+            formatter,
+            sequential=True,
+            transport=transport,
+            history=LatencyStore(path),
+        )
+        # Unknown host first, then slowest known host
+        assert transport.started == ["h2", "h1", "h0"]
+        assert LatencyStore(path).load("uptime")["@h2:22"].runs == 1
+
+    def test_immediate_mode_applies_adaptive_timeouts(self, tmp_path):
+        path = tmp_path / "db"
+        seed = LatencyStore(path)
+        for _ in range(3):
+            seed.record("uptime", [_timed_result("h0", 1.0)])
+        seed.close()
+        seen = {}
+
+        class Recording(_ScriptedTransport):
+            async def run(self, host, remote_cmd, timeout, *args, **kwargs):
+                seen[host.name] = timeout
+                return await super().run(host, remote_cmd, timeout, *args, **kwargs)
+
+        formatter = OutputFormatter(color="never", is_tty=False, file=io.StringIO())
+        run_immediate_mode(
+            self._hosts(2),
+            "uptime",
+            formatter,
+            timeout=60.0,
+            transport=Recording(),
+            history=LatencyStore(path),
+            adaptive_timeout=True,
+        )
+        assert seen == {"h0": 5.0, "h1": 60.0}
+
+
+# ---------------------------------------------------------------------------
+# Unit Tests: file distribution (--push, --script, --relay)
+# ---------------------------------------------------------------------------
+
+import os
+import stat as stat_module
+import subprocess
+
+build_push_command = ssh_tool.build_push_command
+build_script_command = ssh_tool.build_script_command
+resolve_push_dest = ssh_tool.resolve_push_dest
+relay_push = ssh_tool.relay_push
+FileInput = ssh_tool.FileInput
+
+_FAKE_SSH = """#!/bin/sh
+# Stand-in for ssh: runs the remote command in $FAKE_SSH_ROOT/<target>,
+# logging "<caller> -> <target>" so relay hops can be checked.
+# $FAKE_SSH_REFUSE_ONCE names a target whose first connection is refused.
+prev=""
+for arg; do target=$prev; prev=$arg; done
+caller=$(basename "$PWD")
+case "$PWD" in "$FAKE_SSH_ROOT"/*) ;; *) caller=origin ;; esac
+echo "$caller -> $target" >> "$FAKE_SSH_ROOT/log"
+[ "$caller" = "$FAKE_SSH_DENY_FROM" ] && { echo "Permission denied (publickey)." >&2; exit 255; }
+if [ "$target" = "$FAKE_SSH_REFUSE_ONCE" ] && [ ! -e "$FAKE_SSH_ROOT/refused" ]; then
+    : > "$FAKE_SSH_ROOT/refused"
+    echo "ssh: connect to host $target port 22: Connection refused" >&2
+    exit 255
+fi
+mkdir -p "$FAKE_SSH_ROOT/$target"
+cd "$FAKE_SSH_ROOT/$target" && exec sh -c "$prev"
+"""
+
+
+@pytest.fixture
+def fake_fleet(tmp_path, monkeypatch):
+    """Put a fake `ssh` on PATH whose hosts are directories under a root."""
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    fake = bin_dir / "ssh"
+    fake.write_text(_FAKE_SSH)
+    fake.chmod(0o755)
+    root = tmp_path / "hosts"
+    root.mkdir()
+    monkeypatch.setenv("PATH", f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+    monkeypatch.setenv("FAKE_SSH_ROOT", str(root))
+    return root
+
+
+class TestPushCommands:
+    """Tests for the remote commands built for --push and --script."""
+
+    def test_resolve_push_dest(self):
+        local = Path("/src/app.tar")
+        assert resolve_push_dest(local, None) == "app.tar"
+        assert resolve_push_dest(local, "/opt/") == "/opt/app.tar"
+        assert resolve_push_dest(local, "/opt/app-1.tar") == "/opt/app-1.tar"
+
+    def test_push_command_is_atomic_and_quoted(self, tmp_path):
+        cmd = build_push_command("/opt/my app", 0o644, then="echo done")
+        assert "cat > '/opt/my app.ssh-tool-part'" in cmd
+        assert "mv -f '/opt/my app.ssh-tool-part' '/opt/my app'" in cmd
+        assert cmd.endswith("\necho done")
+
+    def test_push_command_runs_locally(self, tmp_path):
+        src = tmp_path / "src.bin"
+        src.write_bytes(os.urandom(300_000))
+        cmd = build_push_command(str(tmp_path / "out.bin"), 0o640, then="echo stored")
+        proc = subprocess.run(
+            ["sh", "-c", cmd], stdin=src.open("rb"), capture_output=True, check=False
+        )
+        assert proc.returncode == 0
+        assert proc.stdout == b"stored\n"
+        assert (tmp_path / "out.bin").read_bytes() == src.read_bytes()
+        assert stat_module.S_IMODE((tmp_path / "out.bin").stat().st_mode) == 0o640
+        assert not (tmp_path / "out.bin.ssh-tool-part").exists()
+
+    def test_failed_push_skips_command_and_cleans_up(self, tmp_path):
+        (tmp_path / "not-a-dir").write_text("")
+        cmd = build_push_command(
+            str(tmp_path / "not-a-dir" / "out"), 0o644, then="echo stored"
+        )
+        proc = subprocess.run(
+            ["sh", "-c", cmd], input=b"data", capture_output=True, check=False
+        )
+        assert proc.returncode == 1
+        assert b"stored" not in proc.stdout
+
+    def test_script_command_runs_and_removes_script(self, tmp_path):
+        cmd = build_script_command(["a b", "c"])
+        script = (
+            b'#!/bin/sh\necho "$# $1" ; echo "$0" > '
+            + str(tmp_path / "path").encode()
+            + b"\nexit 3\n"
+        )
+        proc = subprocess.run(
+            ["sh", "-c", cmd], input=script, capture_output=True, check=False
+        )
+        assert proc.returncode == 3
+        assert proc.stdout == b"2 a b\n"
+        assert not Path((tmp_path / "path").read_text().strip()).exists()
+
+
+class TestFileDistribution:
+    """Tests for pushing through the fake fleet."""
+
+    def _hosts(self, count):
+        return [
+            HostDefinition(name=f"h{i:02d}", hostname=f"h{i:02d}") for i in range(count)
+        ]
+
+    def test_push_streams_file_to_every_host(self, fake_fleet, tmp_path):
+        src = tmp_path / "artifact.bin"
+        src.write_bytes(os.urandom(200_000))
+        hosts = self._hosts(5)
+        results = asyncio.run(
+            run_command_on_all(
+                hosts,
+                build_push_command("artifact.bin", 0o644),
+                forks=2,
+                stdin=FileInput(src),
+            )
+        )
+        assert all(r.exit_code == 0 for r in results)
+        for host in hosts:
+            assert (
+                fake_fleet / host.name / "artifact.bin"
+            ).read_bytes() == src.read_bytes()
+
+    def test_relay_uses_binomial_tree(self, fake_fleet, tmp_path):
+        src = tmp_path / "artifact.bin"
+        src.write_bytes(os.urandom(100_000))
+        hosts = self._hosts(7)
+        results = asyncio.run(relay_push(hosts, src, "artifact.bin"))
+        assert [r.host.name for r in results] == [h.name for h in hosts]
+        assert all(r.exit_code == 0 for r in results)
+        for host in hosts:
+            assert (
+                fake_fleet / host.name / "artifact.bin"
+            ).read_bytes() == src.read_bytes()
+        hops = [
+            line.split(" -> ") for line in (fake_fleet / "log").read_text().splitlines()
+        ]
+        # 7 hosts in 3 rounds: the origin uploads once per round, holders forward the rest
+        direct = {target for caller, target in hops if caller == "origin"}
+        relayed = {(caller, target) for caller, target in hops if caller != "origin"}
+        assert {"h00", "h01", "h03"} <= direct
+        assert relayed == {
+            ("h00", "h02"),
+            ("h00", "h04"),
+            ("h01", "h05"),
+            ("h02", "h06"),
+        }
+
+    def test_failed_relay_falls_back_to_direct(self, fake_fleet, tmp_path, monkeypatch):
+        src = tmp_path / "artifact.bin"
+        src.write_bytes(b"payload")
+        hosts = self._hosts(4)
+        # h00 receives the file but cannot forward it (no agent)
+        monkeypatch.setenv("FAKE_SSH_DENY_FROM", "h00")
+        results = asyncio.run(relay_push(hosts, src, "artifact.bin"))
+        assert [r.exit_code for r in results] == [0, 0, 0, 0]
+        for host in hosts:
+            assert (fake_fleet / host.name / "artifact.bin").read_bytes() == b"payload"
+        assert "origin -> h02" in (fake_fleet / "log").read_text().splitlines()
+
+    def test_cli_push_then_run(self, fake_fleet, tmp_path):
+        src = tmp_path / "tool.sh"
+        src.write_text("#!/bin/sh\necho tool ran\n")
+        src.chmod(0o755)
+        result = CliRunner().invoke(
+            app,
+            [
+                "--hosts",
+                "h01",
+                "--hosts",
+                "h02",
+                "--push",
+                str(src),
+                "--dest",
+                "bin/",
+                "--no-history",
+                "./bin/tool.sh",
+            ],
+        )
+        assert result.exit_code == 0, result.output
+        assert "[h01] tool ran" in result.output
+        assert (fake_fleet / "h02" / "bin" / "tool.sh").read_text() == src.read_text()
+
+    def test_cli_script_with_arguments(self, fake_fleet, tmp_path):
+        src = tmp_path / "check.sh"
+        src.write_text('echo "checking $1"\n')
+        result = CliRunner().invoke(
+            app, ["--hosts", "h01", "--script", str(src), "--no-history", "disk"]
+        )
+        assert result.exit_code == 0, result.output
+        assert "[h01] checking disk" in result.output
+
+    def test_cli_relay_requires_push(self):
+        result = CliRunner().invoke(app, ["--hosts", "h01", "--relay", "uptime"])
+        assert result.exit_code == 1
+        assert "--relay require --push" in result.output
+
+
+# ---------------------------------------------------------------------------
+# Stdin broadcast
+# ---------------------------------------------------------------------------
+
+BroadcastInput = ssh_tool.BroadcastInput
+
+
+class _ChunkStream:
+    """A binary stream that hands out fixed chunks and counts reads."""
+
+    def __init__(self, data, chunk):
+        self._data = io.BytesIO(data)
+        self._chunk = chunk
+        self.reads = 0
+
+    def read1(self, size):
+        self.reads += 1
+        return self._data.read(min(size, self._chunk))
+
+
+class _SinkWriter:
+    """A stdin writer that records what it receives, optionally slowly."""
+
+    def __init__(self, delay=0.0):
+        self.data = bytearray()
+        self.delay = delay
+
+    def write(self, chunk):
+        self.data += chunk
+
+    async def drain(self):
+        await asyncio.sleep(self.delay)
+
+    def write_eof(self):
+        pass
+
+
+class TestBroadcastInput:
+    """Tests for fanning one local input out to many hosts."""
+
+    def _broadcast(self, source, writers, stagger=False):
+        async def host(writer):
+            reader = source.open()
+            try:
+                await reader.feed(writer)
+            finally:
+                reader.close()
+
+        async def run():
+            try:
+                if stagger:
+                    for writer in writers:
+                        await host(writer)
+                else:
+                    await asyncio.gather(*(host(w) for w in writers))
+            finally:
+                await source.aclose()
+
+        asyncio.run(run())
+
+    def test_every_host_gets_the_whole_input_from_one_read(self):
+        data = os.urandom(100_000)
+        stream = _ChunkStream(data, 1000)
+        writers = [_SinkWriter() for _ in range(5)]
+        self._broadcast(BroadcastInput(stream), writers)
+        assert all(bytes(w.data) == data for w in writers)
+        # 100 chunks plus the EOF read: the input is read once, not per host
+        assert stream.reads == 101
+
+    def test_memory_is_bounded_by_the_slowest_host(self):
+        data = os.urandom(50_000)
+        source = BroadcastInput(_ChunkStream(data, 500), window=4)
+        held = []
+        writers = [_SinkWriter(), _SinkWriter(delay=0.001)]
+        writers[0].write = lambda chunk: (
+            writers[0].data.extend(chunk),
+            held.append(len(source._chunks)),
+        )
+        self._broadcast(source, writers)
+        assert all(bytes(w.data) == data for w in writers)
+        assert max(held) <= 4
+
+    def test_late_hosts_replay_from_spool(self):
+        data = os.urandom(20_000)
+        source = BroadcastInput(_ChunkStream(data, 1000), spool=True, window=2)
+        writers = [_SinkWriter() for _ in range(3)]
+        self._broadcast(source, writers, stagger=True)
+        assert all(bytes(w.data) == data for w in writers)
+
+    def test_late_host_without_spool_is_refused(self):
+        source = BroadcastInput(_ChunkStream(os.urandom(10_000), 1000), window=2)
+        with pytest.raises(RuntimeError, match="spooling"):
+            self._broadcast(source, [_SinkWriter(), _SinkWriter()], stagger=True)
+
+    def test_stdin_reaches_every_host(self, fake_fleet, tmp_path):
+        data = os.urandom(300_000)
+        hosts = [
+            HostDefinition(name=f"h{i:02d}", hostname=f"h{i:02d}") for i in range(4)
+        ]
+        source = BroadcastInput(io.BytesIO(data), spool=True)
+
+        async def run():
+            try:
+                return await run_command_on_all(
+                    hosts, "cat > payload", forks=2, stdin=source
+                )
+            finally:
+                await source.aclose()
+
+        results = asyncio.run(run())
+        assert all(r.exit_code == 0 for r in results)
+        for host in hosts:
+            assert (fake_fleet / host.name / "payload").read_bytes() == data
+
+    def test_cli_streams_piped_stdin(self, fake_fleet):
+        result = CliRunner().invoke(
+            app,
+            ["--hosts", "h01", "--hosts", "h02", "--stdin", "--no-history", "wc -c"],
+            input="hello\n",
+        )
+        assert result.exit_code == 0, result.output
+        assert "[h01] 6" in result.output
+        assert "[h02] 6" in result.output
+
+    def test_cli_replays_piped_stdin_to_retried_hosts(self, fake_fleet, monkeypatch):
+        monkeypatch.setenv("FAKE_SSH_REFUSE_ONCE", "bad")
+        result = CliRunner().invoke(
+            app,
+            [
+                "-H",
+                "good",
+                "-H",
+                "bad",
+                "--stdin",
+                "--retries",
+                "1",
+                "--retry-delay",
+                "0",
+                "--no-history",
+                "wc -c",
+            ],
+            input="x" * 200_000,
+        )
+        assert result.exit_code == 0, result.output
+        assert "[good] 200000" in result.output
+        assert "[bad] 200000" in result.output
+        assert (fake_fleet / "refused").exists()
+
+    def test_late_host_without_spool_fails_alone(self, fake_fleet):
+        hosts = [
+            HostDefinition(name=f"h{i:02d}", hostname=f"h{i:02d}") for i in range(3)
+        ]
+        source = BroadcastInput(io.BytesIO(os.urandom(10_000)))
+
+        async def run():
+            try:
+                return await run_command_on_all(
+                    hosts, "wc -c", sequential=True, stdin=source
+                )
+            finally:
+                await source.aclose()
+
+        results = asyncio.run(run())
+        assert [r.exit_code for r in results] == [0, 1, 1]
+        assert "enable spooling" in results[1].error
+
+    def test_idle_open_stdin_does_not_hold_results(self, fake_fleet):
+        import threading
+        import time as _time
+
+        read_end, write_end = os.pipe()
+        # Safety net: end the input if the run waits for it after all
+        timer = threading.Timer(10, os.close, (write_end,))
+        timer.start()
+        hosts = [
+            HostDefinition(name=f"h{i:02d}", hostname=f"h{i:02d}") for i in range(3)
+        ]
+        buf = io.StringIO()
+        formatter = OutputFormatter(color="never", is_tty=False, file=buf)
+        started = _time.monotonic()
+        try:
+            with os.fdopen(read_end, "rb") as stream:
+                exit_code = run_immediate_mode(
+                    hosts, "echo ran", formatter, stdin=BroadcastInput(stream)
+                )
+            elapsed = _time.monotonic() - started
+        finally:
+            timer.cancel()
+            os.close(write_end)
+        assert exit_code == 0
+        assert elapsed < 5
+        assert "[h00] ran" in buf.getvalue()
+
+    def test_cli_exits_with_idle_open_stdin(self, fake_fleet):
+        for args in ([], ["--stdin"]):
+            proc = subprocess.Popen(
+                [
+                    sys.executable,
+                    spec.origin,
+                    "-H",
+                    "h00",
+                    "--no-history",
+                    *args,
+                    "echo ran",
+                ],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+            )
+            try:
+                assert proc.wait(timeout=15) == 0
+                assert proc.stdout.read() == b"[h00] ran\n"
+            finally:
+                proc.kill()
+                proc.stdin.close()
+                proc.stdout.close()
+
+    def test_cli_no_stdin_leaves_input_unread(self, fake_fleet):
+        result = CliRunner().invoke(
+            app,
+            ["--hosts", "h01", "--no-stdin", "--no-history", "echo ok"],
+            input="hello\n",
+        )
+        assert result.exit_code == 0, result.output
+        assert "[h01] ok" in result.output
+
+
+# ---------------------------------------------------------------------------
+# Compiled inventory cache
+# ---------------------------------------------------------------------------
+
+InventoryCache = ssh_tool.InventoryCache
+compile_groups = ssh_tool.compile_groups
+
+
+def _large_config_yaml(hosts, racks):
+    lines = ["hosts:"]
+    for i in range(hosts):
+        lines.append(f"  web{i:05d}: {{hostname: 10.0.{i // 250}.{i % 250}, port: 22}}")
+    lines.append("groups:")
+    for r in range(racks):
+        lines.append(f"  rack{r}: {{hosts: ['web*{r}']}}")
+    lines.append(f"  all: {{groups: [{', '.join(f'rack{r}' for r in range(racks))}]}}")
+    lines.append("  everything: {groups: [all, rack0]}")
+    return "\n".join(lines) + "\n"
+
+
+class TestInventoryCache:
+    """Tests for the compiled config cache and memoized group resolution."""
+
+    def _config(self, tmp_path, text):
+        path = tmp_path / "inventory.yaml"
+        path.write_text(text)
+        return path
+
+    def _no_parsing(self, monkeypatch):
+        def fail(*args, **kwargs):
+            raise AssertionError("config was parsed again")
+
+        import yaml
+
+        monkeypatch.setattr(yaml, "safe_load", fail)
+
+    def test_unchanged_config_is_not_parsed_again(self, tmp_path, monkeypatch):
+        path = self._config(tmp_path, _large_config_yaml(30, 3))
+        cache = InventoryCache(tmp_path / "cache")
+        first = cache.load(path)
+        self._no_parsing(monkeypatch)
+        second = cache.load(path)
+        assert second.hosts == first.hosts
+        assert second.groups == first.groups
+        assert resolve_group(second, "all") == resolve_group(first, "all")
+
+    def test_touched_config_is_validated_by_hash(self, tmp_path, monkeypatch):
+        path = self._config(tmp_path, _large_config_yaml(10, 1))
+        cache = InventoryCache(tmp_path / "cache")
+        cache.load(path)
+        os.utime(path, ns=(1, 1))
+        self._no_parsing(monkeypatch)
+        assert len(cache.load(path).hosts) == 10
+
+    def test_edited_config_is_recompiled(self, tmp_path):
+        path = self._config(tmp_path, _large_config_yaml(10, 1))
+        cache = InventoryCache(tmp_path / "cache")
+        cache.load(path)
+        path.write_text(_large_config_yaml(12, 1))
+        config = cache.load(path)
+        assert len(config.hosts) == 12
+        assert [h.name for h in resolve_group(config, "rack0")] == [
+            "web00000",
+            "web00010",
+        ]
+
+    def test_corrupt_entry_is_rebuilt(self, tmp_path):
+        path = self._config(tmp_path, _large_config_yaml(5, 1))
+        cache = InventoryCache(tmp_path / "cache")
+        cache.load(path)
+        cache.entry_path(path).write_bytes(b"not a pickle")
+        assert len(cache.load(path).hosts) == 5
+
+    def test_broken_group_still_reports_its_error(self, tmp_path):
+        path = self._config(
+            tmp_path,
+            "hosts:\n  a: {hostname: a}\ngroups:\n  ok: {hosts: [a]}\n  bad: {hosts: [zzz]}\n",
+        )
+        cache = InventoryCache(tmp_path / "cache")
+        cache.load(path)
+        config = cache.load(path)
+        assert [h.name for h in resolve_group(config, "ok")] == ["a"]
+        with pytest.raises(ConfigError, match="undefined host 'zzz'"):
+            resolve_group(config, "bad")
+
+    def test_diamond_nesting_is_resolved_once_per_group(self):
+        # Each level reaches the next along two paths: 2**40 paths without memoization
+        hosts = {"h": HostDefinition(name="h", hostname="h")}
+        groups = {"g40": HostGroup(name="g40", hosts=["h"])}
+        for level in range(40):
+            groups[f"g{level}"] = HostGroup(
+                name=f"g{level}", groups=[f"l{level}", f"r{level}"]
+            )
+            groups[f"l{level}"] = HostGroup(name=f"l{level}", groups=[f"g{level + 1}"])
+            groups[f"r{level}"] = HostGroup(name=f"r{level}", groups=[f"g{level + 1}"])
+        config = Config(hosts=hosts, groups=groups)
+        assert [h.name for h in resolve_group(config, "g0")] == ["h"]
+        compile_groups(config)
+        assert config.resolved["l7"] == ["h"]
+
+    def test_cached_startup_is_fast(self, tmp_path):
+        import time as _time
+
+        path = self._config(tmp_path, _large_config_yaml(20_000, 10))
+        cache = InventoryCache(tmp_path / "cache")
+        started = _time.perf_counter()
+        cold = cache.load(path)
+        cold_time = _time.perf_counter() - started
+        started = _time.perf_counter()
+        warm = cache.load(path)
+        assert len(resolve_group(warm, "everything")) == 20_000
+        warm_time = _time.perf_counter() - started
+        assert len(resolve_group(cold, "everything")) == 20_000
+        assert warm_time < cold_time / 5
+
+    def test_cli_uses_the_cache(self, tmp_path, monkeypatch):
+        path = self._config(
+            tmp_path, "hosts:\n  a: {hostname: 127.0.0.1}\ngroups:\n  g: {hosts: [a]}\n"
+        )
+        InventoryCache().load(path)
+        self._no_parsing(monkeypatch)
+        monkeypatch.setattr(
+            ssh_tool,
+            "run_immediate_mode",
+            lambda hosts, **kwargs: print([h.name for h in hosts]) or 0,
+        )
+        result = CliRunner().invoke(
+            app, ["--config", str(path), "--group", "g", "--no-stdin", "uptime"]
+        )
+        assert result.exit_code == 0, result.output
+        assert "['a']" in result.output
+
+
+# ---------------------------------------------------------------------------
+# Label selection
+# ---------------------------------------------------------------------------
+
+select_hosts = ssh_tool.select_hosts
+
+_LABELLED_CONFIG = """\
+hosts:
+  web1: {hostname: 10.0.0.1, labels: {role: web, region: eu-west}}
+  web2: {hostname: 10.0.0.2, labels: {role: web, region: eu-west}}
+  web3: {hostname: 10.0.0.3, labels: {role: web, region: us-east}}
+  canary: {hostname: 10.0.0.4, labels: [canary, web]}
+  db1: {hostname: 10.0.1.1, labels: {role: db, region: eu-central}}
+groups:
+  databases: {hosts: [db1]}
+"""
+
+
+class TestSelectHosts:
+    """Tests for --select label expressions."""
+
+    @pytest.fixture
+    def config(self, tmp_path):
+        path = tmp_path / "inventory.yaml"
+        path.write_text(_LABELLED_CONFIG)
+        return load_config(path)
+
+    def _names(self, config, expression):
+        return [h.name for h in select_hosts(config, expression)]
+
+    def test_labels_are_parsed(self, config):
+        assert config.hosts["web1"].labels == ["role=web", "region=eu-west"]
+        assert config.hosts["canary"].labels == ["canary", "web"]
+
+    def test_invalid_labels_raise_config_error(self, tmp_path):
+        path = tmp_path / "bad.yaml"
+        path.write_text("hosts:\n  a: {hostname: a, labels: web}\n")
+        with pytest.raises(ConfigError, match="'labels' must be a list or mapping"):
+            load_config(path)
+
+    @pytest.mark.parametrize(
+        "expression, expected",
+        [
+            ("role=web", ["web1", "web2", "web3"]),
+            ("role=web | web", ["canary", "web1", "web2", "web3"]),
+            ("role=web, canary", ["canary", "web1", "web2", "web3"]),
+            ("role=web and region=eu-west", ["web1", "web2"]),
+            ("role=web & region=eu-*", ["web1", "web2"]),
+            ("(role=web or web) not canary", ["web1", "web2", "web3"]),
+            ("region=eu-* and not role=db", ["web1", "web2"]),
+            ("!region=*", ["canary"]),
+            ("host=web[12] | @databases", ["db1", "web1", "web2"]),
+            ("host=canary", ["canary"]),
+            ("no-such-label", []),
+            ("ROLE=WEB", []),
+        ],
+    )
+    def test_set_algebra(self, config, expression, expected):
+        assert self._names(config, expression) == expected
+
+    def test_keywords_are_case_insensitive(self, config):
+        assert self._names(config, "role=web AND region=eu-west NOT host=web2") == [
+            "web1"
+        ]
+
+    @pytest.mark.parametrize(
+        "expression, message",
+        [
+            ("", "empty expression"),
+            ("role=web and", "unexpected end"),
+            ("(role=web", "missing '\\)'"),
+            ("role=web)", "unexpected '\\)'"),
+            ("role=web db", "unexpected 'db'"),
+        ],
+    )
+    def test_malformed_expressions(self, config, expression, message):
+        with pytest.raises(ValidationError, match=message):
+            select_hosts(config, expression)
+
+    def test_unknown_group_raises_config_error(self, config):
+        with pytest.raises(ConfigError, match="undefined group 'nope'"):
+            select_hosts(config, "@nope")
+
+    def test_index_survives_the_inventory_cache(self, tmp_path, monkeypatch):
+        path = tmp_path / "inventory.yaml"
+        path.write_text(_LABELLED_CONFIG)
+        cache = InventoryCache(tmp_path / "cache")
+        cache.load(path)
+        monkeypatch.setattr(
+            ssh_tool, "index_labels", lambda config: pytest.fail("index rebuilt")
+        )
+        config = cache.load(path)
+        assert [h.name for h in select_hosts(config, "role=db")] == ["db1"]
+
+    def test_selection_is_fast_at_scale(self):
+        import time as _time
+
+        hosts = {}
+        for i in range(30_000):
+            name = f"h{i:05d}"
+            labels = [f"role={('web', 'db', 'cache')[i % 3]}", f"region=r{i % 7}"]
+            if i % 100 == 0:
+                labels.append("canary")
+            hosts[name] = HostDefinition(name=name, hostname=name, labels=labels)
+        config = Config(hosts=hosts)
+        ssh_tool.index_labels(config)
+        started = _time.perf_counter()
+        for _ in range(10):
+            selected = select_hosts(
+                config, "(role=web | role=db) and region=r[0-3] not canary"
+            )
+        elapsed = (_time.perf_counter() - started) / 10
+        expected = [
+            name
+            for name, host in hosts.items()
+            if int(name[1:]) % 3 != 2
+            and int(name[1:]) % 7 < 4
+            and int(name[1:]) % 100 != 0
+        ]
+        assert [h.name for h in selected] == expected
+        assert elapsed < 0.05
+
+    def test_cli_select(self, tmp_path, monkeypatch):
+        path = tmp_path / "inventory.yaml"
+        path.write_text(_LABELLED_CONFIG)
+        monkeypatch.setattr(
+            ssh_tool,
+            "run_immediate_mode",
+            lambda hosts, **kwargs: print([h.name for h in hosts]) or 0,
+        )
+        result = CliRunner().invoke(
+            app,
+            [
+                "--config",
+                str(path),
+                "--select",
+                "region=eu-west",
+                "--select",
+                "@databases",
+                "--no-stdin",
+                "uptime",
+            ],
+        )
+        assert result.exit_code == 0, result.output
+        assert "['db1', 'web1', 'web2']" in result.output
+
+    def test_cli_select_requires_config(self, monkeypatch):
+        monkeypatch.setattr(ssh_tool.Path, "home", lambda: Path("/nonexistent"))
+        result = CliRunner().invoke(app, ["--select", "web", "uptime"])
+        assert result.exit_code == 1
+        assert "--select requires --config" in result.output
+
+    def test_cli_bad_expression(self, tmp_path):
+        path = tmp_path / "inventory.yaml"
+        path.write_text(_LABELLED_CONFIG)
+        result = CliRunner().invoke(
+            app, ["--config", str(path), "--select", "(web", "uptime"]
+        )
+        assert result.exit_code == 1
+        assert "invalid --select expression" in result.output
+
+
+# ---------------------------------------------------------------------------
+# Inventory plugins
+# ---------------------------------------------------------------------------
+
+make_inventory = ssh_tool.make_inventory
+inventory_hosts = ssh_tool.inventory_hosts
+InventoryResultCache = ssh_tool.InventoryResultCache
+
+
+def fleet_inventory():
+    """Python inventory entry point used by the py: plugin tests."""
+    return {"hosts": {"app1": {"hostname": "10.1.0.1", "labels": {"role": "app"}}}}
+
+
+class _CountingSource(ssh_tool.InventorySource):
+    def __init__(self, hosts):
+        super().__init__("test:counting", "counting")
+        self.hosts = hosts
+        self.fetches = 0
+
+    def fetch(self, max_entries=10_000):
+        self.fetches += 1
+        return [HostDefinition(name=h, hostname=h) for h in self.hosts]
+
+
+class TestInventoryPlugins:
+    """Tests for exec:, file: and py: inventory sources."""
+
+    def test_inventory_shapes(self):
+        hosts = inventory_hosts(
+            "t",
+            [
+                "a.example",
+                {"hostname": "10.0.0.2", "name": "b", "port": 2222, "labels": ["x"]},
+            ],
+        )
+        assert [(h.name, h.hostname, h.port, h.labels) for h in hosts] == [
+            ("a.example", "a.example", 22, []),
+            ("b", "10.0.0.2", 2222, ["x"]),
+        ]
+        hosts = inventory_hosts(
+            "t", {"hosts": {"c": {"hostname": "c.example", "user": "ops"}}}
+        )
+        assert (hosts[0].name, hosts[0].user) == ("c", "ops")
+
+    @pytest.mark.parametrize(
+        "data, message",
+        [
+            ({"servers": []}, "expected a list"),
+            (["bad host!"], "inventory 't': invalid host entry 'bad host!'"),
+            ([{"name": "x"}], "invalid host entry"),
+            (
+                {"hosts": {"web1": "10.0.0.1"}},
+                "inventory 't': invalid host entry 'web1': '10.0.0.1'",
+            ),
+            ({"hosts": {"web1": ["10.0.0.1"]}}, "invalid host entry 'web1'"),
+            ([{"hostname": "x", "port": 0}], "invalid port 0"),
+            (["a", "b", "c"], "exceeds maximum of 2"),
+        ],
+    )
+    def test_invalid_inventory_data(self, data, message):
+        with pytest.raises(ValidationError, match=message):
+            inventory_hosts("t", data, max_entries=2)
+
+    def test_unknown_kind(self):
+        with pytest.raises(ValidationError, match="expected one of exec:, file:, py:"):
+            make_inventory("http://inventory")
+
+    def test_exec_plugin(self, tmp_path):
+        script = tmp_path / "inventory.sh"
+        script.write_text('#!/bin/sh\necho \'["web1.example", "web2.example"]\'\n')
+        script.chmod(0o755)
+        hosts = make_inventory(f"exec:{script}").fetch()
+        assert [h.hostname for h in hosts] == ["web1.example", "web2.example"]
+
+    def test_exec_plugin_failure(self, tmp_path):
+        with pytest.raises(ValidationError, match="exited with code 3: boom"):
+            make_inventory("exec:sh -c 'echo boom >&2; exit 3'").fetch()
+
+    @pytest.mark.parametrize(
+        "name, content",
+        [
+            ("hosts.json", '{"hosts": ["db1.example"]}'),
+            ("hosts.yaml", "hosts:\n  - db1.example\n"),
+            ("hosts.txt", "db1.example\n\n"),
+        ],
+    )
+    def test_file_plugin_formats(self, tmp_path, name, content):
+        (tmp_path / name).write_text(content)
+        assert [
+            h.hostname for h in make_inventory(f"file:{tmp_path / name}").fetch()
+        ] == ["db1.example"]
+
+    def test_py_plugin(self):
+        hosts = make_inventory(f"py:{__name__}:fleet_inventory").fetch()
+        assert [(h.name, h.labels) for h in hosts] == [("app1", ["role=app"])]
+
+    def test_py_plugin_missing_function(self):
+        with pytest.raises(ValidationError, match="no attribute"):
+            make_inventory(f"py:{__name__}:nope").fetch()
+
+
+class TestInventoryResultCache:
+    """Tests for TTL caching with stale-while-revalidate."""
+
+    @pytest.fixture
+    def refreshes(self, monkeypatch):
+        calls = []
+        monkeypatch.setattr(
+            ssh_tool, "_refresh_in_background", lambda refresh: calls.append(refresh)
+        )
+        return calls
+
+    def _age(self, cache, spec, seconds):
+        path = cache.entry_path(spec)
+        entry = json.loads(path.read_text())
+        entry["fetched_at"] -= seconds
+        path.write_text(json.dumps(entry))
+
+    def test_fresh_results_are_reused(self, tmp_path, refreshes):
+        cache = InventoryResultCache(tmp_path, ttl=60)
+        source = _CountingSource(["a", "b"])
+        assert [h.name for h in cache.load(source)] == ["a", "b"]
+        assert [h.name for h in cache.load(source)] == ["a", "b"]
+        assert source.fetches == 1
+        assert refreshes == []
+
+    def test_stale_results_are_served_while_refreshing(self, tmp_path, refreshes):
+        cache = InventoryResultCache(tmp_path, ttl=60)
+        source = _CountingSource(["a"])
+        cache.load(source)
+        source.hosts = ["a", "b"]
+        self._age(cache, source.spec, 120)
+        assert [h.name for h in cache.load(source)] == ["a"]
+        # A second caller does not start another refresh while one is running
+        cache.load(source)
+        assert len(refreshes) == 1
+        refreshes[0]()
+        assert [h.name for h in cache.load(source)] == ["a", "b"]
+        assert source.fetches == 2
+
+    def test_file_sources_are_always_read(self, tmp_path, refreshes):
+        cache = InventoryResultCache(tmp_path / "cache", ttl=3600)
+        path = tmp_path / "hosts.json"
+        path.write_text('["one.example", "gone.example"]')
+        source = make_inventory(f"file:{path}")
+        assert [h.name for h in cache.load(source)] == ["one.example", "gone.example"]
+        path.write_text('["one.example"]')
+        assert [h.name for h in cache.load(source)] == ["one.example"]
+        assert not cache.entry_path(source.spec).exists()
+
+    def test_zero_ttl_always_fetches(self, tmp_path, refreshes):
+        cache = InventoryResultCache(tmp_path, ttl=0)
+        source = _CountingSource(["a"])
+        cache.load(source)
+        cache.load(source)
+        assert source.fetches == 2
+
+    def test_background_refresh_updates_cache(self, tmp_path):
+        import time as _time
+
+        script = tmp_path / "inventory.sh"
+        script.write_text('#!/bin/sh\ncat "$0.data"\n')
+        script.chmod(0o755)
+        (tmp_path / "inventory.sh.data").write_text('["one.example"]')
+        cache = InventoryResultCache(tmp_path / "cache", ttl=60)
+        source = make_inventory(f"exec:{script}")
+        cache.load(source)
+        (tmp_path / "inventory.sh.data").write_text('["two.example"]')
+        self._age(cache, source.spec, 120)
+        assert [h.name for h in cache.load(source)] == ["one.example"]
+        # The detached refresh removes its lock when done
+        deadline = _time.monotonic() + 10
+        while cache._lock_path(source.spec).exists() and _time.monotonic() < deadline:
+            _time.sleep(0.02)
+        assert [h.name for h in cache.load(source)] == ["two.example"]
+
+
+class TestMaxHosts:
+    """Tests for the configurable host cap."""
+
+    def test_host_file_cap_is_configurable(self, tmp_path):
+        f = tmp_path / "hosts.txt"
+        f.write_text("a\nb\nc\n")
+        assert parse_host_file(f, max_entries=3) == ["a", "b", "c"]
+        with pytest.raises(ValidationError, match="exceeds maximum of 2 entries"):
+            parse_host_file(f, max_entries=2)
+
+    def test_cli_inventory_and_max_hosts(self, tmp_path, monkeypatch):
+        inventory = tmp_path / "hosts.json"
+        inventory.write_text('["a.example", "b.example"]')
+        monkeypatch.setattr(
+            ssh_tool,
+            "run_immediate_mode",
+            lambda hosts, **kwargs: print([h.name for h in hosts]) or 0,
+        )
+        result = CliRunner().invoke(
+            app, ["--inventory", f"file:{inventory}", "--no-stdin", "uptime"]
+        )
+        assert result.exit_code == 0, result.output
+        assert "['a.example', 'b.example']" in result.output
+        result = CliRunner().invoke(
+            app,
+            [
+                "--inventory",
+                f"file:{inventory}",
+                "--max-hosts",
+                "1",
+                "--inventory-ttl",
+                "0",
+                "uptime",
+            ],
+        )
+        assert result.exit_code == 1
+        assert "exceeds maximum of 1 entries" in result.output
+
+
+# ---------------------------------------------------------------------------
+# Host entry validation pipeline
+# ---------------------------------------------------------------------------
+
+
+def _reference_host_entry(s):
+    """The original, per-label and ipaddress-based host entry check."""
+    import ipaddress
+    import re
+
+    def hostname(s):
+        if not s or len(s) > 253:
+            return False
+        s = s.removesuffix(".")
+        return bool(s) and all(
+            label
+            and len(label) <= 63
+            and re.fullmatch(r"[a-zA-Z0-9](?:[a-zA-Z0-9-]{0,61}[a-zA-Z0-9])?", label)
+            for label in s.split(".")
+        )
+
+    def address(cls, s):
+        try:
+            cls(s)
+            return True
+        except ValueError:
+            return False
+
+    return (
+        hostname(s)
+        or address(ipaddress.IPv4Address, s)
+        or address(ipaddress.IPv6Address, s)
+    )
+
+
+class TestHostEntryPattern:
+    """Tests for the combined host entry pattern and streaming host file parsing."""
+
+    CASES = (
+        "web1",
+        "web-1.example.com",
+        "example.com.",
+        "a" * 63,
+        "a" * 64,
+        "-web",
+        "web-",
+        "a..b",
+        ".",
+        "",
+        "x_y",
+        ".".join(["a" * 63] * 4),
+        ".".join(["a" * 50] * 5),
+        "10.0.0.1",
+        "255.255.255.255",
+        "256.1.1.1",
+        "01.2.3.4",
+        "1.2.3",
+        "1.2.3.4.5",
+        "::",
+        "::1",
+        "1::",
+        "2001:db8::1",
+        "2001:0db8:85a3:0000:0000:8a2e:0370:7334",
+        "1:2:3:4:5:6:7:8",
+        "1:2:3:4:5:6:7:8:9",
+        "1:2:3:4:5:6:7::",
+        "::ffff:10.0.0.1",
+        "1::2:3:4:5:6:7",
+        "1:2:3:4:5:6:1.2.3.4",
+        "::1.2.3.4",
+        "1::2::3",
+        ":::",
+        "12345::",
+        "fe80::1%eth0",
+        "fe80::1%",
+        "g::1",
+        "::ffff:256.0.0.1",
+        "1:2:3:4:5:6:7:1.2.3.4",
+    )
+
+    def test_matches_reference_validation(self):
+        for case in self.CASES:
+            assert validate_host_entry(case) == _reference_host_entry(case), case
+
+    def test_matches_reference_on_random_entries(self):
+        import random
+
+        rng = random.Random(1234)
+        alphabet = "abcdef0123456789:.-%x"
+        for _ in range(20_000):
+            case = "".join(rng.choice(alphabet) for _ in range(rng.randint(1, 20)))
+            assert validate_host_entry(case) == _reference_host_entry(case), case
+
+    def test_all_invalid_lines_are_reported(self, tmp_path):
+        f = tmp_path / "hosts.txt"
+        f.write_text("ok1\nbad_1\nok2\n\nbad 2\nok3\n")
+        with pytest.raises(ValidationError) as excinfo:
+            parse_host_file(f)
+        assert str(excinfo.value) == (
+            "invalid host entries 'bad_1' (line 2), 'bad 2' (line 5): "
+            "does not match hostname, IPv4, or IPv6 format"
+        )
+
+    def test_long_invalid_lists_are_truncated(self, tmp_path):
+        f = tmp_path / "hosts.txt"
+        f.write_text("".join(f"bad_{i}\n" for i in range(25)))
+        with pytest.raises(ValidationError, match=r"'bad_19' \(line 20\) and 5 more:"):
+            parse_host_file(f)
+
+    def test_limit_stops_reading_early(self, tmp_path, monkeypatch):
+        f = tmp_path / "hosts.txt"
+        f.write_text("".join(f"host{i}\n" for i in range(1000)))
+        with pytest.raises(ValidationError, match="exceeds maximum of 10 entries"):
+            parse_host_file(f, max_entries=10)
+
+    def test_million_line_benchmark(self, tmp_path):
+        import time as _time
+
+        f = tmp_path / "hosts.txt"
+        kinds = (
+            "web{0}.dc1.example.com",
+            "10.{1}.{2}.{3}",
+            "2001:db8::{4:x}",
+            "db-{0}",
+        )
+        with f.open("w") as out:
+            for i in range(1_000_000):
+                out.write(
+                    kinds[i % 4].format(
+                        i, i >> 16 & 255, i >> 8 & 255, i & 255, i & 0xFFFF
+                    )
+                    + "\n"
+                )
+        started = _time.perf_counter()
+        entries = parse_host_file(f, max_entries=1_000_000)
+        elapsed = _time.perf_counter() - started
+        assert len(entries) == 1_000_000
+        # About 2s here, against about 7.5s for the per-label / ipaddress checks
+        assert elapsed < 10
+
+
+# ---------------------------------------------------------------------------
+# Interrupt handling
+# ---------------------------------------------------------------------------
+
+import signal as signal_module
+
+ProcessRegistry = ssh_tool.ProcessRegistry
+
+
+class TestProcessRegistry:
+    """Tests for terminating every tracked child process."""
+
+    def _spawn(self, registry, script, count):
+        async def spawn():
+            processes = []
+            for _ in range(count):
+                process = await asyncio.create_subprocess_exec("sh", "-c", script)
+                registry.add(process)
+                processes.append(process)
+            await asyncio.sleep(0.2)  # let the shells ignore TERM before exec
+            return processes
+
+        return spawn()
+
+    def test_terminate_all_is_bounded_for_stubborn_processes(self):
+        import time as _time
+
+        registry = ProcessRegistry()
+
+        async def run():
+            processes = await self._spawn(registry, "trap '' TERM; exec sleep 30", 20)
+            started = _time.monotonic()
+            count = await registry.terminate_all(grace=0.3)
+            return processes, count, _time.monotonic() - started
+
+        processes, count, elapsed = asyncio.run(run())
+        assert count == 20
+        assert all(p.returncode == -signal_module.SIGKILL for p in processes)
+        assert elapsed < 0.3 + ssh_tool._KILL_WAIT + 0.5
+        assert len(registry) == 0
+
+    def test_exited_processes_are_released(self):
+        registry = ProcessRegistry()
+
+        async def run():
+            process = await asyncio.create_subprocess_exec("true")
+            registry.add(process)
+            registry.release(process)
+            assert len(registry) == 1  # still running as far as asyncio knows
+            await process.wait()
+            registry.release(process)
+            return await registry.terminate_all()
+
+        assert asyncio.run(run()) == 0
+        assert len(registry) == 0
+
+
+class TestInterruptedRun:
+    """Tests for Ctrl-C during an immediate-mode fan-out."""
+
+    def test_sigint_terminates_in_flight_hosts_and_reports_partial_results(
+        self, fake_fleet, capsys
+    ):
+        import threading
+        import time as _time
+
+        hosts = [
+            HostDefinition(name=f"h{i:02d}", hostname=f"h{i:02d}") for i in range(6)
+        ]
+        for host in hosts[:2]:
+            (fake_fleet / host.name).mkdir()
+            (fake_fleet / host.name / "fast").write_text("")
+        formatter = OutputFormatter(color=False, is_tty=False)
+        timer = threading.Timer(1.0, os.kill, (os.getpid(), signal_module.SIGINT))
+        timer.start()
+        started = _time.monotonic()
+        try:
+            exit_code = run_immediate_mode(
+                hosts,
+                "if [ -e fast ]; then echo done; else exec sleep 30; fi",
+                formatter,
+                timeout=60,
+                stdin=None,
+            )
+        finally:
+            timer.cancel()
+        elapsed = _time.monotonic() - started
+        captured = capsys.readouterr()
+        assert exit_code == 130
+        assert "[h00] done" in captured.out
+        assert "[h01] done" in captured.out
+        assert "h02" not in captured.out
+        assert (
+            "Interrupted: 2 of 6 host(s) finished, 4 ssh process(es) terminated"
+            in captured.err
+        )
+        assert elapsed < 1.0 + ssh_tool._TERMINATE_GRACE + 2
+        assert len(ssh_tool._process_registry) == 0
+
+
+# ---------------------------------------------------------------------------
+# Unit Tests: retries and --retry-failed
+# ---------------------------------------------------------------------------
+
+classify_failure = ssh_tool.classify_failure
+RetryPolicy = ssh_tool.RetryPolicy
+LastRunStore = ssh_tool.LastRunStore
+
+
+class _FlakyTransport(Transport):
+    """Transport whose hosts fail with an error until they have been tried N times."""
+
+    def __init__(
+        self, failures, error="ssh: connect to host h port 22: Connection refused"
+    ):
+        self.failures = dict(failures)  # host name -> failing attempts
+        self.error = error
+        self.started = []
+        self.in_flight = 0
+        self.peak = 0
+
+    async def run(
+        self, host, remote_cmd, timeout, connection_timeout, on_line=None, **kwargs
+    ):
+        self.started.append(host.name)
+        self.in_flight += 1
+        self.peak = max(self.peak, self.in_flight)
+        try:
+            await asyncio.sleep(0.001)
+        finally:
+            self.in_flight -= 1
+        if self.started.count(host.name) <= self.failures.get(host.name, 0):
+            return CommandResult(host=host, stdout="", stderr=self.error, exit_code=255)
+        return CommandResult(host=host, stdout="ok\n", stderr="", exit_code=0)
+
+
+class TestClassifyFailure:
+    """Tests for failure classification."""
+
+    host = HostDefinition(name="web1", hostname="web1")
+
+    def _result(self, exit_code=0, stderr="", error=None, **kwargs):
+        return CommandResult(
+            host=self.host,
+            stdout="",
+            stderr=stderr,
+            exit_code=exit_code,
+            error=error,
+            **kwargs,
+        )
+
+    @pytest.mark.parametrize(
+        "stderr,kind",
+        [
+            ("ssh: connect to host web1 port 22: Connection refused", "refused"),
+            (
+                "ssh: connect to host web1 port 22: Connection timed out",
+                "connect_timeout",
+            ),
+            ("ssh: connect to host web1 port 22: No route to host", "unreachable"),
+            ("kex_exchange_identification: read: Connection reset by peer", "reset"),
+            (
+                "ssh: Could not resolve hostname web1: Name or service not known",
+                "resolve",
+            ),
+            ("web1: Permission denied (publickey).", "auth"),
+            ("Host key verification failed.", "auth"),
+            ("something else", "command"),
+        ],
+    )
+    def test_ssh_errors(self, stderr, kind):
+        assert classify_failure(self._result(255, stderr)) == kind
+
+    def test_success_and_command_failures(self):
+        assert classify_failure(self._result(0)) is None
+        # A remote command printing ssh-like text is still a command failure
+        assert classify_failure(self._result(1, "Connection refused")) == "command"
+        assert classify_failure(self._result(-1, timed_out=True)) == "timeout"
+        assert classify_failure(self._result(-1, skipped=True)) == "skipped"
+
+    def test_started_commands_are_command_failures(self):
+        refused = "ssh: connect to host web1 port 22: Connection refused"
+        # Only ssh's own last line is classified, and only before the command started
+        assert (
+            classify_failure(self._result(255, f"{refused}\nretrying later\n"))
+            == "command"
+        )
+        assert (
+            classify_failure(
+                self._result(255, refused, timing=HostTiming(connected=1.0))
+            )
+            == "command"
+        )
+        started = CommandResult(
+            host=self.host, stdout="partial\n", stderr=refused, exit_code=255
+        )
+        assert classify_failure(started) == "command"
+        assert not RetryPolicy(attempts=1).retryable(started)
+        # A remote command's own connection error is not ssh's
+        curl = "curl: (7) Failed to connect to db port 80: Connection refused"
+        assert classify_failure(self._result(255, curl)) == "command"
+        assert classify_failure(self._result(255, "Connection refused")) == "command"
+
+    def test_transport_errors(self):
+        assert (
+            classify_failure(
+                self._result(
+                    -1, error="[Errno 111] Connect call failed ('10.0.0.1', 22)"
+                )
+            )
+            == "refused"
+        )
+        assert classify_failure(self._result(-1, error="boom")) == "error"
+
+    def test_policy_retries_only_transient_failures(self):
+        policy = RetryPolicy(attempts=1)
+        assert policy.retryable(
+            self._result(255, "ssh: connect to host web1 port 22: Connection refused")
+        )
+        assert not policy.retryable(self._result(255, "Permission denied (publickey)."))
+        assert not policy.retryable(self._result(1, "Connection refused"))
+
+    def test_delay_doubles_up_to_cap(self):
+        policy = RetryPolicy(attempts=10, base_delay=1.0, max_delay=5.0, jitter=0.0)
+        assert [policy.delay(n) for n in range(1, 6)] == [1.0, 2.0, 4.0, 5.0, 5.0]
+        jittered = RetryPolicy(attempts=1, base_delay=10.0, jitter=0.2)
+        assert all(8.0 <= jittered.delay(1) <= 12.0 for _ in range(50))
+
+
+class TestRetriedExecution:
+    """Tests for run_command_on_all with a RetryPolicy."""
+
+    def _hosts(self, count):
+        return [
+            HostDefinition(name=f"h{i:02d}", hostname=f"h{i:02d}") for i in range(count)
+        ]
+
+    def _run(self, hosts, transport, **kwargs):
+        return asyncio.run(
+            run_command_on_all(hosts, "uptime", transport=transport, **kwargs)
+        )
+
+    def test_transient_failures_are_retried_and_reported_once(self):
+        hosts = self._hosts(4)
+        transport = _FlakyTransport({"h01": 1, "h02": 2})
+        reported = []
+        results = self._run(
+            hosts,
+            transport,
+            on_result=reported.append,
+            retry=RetryPolicy(attempts=3, base_delay=0.0),
+        )
+        assert [r.exit_code for r in results] == [0, 0, 0, 0]
+        assert [r.attempts for r in results] == [1, 2, 3, 1]
+        assert sorted(r.host.name for r in reported) == ["h00", "h01", "h02", "h03"]
+        assert transport.started.count("h02") == 3
+
+    def test_gives_up_after_attempts(self):
+        transport = _FlakyTransport({"h00": 5})
+        reported = []
+        results = self._run(
+            self._hosts(1),
+            transport,
+            on_result=reported.append,
+            retry=RetryPolicy(attempts=2, base_delay=0.0),
+        )
+        assert results[0].exit_code == 255
+        assert results[0].attempts == 3
+        assert reported == results
+
+    def test_auth_failures_are_not_retried(self):
+        transport = _FlakyTransport({"h00": 5}, error="Permission denied (publickey).")
+        results = self._run(
+            self._hosts(2), transport, retry=RetryPolicy(attempts=3, base_delay=0.0)
+        )
+        assert transport.started.count("h00") == 1
+        assert results[0].attempts == 1
+
+    def test_started_command_is_never_rerun(self, fake_fleet):
+        # The remote command itself reports a refused connection and exits 255
+        command = "echo run >> runs; echo 'curl: (7) Failed to connect to db port 80: Connection refused' >&2; exit 255"
+        hosts = self._hosts(1)
+        results = asyncio.run(
+            run_command_on_all(
+                hosts, command, retry=RetryPolicy(attempts=2, base_delay=0.0)
+            )
+        )
+        assert results[0].exit_code == 255
+        assert results[0].attempts == 1
+        assert (fake_fleet / "h00" / "runs").read_text() == "run\n"
+
+    def test_only_stats_and_trace_file_inject_the_connect_marker(
+        self, fake_fleet, tmp_path
+    ):
+        commands = []
+        exec_ = asyncio.create_subprocess_exec
+
+        async def recording(*args, **kwargs):
+            commands.append(args[-1])
+            return await exec_(*args, **kwargs)
+
+        with patch("asyncio.create_subprocess_exec", recording):
+            asyncio.run(
+                run_command_on_all(
+                    self._hosts(1),
+                    "true",
+                    retry=RetryPolicy(attempts=1, base_delay=0.0),
+                )
+            )
+            for args in (
+                ["--format", "jsonl"],
+                ["--retries", "1"],
+                ["--stats"],
+                ["--trace-file", str(tmp_path / "t")],
+            ):
+                result = CliRunner().invoke(
+                    app, ["--no-stdin", "-H", "h00", *args, "true"]
+                )
+                assert result.exit_code == 0, result.output
+        assert ["ssh-tool-connected" in c for c in commands] == [
+            False,
+            False,
+            False,
+            True,
+            True,
+        ]
+
+    def test_retry_waves_share_the_concurrency_limit(self):
+        hosts = self._hosts(12)
+        transport = _FlakyTransport({h.name: 1 for h in hosts})
+        with patch("asyncio.sleep", wraps=asyncio.sleep) as sleep:
+            self._run(
+                hosts,
+                transport,
+                forks=3,
+                retry=RetryPolicy(attempts=2, base_delay=0.01, jitter=0.0),
+            )
+        assert transport.peak == 3
+        assert len(transport.started) == 24
+        assert [c.args[0] for c in sleep.call_args_list].count(0.01) == 1
+
+    def test_retries_count_once_towards_batch_failures(self):
+        transport = _FlakyTransport({"h00": 1, "h01": 1})
+        results = self._run(
+            self._hosts(4),
+            transport,
+            batch=BatchPolicy(size=2, max_failures=0),
+            retry=RetryPolicy(attempts=1, base_delay=0.0),
+        )
+        assert not any(r.skipped for r in results)
+
+
+class TestRetryFailed:
+    """Tests for the last-run results file and --retry-failed."""
+
+    def test_store_keeps_failed_and_unfinished_hosts(self, tmp_path):
+        store = LastRunStore(tmp_path / "last-run.json")
+        hosts = [
+            HostDefinition(
+                name=n, hostname=f"{n}.example", user="ops", port=2222, labels=["web"]
+            )
+            for n in ("a", "b", "c", "d")
+        ]
+        results = [
+            CommandResult(host=hosts[0], stdout="", stderr="", exit_code=0),
+            CommandResult(host=hosts[1], stdout="", stderr="", exit_code=3),
+            CommandResult(
+                host=hosts[2],
+                stdout="",
+                stderr="ssh: connect to host c port 22: Connection refused",
+                exit_code=255,
+            ),
+        ]
+        store.save("uptime", hosts, results)
+        last = store.load()
+        assert last.command == "uptime" and last.stdin is False
+        assert last.failed == hosts[1:]
+        assert last.failures == {"b": "command", "c": "refused", "d": "interrupted"}
+
+    def test_missing_or_corrupt_file_loads_none(self, tmp_path):
+        store = LastRunStore(tmp_path / "last-run.json")
+        assert store.load() is None
+        store.path.write_text("{not json")
+        assert store.load() is None
+
+    def test_cli_reruns_only_failed_hosts(self, fake_fleet):
+        for name in ("h00", "h01", "h02"):
+            (fake_fleet / name).mkdir()
+        (fake_fleet / "h01" / "broken").write_text("")
+        cmd = "[ -e broken ] && exit 1; echo fine"
+        first = CliRunner().invoke(
+            app, ["--no-stdin", "--history", "-H", "h00", "-H", "h01", "-H", "h02", cmd]
+        )
+        assert first.exit_code == 1
+        (fake_fleet / "log").unlink()
+        (fake_fleet / "h01" / "broken").unlink()
+        second = CliRunner().invoke(app, ["--no-stdin", "--retry-failed"])
+        assert second.exit_code == 0
+        assert (fake_fleet / "log").read_text() == "origin -> h01\n"
+        third = CliRunner().invoke(app, ["--no-stdin", "--retry-failed"])
+        assert third.exit_code == 0
+        assert "No hosts failed in the last run" in third.output
+
+    @pytest.mark.parametrize(
+        "args,recorded",
+        [
+            ([], False),
+            (["--retries", "1"], True),
+            (["--retries", "1", "--no-history"], False),
+        ],
+    )
+    def test_cli_records_the_run_only_when_asked(self, fake_fleet, args, recorded):
+        result = CliRunner().invoke(app, ["--no-stdin", "-H", "h00", *args, "exit 1"])
+        assert result.exit_code == 1
+        assert LastRunStore.default_path().exists() is recorded
+        assert not LatencyStore.default_path().exists()
+
+    def test_cli_intersects_with_given_hosts(self, fake_fleet):
+        LastRunStore().save(
+            "true", [HostDefinition(name=n, hostname=n) for n in ("a", "b")], []
+        )
+        result = CliRunner().invoke(
+            app, ["--no-stdin", "-H", "b", "-H", "c", "--retry-failed"]
+        )
+        assert result.exit_code == 0
+        assert (fake_fleet / "log").read_text() == "origin -> b\n"
+
+    def test_cli_without_previous_run(self):
+        result = CliRunner().invoke(app, ["--retry-failed"])
+        assert result.exit_code == 1
+        assert "no previous run recorded" in result.output
+
+    def test_cli_will_not_replay_stdin(self):
+        LastRunStore().save(
+            "cat", [HostDefinition(name="a", hostname="a")], [], used_stdin=True
+        )
+        result = CliRunner().invoke(app, ["--no-stdin", "--retry-failed"])
+        assert result.exit_code == 1
+        assert "read stdin" in result.output
+
+
+# ---------------------------------------------------------------------------
+# Unit Tests: bastions
+# ---------------------------------------------------------------------------
+
+import shlex
+from dataclasses import replace
+
+parse_bastion = ssh_tool.parse_bastion
+
+_BASTION_CONFIG = """\
+hosts:
+  bastion-eu: {hostname: bastion.eu.example, user: jump, port: 2222}
+  db1: {hostname: 10.1.0.1, via: bastion-eu}
+  db2: {hostname: 10.1.0.2, via: bastion-eu}
+  app1: {hostname: 10.2.0.1, via: "ops@bastion.us.example"}
+  web1: {hostname: web1.example}
+"""
+
+
+class TestBastionConfig:
+    """Tests for the 'via' field and bastion specs."""
+
+    @pytest.mark.parametrize(
+        "spec,expected",
+        [
+            ("jump.example", (None, "jump.example", 22)),
+            ("ops@jump.example:2200", ("ops", "jump.example", 2200)),
+            ("10.0.0.1:22", (None, "10.0.0.1", 22)),
+            ("fe80::1", (None, "fe80::1", 22)),
+            ("ops@[2001:db8::1]:2022", ("ops", "2001:db8::1", 2022)),
+        ],
+    )
+    def test_parse_bastion(self, spec, expected):
+        bastion = parse_bastion(spec)
+        assert (bastion.user, bastion.hostname, bastion.port) == expected
+
+    @pytest.mark.parametrize(
+        "spec", ["", "bad_host", "jump:0", "jump:ssh", "[::1]:99999"]
+    )
+    def test_parse_bastion_rejects_invalid(self, spec):
+        with pytest.raises(ValidationError, match="invalid bastion"):
+            parse_bastion(spec)
+
+    def test_via_names_a_host_or_a_target(self, tmp_path):
+        path = tmp_path / "config.yaml"
+        path.write_text(_BASTION_CONFIG)
+        config = load_config(path)
+        assert config.hosts["db1"].via is config.hosts["bastion-eu"]
+        assert config.hosts["app1"].via == HostDefinition(
+            name="ops@bastion.us.example", hostname="bastion.us.example", user="ops"
+        )
+        assert config.hosts["web1"].via is None
+
+    def test_circular_via_is_rejected(self, tmp_path):
+        path = tmp_path / "config.yaml"
+        path.write_text(
+            "hosts:\n  a: {hostname: a, via: b}\n  b: {hostname: b, via: a}\n"
+        )
+        with pytest.raises(ConfigError, match="circular 'via' reference: a -> b -> a"):
+            load_config(path)
+
+    def test_invalid_via_is_rejected(self, tmp_path):
+        path = tmp_path / "config.yaml"
+        path.write_text("hosts:\n  a: {hostname: a, via: 'no way'}\n")
+        with pytest.raises(ConfigError, match="host 'a' has invalid bastion"):
+            load_config(path)
+
+    def test_via_survives_caches(self, tmp_path):
+        path = tmp_path / "config.yaml"
+        path.write_text(_BASTION_CONFIG)
+        cache = InventoryCache(tmp_path / "cache")
+        first = cache.load(path)
+        assert cache.load(path).hosts == first.hosts
+        store = LastRunStore(tmp_path / "last-run.json")
+        store.save("true", [first.hosts["db1"]], [])
+        assert store.load().failed == [first.hosts["db1"]]
+
+    def test_inventory_hosts_share_bastions(self):
+        hosts = inventory_hosts(
+            "test",
+            [
+                {"hostname": "10.0.0.1", "via": "jump.example"},
+                {"hostname": "10.0.0.2", "via": "jump.example"},
+            ],
+        )
+        assert hosts[0].via is hosts[1].via
+        with pytest.raises(
+            ValidationError, match="host '10.0.0.1' has invalid bastion"
+        ):
+            inventory_hosts("test", [{"hostname": "10.0.0.1", "via": "a b"}])
+
+
+class TestBastionExecution:
+    """Tests for tunnelling and per-bastion concurrency."""
+
+    bastion = HostDefinition(
+        name="jump", hostname="jump.example", user="ops", port=2222
+    )
+
+    def _proxy_command(self, args):
+        return next(a for a in args if a.startswith("ProxyCommand=")).removeprefix(
+            "ProxyCommand="
+        )
+
+    def test_proxy_command_multiplexes_over_bastion_master(self):
+        host = HostDefinition(name="db1", hostname="10.1.0.1", via=self.bastion)
+        proxy = shlex.split(
+            self._proxy_command(build_ssh_args(host, 10, bastion_control_path="/tmp/m"))
+        )
+        assert proxy[:3] == ["ssh", "-W", "%h:%p"]
+        assert "ControlPath=/tmp/m" in proxy and "ControlMaster=no" in proxy
+        assert proxy[-1] == "ops@jump.example"
+        assert build_ssh_args(host, 10)[-1] == "10.1.0.1"
+
+    def test_nested_bastions_escape_percent_tokens(self):
+        outer = HostDefinition(name="edge", hostname="edge.example")
+        host = HostDefinition(
+            name="db1", hostname="10.1.0.1", via=replace(self.bastion, via=outer)
+        )
+        proxy = shlex.split(self._proxy_command(build_ssh_args(host, 10)))
+        inner = self._proxy_command(proxy)
+        assert "-W %%h:%%p" in inner and inner.endswith("edge.example")
+
+    def test_hosts_behind_different_bastions_do_not_share_masters(self):
+        pool = ConnectionPool(control_dir=Path("/tmp/x"))
+        a = HostDefinition(name="a", hostname="10.0.0.5", via=self.bastion)
+        b = HostDefinition(
+            name="b", hostname="10.0.0.5", via=HostDefinition(name="j2", hostname="j2")
+        )
+        assert pool.control_path(a) != pool.control_path(b)
+
+    def test_one_master_per_bastion(self):
+        opened = []
+
+        class Pool(ConnectionPool):
+            async def open(self, host):
+                opened.append(host.name)
+                await asyncio.sleep(0.01)
+
+        transport = SubprocessTransport(bastions=Pool(control_dir=Path("/tmp/x")))
+        other = HostDefinition(name="j2", hostname="j2.example")
+        hosts = [
+            HostDefinition(
+                name=f"h{i}",
+                hostname=f"10.0.0.{i}",
+                via=self.bastion if i % 2 else other,
+            )
+            for i in range(20)
+        ]
+
+        async def paths():
+            return await asyncio.gather(
+                *(transport.bastion_control_path(h, 10) for h in hosts)
+            )
+
+        result = asyncio.run(paths())
+        assert sorted(opened) == ["j2", "jump"]
+        assert len(set(result)) == 2
+        assert (
+            asyncio.run(
+                transport.bastion_control_path(
+                    HostDefinition(name="d", hostname="d"), 10
+                )
+            )
+            is None
+        )
+
+    def test_concurrency_is_capped_per_bastion(self):
+        bastions = [HostDefinition(name=f"j{b}", hostname=f"j{b}") for b in range(3)]
+        hosts = [
+            HostDefinition(name=f"h{i:02d}", hostname=f"h{i:02d}", via=bastions[i % 3])
+            for i in range(30)
+        ]
+        hosts += [
+            HostDefinition(name=f"d{i:02d}", hostname=f"d{i:02d}") for i in range(10)
+        ]
+        in_flight: dict = {}
+        peaks: dict = {}
+
+        class Tracking(_ScriptedTransport):
+            async def run(self, host, *args, **kwargs):
+                key = host.via.name if host.via else "direct"
+                in_flight[key] = in_flight.get(key, 0) + 1
+                in_flight["all"] = in_flight.get("all", 0) + 1
+                for k in (key, "all"):
+                    peaks[k] = max(peaks.get(k, 0), in_flight[k])
+                await asyncio.sleep(0.005)
+                in_flight[key] -= 1
+                in_flight["all"] -= 1
+                return await super().run(host, *args, **kwargs)
+
+        results = asyncio.run(
+            run_command_on_all(
+                hosts, "true", transport=Tracking(), forks=8, bastion_forks=2
+            )
+        )
+        assert [r.host.name for r in results] == [h.name for h in hosts]
+        assert all(peaks[b.name] == 2 for b in bastions)
+        assert peaks["all"] == 8
+
+    def test_cli_rejects_invalid_bastion_options(self):
+        result = CliRunner().invoke(app, ["--hosts", "web1", "--via", "a b", "uptime"])
+        assert result.exit_code == 1
+        assert "invalid bastion 'a b'" in result.output
+        result = CliRunner().invoke(
+            app, ["--hosts", "web1", "--bastion-forks", "0", "uptime"]
+        )
+        assert result.exit_code == 1
+        assert "invalid --bastion-forks value 0" in result.output
+
+
+# ---------------------------------------------------------------------------
+# Unit Tests: cold start
+# ---------------------------------------------------------------------------
+
+# Upper bound on the summed `-X importtime` self times of a one-off command
+# (about 140ms on a typical machine; yaml and rich together add over 90ms)
+_IMPORT_BUDGET_US = 300_000
+
+
+def _import_times(args):
+    """Run the script under -X importtime and return {module: self microseconds}."""
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", spec.origin, *args],
+        stdin=subprocess.DEVNULL,
+        capture_output=True,
+        text=True,
+        timeout=60,
+        check=True,
+    )
+    times = {}
+    for line in proc.stderr.splitlines():
+        if line.startswith("import time:") and "self [us]" not in line:
+            self_us, _cumulative, name = line.removeprefix("import time:").split("|")
+            times[name.strip()] = int(self_us)
+    return proc, times
+
+
+class TestColdStart:
+    """Tests that a one-off piped command imports only what it needs."""
+
+    def _run(self, fake_fleet):
+        return _import_times(["--no-stdin", "-H", "h00", "echo", "hi"])
+
+    def test_piped_command_skips_optional_modules(self, fake_fleet):
+        proc, times = self._run(fake_fleet)
+        assert proc.stdout == "[h00] hi\n"
+        for prefix in ("rich", "yaml", "readline", "json", "pickle", "sqlite3"):
+            assert not [name for name in times if name.split(".")[0] == prefix]
+
+    def test_import_time_budget(self, fake_fleet):
+        # Best of three, to keep a busy machine from failing the run
+        totals = [sum(self._run(fake_fleet)[1].values()) for _ in range(3)]
+        assert min(totals) < _IMPORT_BUDGET_US
+
+    def test_piped_formatter_never_creates_a_console(self):
+        formatter = OutputFormatter(color="never", is_tty=False, file=io.StringIO())
+        formatter.format_result(
+            CommandResult(
+                host=HostDefinition(name="a", hostname="a"),
+                stdout="x\n",
+                stderr="",
+                exit_code=0,
+            )
+        )
+        assert "console" not in vars(formatter)
+
+
+# ---------------------------------------------------------------------------
+# Unit Tests: watch mode
+# ---------------------------------------------------------------------------
+
+ChangeTracker = ssh_tool.ChangeTracker
+run_watch_mode = ssh_tool.run_watch_mode
+
+
+class _CountingTransport(Transport):
+    """Transport whose hosts print their run number if listed in `changing`, else a constant."""
+
+    def __init__(self, changing=()):
+        self.changing = set(changing)
+        self.runs = {}
+        self.closed = 0
+
+    async def run(
+        self, host, remote_cmd, timeout, connection_timeout, on_line=None, **kwargs
+    ):
+        self.runs[host.name] = self.runs.get(host.name, 0) + 1
+        stdout = (
+            f"run {self.runs[host.name]}\n" if host.name in self.changing else "same\n"
+        )
+        return CommandResult(host=host, stdout=stdout, stderr="", exit_code=0)
+
+    async def close(self):
+        self.closed += 1
+
+
+class TestWatchMode:
+    """Tests for --watch."""
+
+    def _hosts(self, count):
+        return [
+            HostDefinition(name=f"h{i:02d}", hostname=f"h{i:02d}") for i in range(count)
+        ]
+
+    def test_change_tracker_reports_only_changes(self):
+        host = HostDefinition(name="a", hostname="a")
+        tracker = ChangeTracker()
+        first = CommandResult(host=host, stdout="1\n", stderr="", exit_code=0)
+        assert tracker.update([first]) == [first]
+        assert tracker.update([replace(first)]) == []
+        failed = replace(first, exit_code=1)
+        assert tracker.update([failed]) == [failed]
+
+    def test_piped_mode_prints_only_changed_hosts(self):
+        buf = io.StringIO()
+        formatter = OutputFormatter(color="never", is_tty=False, file=buf)
+        transport = _CountingTransport(changing={"h01"})
+        exit_code = run_watch_mode(
+            self._hosts(3),
+            "uptime",
+            formatter,
+            interval=0.01,
+            transport=transport,
+            iterations=3,
+        )
+        assert exit_code == 0
+        assert buf.getvalue().splitlines() == [
+            "[h00] same",
+            "[h01] run 1",
+            "[h02] same",
+            "[h01] run 2",
+            "[h01] run 3",
+        ]
+        assert transport.runs == {"h00": 3, "h01": 3, "h02": 3}
+        assert transport.closed == 1
+
+    def test_table_rows_are_rebuilt_only_on_change(self, monkeypatch):
+        built = []
+        real = ssh_tool._watch_row
+        monkeypatch.setattr(
+            ssh_tool,
+            "_watch_row",
+            lambda result, n: built.append(result.host.name) or real(result, n),
+        )
+        buf = io.StringIO()
+        formatter = OutputFormatter(color="never", is_tty=True, file=buf)
+        run_watch_mode(
+            self._hosts(20),
+            "uptime",
+            formatter,
+            interval=0.01,
+            transport=_CountingTransport(changing={"h03"}),
+            iterations=4,
+        )
+        assert len(built) == 20 + 3
+        output = buf.getvalue()
+        assert "run 4" in output and "h19" in output and "[run 4, 1 changed]" in output
+
+    def test_connections_are_opened_once(self):
+        events = []
+
+        class Pool(ConnectionPool):
+            async def open_all(self, hosts, forks=64, bastion_forks=None):
+                events.append("open")
+                return {}
+
+            async def close_all(self):
+                events.append("close")
+
+        formatter = OutputFormatter(color="never", is_tty=False, file=io.StringIO())
+        run_watch_mode(
+            self._hosts(2),
+            "uptime",
+            formatter,
+            interval=0.01,
+            transport=_CountingTransport(),
+            pool=Pool(),
+            iterations=3,
+        )
+        assert events == ["open", "close"]
+
+    def test_masters_tunnel_over_one_capped_bastion_master(self):
+        bastion = HostDefinition(name="jump", hostname="jump.example")
+        hosts = [
+            HostDefinition(name=f"h{i:02d}", hostname=f"10.0.0.{i}", via=bastion)
+            for i in range(6)
+        ]
+        opened = []
+        in_flight = []
+        peak = 0
+
+        class Pool(ConnectionPool):
+            async def _run_ssh(self, args):
+                nonlocal peak
+                if args[1] == "-O":
+                    return 0, ""  # closing a master
+                proxy = next((a for a in args if a.startswith("ProxyCommand=")), "")
+                opened.append(
+                    (args[-1], f"ControlPath={self.control_path(bastion)}" in proxy)
+                )
+                in_flight.append(args[-1])
+                peak = max(peak, len(in_flight) if proxy else 0)
+                await asyncio.sleep(0.005)
+                in_flight.remove(args[-1])
+                return 0, ""
+
+        formatter = OutputFormatter(color="never", is_tty=False, file=io.StringIO())
+        run_watch_mode(
+            hosts,
+            "uptime",
+            formatter,
+            interval=0.01,
+            transport=_CountingTransport(),
+            pool=Pool(),
+            forks=8,
+            bastion_forks=2,
+            iterations=1,
+        )
+        assert opened[0] == ("jump.example", False)
+        assert sorted(opened[1:]) == [(f"10.0.0.{i}", True) for i in range(6)]
+        assert peak == 2
+
+    def test_iterations_start_on_a_fixed_interval(self):
+        import time as _time
+
+        formatter = OutputFormatter(color="never", is_tty=False, file=io.StringIO())
+        started = _time.monotonic()
+        run_watch_mode(
+            self._hosts(1),
+            "uptime",
+            formatter,
+            interval=0.1,
+            transport=_CountingTransport(),
+            iterations=3,
+        )
+        assert 0.2 <= _time.monotonic() - started < 0.6
+
+    def test_sigterm_stops_the_watch(self, fake_fleet, capsys):
+        import threading
+
+        formatter = OutputFormatter(color="never", is_tty=False)
+        timer = threading.Timer(0.5, os.kill, (os.getpid(), signal_module.SIGTERM))
+        timer.start()
+        try:
+            exit_code = run_watch_mode(
+                self._hosts(2), "echo up", formatter, interval=0.1
+            )
+        finally:
+            timer.cancel()
+        assert exit_code == 0
+        assert capsys.readouterr().out.count("[h00] up") == 1
+        assert len(ssh_tool._process_registry) == 0
+
+    def test_cli_rejects_invalid_watch_options(self):
+        for args, message in (
+            (["--watch", "0", "uptime"], "invalid --watch value 0"),
+            (
+                ["--watch", "1", "--aggregate", "uptime"],
+                "cannot be combined with --aggregate",
+            ),
+            (["--watch", "1"], "--watch requires a COMMAND"),
+        ):
+            result = CliRunner().invoke(app, ["--hosts", "web1", *args])
+            assert result.exit_code == 1
+            assert message in result.output